@@ -1,19 +1,88 @@
 """
 Usage:
     rbc (-h | --help)
-    rbc [-c | -s] [-o FILE] [-O LEVEL] [--emit-llvm] <file>...
+    rbc --server [-j N] [--idle-timeout=SECONDS]
+    rbc [-c | -s | --emit=KINDS] [-o FILE] [-O LEVEL] [-g] [-j N] [--emit-llvm]
+        [--byte-addressed] [--whole-program | --lto] [--aggressive-semantics]
+        [--memoize=NAMES] [--profile-generate | --profile-use=FILE]
+        [--codegen-partitions=N] [--cache] [--function-cache] [--fast]
+        [--verify] <file>...
 
 Options:
     -h, --help      Show a brief usage summary.
     -o=FILE         Write output to FILE. The default is to use the basename of
-                    <file> with an appropriate extension appended.
+                    <file> with an appropriate extension appended. Only one
+                    <file> may be given with -o and -c or -s.
     -O=LEVEL        Set optimisation level from 0 to 3. [default: 1]
     -c              Generate object file output.
     -s              Generate assembly output.
+    -g              Generate debug information.
+    -j=N            Compile up to N input files in parallel. [default: 1]
 
 Advanced options:
     --emit-llvm     Emit LLVM bytecode/assembly rather than native code when -c
                     or -s is specified.
+    --emit=KINDS    Compile each <file> once and write every output in the
+                    comma-separated list KINDS. The kinds are obj, asm, llvm-ir
+                    and llvm-bc. Outputs are named after <file> with the
+                    extension for their kind. -o may be given with one <file>
+                    and one kind.
+    --byte-addressed
+                    Use byte-oriented rather than word-oriented addresses.
+                    Vector indices are scaled by the word size but other
+                    address arithmetic is in bytes.
+    --whole-program
+                    When linking an executable, treat the B input files as the
+                    entire B program. Only main is visible to C code.
+    --lto           When linking an executable, link the B input files and
+                    the B standard library together before optimising them.
+    --aggressive-semantics
+                    Assume that signed arithmetic never overflows and that
+                    vector indices stay within their vector. Division by zero
+                    yields the dividend. This changes the meaning of programs
+                    which rely on wrapping arithmetic.
+    --memoize=NAMES Cache the results of the comma-separated list of B
+                    functions NAMES. The functions must be pure.
+    --profile-generate
+                    Instrument B code to record a profile. Running the program
+                    appends to the file named by the RBC_PROFILE environment
+                    variable or "rbc.prof" if it is not set.
+    --profile-use=FILE
+                    Optimise using a profile recorded by a program compiled
+                    with --profile-generate.
+    --codegen-partitions=N
+                    Split each B module into N partitions by function and
+                    optimise and generate native code for them in parallel.
+                    Functions in different partitions are not inlined into
+                    one another. [default: 1]
+    --cache         Reuse output from earlier compilations of the same source
+                    with the same options. Output is cached in the directory
+                    named by the RBC_CACHE_DIR environment variable or
+                    ~/.cache/rbc if it is not set.
+    --function-cache
+                    Optimise each function separately and reuse unchanged
+                    functions from earlier compilations when a file changes.
+                    Functions are not inlined into one another. Functions are
+                    cached in the same directory as --cache output.
+    --fast          Compile for the lowest latency rather than the fastest
+                    code. B code is not optimised, whatever -O says, and
+                    native code is generated by LLVM's fast instruction
+                    selector.
+    --verify        Check the LLVM code generated for each module for errors
+                    in the compiler. This is the default unless --fast is
+                    given.
+
+Compile server options:
+    --server        Start a compile server which keeps the compiler loaded. If
+                    a server is running, rbc asks it to compile rather than
+                    compiling itself. At most N files are compiled at once
+                    where N is given by -j. The server listens on the socket
+                    named by the RBC_SERVER_SOCKET environment variable or on
+                    a private default socket. Set RBC_SERVER_SOCKET to an
+                    empty string to disable the server.
+    --idle-timeout=SECONDS
+                    Stop the server when it has had nothing to do for SECONDS
+                    seconds. [default: 600]
 
 """
 import enum
@@ -22,12 +91,20 @@ import sys
 
 import docopt
 
-import rbc.compiler
+# The compiler, cache and server modules are imported by the functions which
+# use them. Importing the compiler loads LLVM and the parser which takes much
+# longer than parsing the command line and so "rbc --help" should not pay for
+# it.
 
 class OptionError(RuntimeError):
     pass
 
-OutputType = enum.Enum('OutputType', 'object asm executable')
+OutputType = enum.Enum('OutputType', 'object asm executable outputs')
+
+# File extensions of each kind of output which may be given to --emit.
+_EMIT_EXTENSIONS = {
+    'obj': '.o', 'asm': '.s', 'llvm-ir': '.ll', 'llvm-bc': '.bc',
+}
 
 class Options(object):
     def __init__(self, opts):
@@ -38,50 +115,137 @@ class Options(object):
             self.output_type = OutputType.object
         elif opts['-s']:
             self.output_type = OutputType.asm
+        elif opts['--emit'] is not None:
+            self.output_type = OutputType.outputs
         else:
             self.output_type = OutputType.executable
 
         if self.output_type != OutputType.executable and \
-                len(self.input_files) > 1:
-            raise OptionError('Only one file with -c or -s option')
+                self.output_file is not None and len(self.input_files) > 1:
+            raise OptionError('Only one file with -o and -c, -s or --emit')
+
+        if opts['--emit'] is not None:
+            self.emit = opts['--emit'].split(',')
+        else:
+            self.emit = []
+        for kind in self.emit:
+            if kind not in _EMIT_EXTENSIONS:
+                raise OptionError('Unknown output kind: ' + kind)
+        if self.output_file is not None and len(self.emit) > 1:
+            raise OptionError('Only one output kind with -o and --emit')
 
         self.emit_llvm = opts['--emit-llvm']
+        self.cache = opts['--cache']
+        self.function_cache = opts['--function-cache']
+        self.debug_info = opts['-g']
+        self.profile_generate = opts['--profile-generate']
+        self.profile_use = opts['--profile-use']
+        self.byte_addressed = opts['--byte-addressed']
+        self.whole_program = opts['--whole-program']
+        self.lto = opts['--lto']
+        self.aggressive_semantics = opts['--aggressive-semantics']
+        if opts['--memoize'] is not None:
+            self.memoize = frozenset(opts['--memoize'].split(','))
+        else:
+            self.memoize = frozenset()
 
         self.opt_level = int(opts['-O'])
         if self.opt_level < 0 or self.opt_level > 3:
             raise OptionError('Optimisation level must be between 0 and 3.')
 
+        self.codegen_partitions = int(opts['--codegen-partitions'])
+        if self.codegen_partitions < 1:
+            raise OptionError('Number of partitions must be at least 1.')
+
+        self.jobs = int(opts['-j'])
+        if self.jobs < 1:
+            raise OptionError('Number of jobs must be at least 1.')
+
+        self.fast = opts['--fast']
+        self.verify = opts['--verify'] or not self.fast
+
+        self.server = opts['--server']
+        self.idle_timeout = float(opts['--idle-timeout'])
+
 def compile_object(output_file, source_file, compiler_options, emit_llvm):
-    with open(source_file) as fobj:
-        source = fobj.read()
-    module_asm = rbc.compiler.compile_b_source(source, compiler_options)
-    module = rbc.compiler.optimize_module(module_asm, compiler_options)
-    module.name = os.path.basename(source_file)
-    with open(output_file, 'wb') as fobj:
-        if emit_llvm:
+    import rbc.compiler
+    if not emit_llvm:
+        rbc.compiler.compile_b_to_native_object(
+            output_file, source_file, compiler_options)
+        return
+
+    def _compile(output_file, source):
+        module = rbc.compiler.compile_b_to_module(
+            source, compiler_options, filename=source_file)
+        with open(output_file, 'wb') as fobj:
             fobj.write(module.as_bitcode())
-        else:
-            fobj.write(compiler_options.machine.emit_object(module))
+
+    rbc.compiler.cached_compile(
+        output_file, source_file, compiler_options, 'llvm-bc', _compile)
 
 def compile_asm(output_file, source_file, compiler_options, emit_llvm):
-    with open(source_file) as fobj:
-        source = fobj.read()
-    module_asm = rbc.compiler.compile_b_source(source, compiler_options)
-    module = rbc.compiler.optimize_module(module_asm, compiler_options)
-    module.name = os.path.basename(source_file)
-    with open(output_file, 'w') as fobj:
-        if emit_llvm:
-            fobj.write(str(module))
-        else:
-            fobj.write(compiler_options.machine.emit_assembly(module))
+    import rbc.compiler
+    def _compile(output_file, source):
+        module = rbc.compiler.compile_b_to_module(
+            source, compiler_options, filename=source_file)
+        with open(output_file, 'w') as fobj:
+            if emit_llvm:
+                fobj.write(str(module))
+            else:
+                fobj.write(compiler_options.machine.emit_assembly(module))
+
+    rbc.compiler.cached_compile(
+        output_file, source_file, compiler_options,
+        'llvm-ir' if emit_llvm else 'asm', _compile)
+
+def compile_outputs(outputs, source_file, compiler_options):
+    import rbc.compiler
+    rbc.compiler.compile_b_to_outputs(outputs, source_file, compiler_options)
 
 def main():
     """Main entry point for rbc tool."""
     # Parse CLI opts
     opts = Options(docopt.docopt(__doc__))
 
+    import rbc.server
+
+    if opts.server:
+        rbc.server.serve(jobs=opts.jobs, idle_timeout=opts.idle_timeout)
+        return
+
+    # Prefer a running compile server unless the server has been disabled.
+    socket_path = rbc.server.default_socket_path()
+    if socket_path is not None:
+        try:
+            if rbc.server.compile_remotely(opts, socket_path):
+                return
+        except rbc.server.RemoteCompileError as err:
+            sys.exit(str(err))
+
+    run(opts)
+
+def run(opts):
+    """Carry out the compilation described by an Options object."""
+    import rbc.cache
+    import rbc.compiler
+
     compiler_options = rbc.compiler.CompilerOptions()
     compiler_options.opt_level = opts.opt_level
+    compiler_options.byte_addressed = opts.byte_addressed
+    compiler_options.whole_program = opts.whole_program
+    compiler_options.lto = opts.lto
+    compiler_options.aggressive_semantics = opts.aggressive_semantics
+    compiler_options.memoize = opts.memoize
+    compiler_options.debug_info = opts.debug_info
+    compiler_options.profile_generate = opts.profile_generate
+    compiler_options.profile_use = opts.profile_use
+    compiler_options.codegen_partitions = opts.codegen_partitions
+    compiler_options.fast = opts.fast
+    compiler_options.verify = opts.verify
+    if opts.cache:
+        compiler_options.output_cache = rbc.cache.OutputCache()
+    if opts.function_cache:
+        compiler_options.function_cache = rbc.cache.OutputCache()
 
     if opts.output_type == OutputType.executable:
         if opts.output_file is None:
@@ -89,20 +253,48 @@ def main():
         else:
             output_file = opts.output_file
         rbc.compiler.compile_and_link(
-            output_file, opts.input_files, options=compiler_options)
-    elif opts.output_type == OutputType.object:
-        output_file = opts.output_file
-        if output_file is None:
+            output_file, opts.input_files, options=compiler_options,
+            jobs=opts.jobs)
+    elif opts.output_type in (OutputType.object, OutputType.asm):
+        if opts.output_type == OutputType.object:
+            compile_func = compile_object
             out_ext = '.bc' if opts.emit_llvm else '.o'
-            output_file = os.path.splitext(opts.input_files[0])[0] + out_ext
-        compile_object(output_file, opts.input_files[0], compiler_options,
-                       emit_llvm=opts.emit_llvm)
-    elif opts.output_type == OutputType.asm:
-        output_file = opts.output_file
-        if output_file is None:
+        else:
+            compile_func = compile_asm
             out_ext = '.ll' if opts.emit_llvm else '.s'
-            output_file = os.path.splitext(opts.input_files[0])[0] + out_ext
-        compile_asm(output_file, opts.input_files[0], compiler_options,
-                    emit_llvm=opts.emit_llvm)
+
+        # Partitioned compilation uses a worker pool of its own.
+        if opts.jobs > 1 and len(opts.input_files) > 1:
+            compiler_options.codegen_partitions = 1
+
+        compile_jobs = []
+        for input_file in opts.input_files:
+            output_file = opts.output_file
+            if output_file is None:
+                output_file = os.path.splitext(input_file)[0] + out_ext
+            compile_jobs.append((compile_func, (
+                output_file, input_file, compiler_options, opts.emit_llvm)))
+        rbc.compiler.map_jobs(_compile_output, compile_jobs, opts.jobs)
+    elif opts.output_type == OutputType.outputs:
+        compile_jobs = []
+        for input_file in opts.input_files:
+            outputs = {}
+            for kind in opts.emit:
+                output_file = opts.output_file
+                if output_file is None:
+                    output_file = os.path.splitext(input_file)[0] + \
+                        _EMIT_EXTENSIONS[kind]
+                outputs[kind] = output_file
+            compile_jobs.append((compile_outputs, (
+                outputs, input_file, compiler_options)))
+        rbc.compiler.map_jobs(_compile_output, compile_jobs, opts.jobs)
     else:
         raise RuntimeError('Unknown output type')
+
+def _compile_output(job):
+    """Worker function which takes a tuple of compile_object, compile_asm or
+    compile_outputs and a tuple of its arguments and calls it.
+
+    """
+    compile_func, args = job
+    compile_func(*args)
@@ -0,0 +1,205 @@
+"""
+Content-addressed cache of compiler output.
+
+"""
+import errno
+import hashlib
+import os
+import shutil
+import tempfile
+
+# Output caches
+# =============
+#
+# Compiling a B file is a pure function of the source, the compiler options
+# and the compiler itself. An output cache is a directory of files, such as
+# native objects, named by a hash of everything which affected them. If a file
+# with the same hash is requested again, it is copied from the cache rather
+# than being compiled.
+#
+# The cache has a maximum size. Whenever a file is used, its modification time
+# is updated. When the cache grows too large, the least recently used files
+# are removed. Files are added to the cache by renaming a complete temporary
+# file so that concurrent compilers never see a partially written file.
+
+# Default maximum size of the cache in bytes.
+DEFAULT_MAX_SIZE = 512 * 1024 * 1024
+
+# Suffix of temporary files in the cache directory.
+_TEMP_SUFFIX = '.tmp'
+
+def default_cache_dir():
+    """Return the default cache directory. This is the directory named by the
+    RBC_CACHE_DIR environment variable if set or an "rbc" directory within the
+    user's cache directory otherwise.
+
+    """
+    cache_dir = os.environ.get('RBC_CACHE_DIR')
+    if cache_dir is not None:
+        return cache_dir
+    cache_home = os.environ.get(
+        'XDG_CACHE_HOME', os.path.join(os.path.expanduser('~'), '.cache'))
+    return os.path.join(cache_home, 'rbc')
+
+def hash_key(parts):
+    """Return a hexadecimal key for a sequence of str or bytes parts."""
+    digest = hashlib.sha256()
+    for part in parts:
+        if not isinstance(part, bytes):
+            part = str(part).encode('utf8')
+        digest.update(str(len(part)).encode('utf8') + b':')
+        digest.update(part)
+    return digest.hexdigest()
+
+# Extensions of the files in the rbc package which affect compiler output.
+_COMPILER_FILE_EXTENSIONS = frozenset(['.py', '.b', '.ebnf'])
+
+def compiler_fingerprint():
+    """Return a string which changes whenever the compiler may have changed.
+    The compiler is identified by the llvmlite version and the names, sizes
+    and modification times of the files making up the rbc package.
+
+    """
+    if compiler_fingerprint.value is not None:
+        return compiler_fingerprint.value
+
+    # Only the version is needed and so llvmlite is not imported until now.
+    import llvmlite
+
+    package_dir = os.path.dirname(os.path.abspath(__file__))
+    parts = [llvmlite.__version__]
+    for dir_path, dir_names, filenames in os.walk(package_dir):
+        dir_names.sort()
+        for filename in sorted(filenames):
+            if os.path.splitext(filename)[1] not in _COMPILER_FILE_EXTENSIONS:
+                continue
+            path = os.path.join(dir_path, filename)
+            stat = os.stat(path)
+            parts.extend([
+                os.path.relpath(path, package_dir), stat.st_size,
+                stat.st_mtime])
+
+    compiler_fingerprint.value = hash_key(parts)
+    return compiler_fingerprint.value
+
+compiler_fingerprint.value = None
+
+class OutputCache(object):
+    """A cache of compiler output files in a directory.
+
+    Attributes:
+        directory: the directory holding the cache
+        max_size: the maximum total size of the cached files in bytes
+        hard_link: if True, outputs are hard linked to cached files rather
+                   than copied. Outputs must then never be modified in place.
+        hits: the number of successful calls to fetch() and fetch_bytes()
+        misses: the number of unsuccessful calls to fetch() and fetch_bytes()
+
+    """
+    def __init__(self, directory=None, max_size=DEFAULT_MAX_SIZE):
+        self.directory = directory if directory is not None \
+            else default_cache_dir()
+        self.max_size = max_size
+        self.hard_link = False
+        self.hits = 0
+        self.misses = 0
+
+    def fetch(self, key, output_filename):
+        """Write the cached file for key to output_filename. Returns True if
+        the file was in the cache and False otherwise.
+
+        """
+        cached_filename = self._use(key)
+        if cached_filename is None:
+            return False
+
+        if self.hard_link:
+            if os.path.exists(output_filename):
+                os.unlink(output_filename)
+            os.link(cached_filename, output_filename)
+        else:
+            shutil.copyfile(cached_filename, output_filename)
+        return True
+
+    def fetch_bytes(self, key):
+        """Return the contents of the cached file for key as bytes or None if
+        there is no such file.
+
+        """
+        cached_filename = self._use(key)
+        if cached_filename is None:
+            return None
+        with open(cached_filename, 'rb') as fobj:
+            return fobj.read()
+
+    def store(self, key, output_filename):
+        """Add a copy of output_filename to the cache for key and then remove
+        least recently used files until the cache is small enough.
+
+        """
+        with open(output_filename, 'rb') as fobj:
+            self.store_bytes(key, fobj.read())
+
+    def store_bytes(self, key, contents):
+        """Like store() but takes the contents of the file as bytes."""
+        if not os.path.isdir(self.directory):
+            os.makedirs(self.directory)
+
+        temp_fd, temp_filename = tempfile.mkstemp(
+            suffix=_TEMP_SUFFIX, dir=self.directory)
+        try:
+            with os.fdopen(temp_fd, 'wb') as fobj:
+                fobj.write(contents)
+            os.rename(temp_filename, self._path(key))
+        finally:
+            if os.path.exists(temp_filename):
+                os.unlink(temp_filename)
+
+        self._evict()
+
+    def _use(self, key):
+        """Return the path of the cached file for key, marking it as recently
+        used, or None if there is no such file. Updates the hit and miss
+        counters.
+
+        """
+        cached_filename = self._path(key)
+        try:
+            os.utime(cached_filename, None)
+        except OSError as err:
+            if err.errno != errno.ENOENT:
+                raise
+            self.misses += 1
+            return None
+        self.hits += 1
+        return cached_filename
+
+    def _path(self, key):
+        """Return the path of the cached file for key."""
+        return os.path.join(self.directory, key)
+
+    def _evict(self):
+        """Remove least recently used files until the cache is no larger than
+        max_size.
+
+        """
+        entries = []
+        for name in os.listdir(self.directory):
+            if name.endswith(_TEMP_SUFFIX):
+                continue
+            try:
+                stat = os.stat(os.path.join(self.directory, name))
+            except OSError:
+                # Removed by a concurrent compiler
+                continue
+            entries.append((stat.st_mtime, stat.st_size, name))
+
+        total_size = sum(size for _, size, _ in entries)
+        for _, size, name in sorted(entries):
+            if total_size <= self.max_size:
+                break
+            try:
+                os.unlink(os.path.join(self.directory, name))
+            except OSError:
+                pass
+            total_size -= size
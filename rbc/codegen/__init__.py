@@ -15,7 +15,8 @@ import rbc.exception as exc
 
 # HACK: make sure all the AST node types are imported and registered
 from . import astnode, expression, external, statement
-from . import context
+from . import analysis, context, profile
+from .profile import apply_profile, instrument_functions
 
 # Constructing AST Nodes
 # ======================
@@ -50,16 +51,48 @@ class Program(astnode.ASTNode):
     :py:meth:`.emit`, which returns the LLVM module assembly as a string.
 
     """
-    def emit(self, target, machine):
+    def emit(self, target, machine, byte_addressed=False,
+             constant_externals=frozenset(), aggressive_semantics=False,
+             memoized_functions=frozenset(), debug_info=False,
+             filename=None, profile_generate=False, profile=None,
+             emitted_functions=None, define_externals=True,
+             shared_constructor=False):
         """Take an llvm Target and TargetMachine instance representing the
-        ultimate target for the emitted code.
+        ultimate target for the emitted code. If byte_addressed is True, emit
+        code which uses byte-oriented addresses. External variables named in
+        constant_externals are assumed never to be written to. If
+        aggressive_semantics is True, signed overflow and out-of-object address
+        arithmetic are assumed never to happen. Functions named in
+        memoized_functions are assumed to be pure and their results are
+        cached. If debug_info is True, emit debug information referring to the
+        source file filename. If profile_generate is True, instrument the
+        code to record a profile. If profile is not None, it is a profile as
+        returned by :py:func:`.profile.read_profile` used to annotate the
+        code. If emitted_functions is not None, only the bodies of the
+        functions named in it are emitted. If define_externals is False,
+        external variables are only declared. These two arguments are used to
+        emit one partition of a module. If shared_constructor is True, external
+        variables are initialised by a single constructor function.
 
         Returns:
             A stirng containing the LLVM module assembly code.
 
         """
         # Create a new emit context for the program
-        ctx = context.EmitContext(target, machine)
+        ctx = context.EmitContext(target, machine,
+                                  byte_addressed=byte_addressed,
+                                  constant_externals=constant_externals,
+                                  aggressive_semantics=aggressive_semantics,
+                                  memoized_functions=memoized_functions,
+                                  debug_info=debug_info, filename=filename,
+                                  profile=profile,
+                                  emitted_functions=emitted_functions,
+                                  define_externals=define_externals,
+                                  shared_constructor=shared_constructor)
+        if profile_generate:
+            ctx.post_emit_hooks.append(instrument_functions)
+        if profile is not None:
+            ctx.post_emit_hooks.append(apply_profile)
 
         with ctx.emitting_code():
             # Declare all top-level definitions
@@ -0,0 +1,222 @@
+"""
+Whole-program analyses of the AST.
+
+"""
+from .astnode import ASTNode
+from .expression import (
+    AssignmentOpValue, BinaryOpValue, DereferencedRValue, FunctionCallValue,
+    LeftUnaryOpValue, RightUnaryOpValue, ScopeValue
+)
+from .external import FunctionDefinition, SimpleDefinition, VectorDefinition
+from .statement import ExtrnStatement
+
+# Constant externals
+# ==================
+#
+# An external variable which is never written to may be emitted as a constant
+# so that LLVM can fold its value. Proving that a variable is never written to
+# requires that the entire program is available and so this analysis should
+# only be used for whole-program compilation.
+#
+# The analysis is a conservative walk over the AST. Each occurrence of a name
+# is classified by how its value is used. A name is a potential write if it is
+# assigned to, incremented, decremented or referenced with "&". The value of a
+# vector name is its address and so any use of a vector name other than as the
+# base of a read such as "v[i]" or "*(v+1)" may allow its address to escape.
+# Local variables are not distinguished from externals with the same name which
+# can only make the analysis more conservative.
+
+# The ways in which the value of an AST node may be used.
+_READ, _WRITE, _INDEX = 'read', 'write', 'index'
+
+def find_constant_externals(programs):
+    """Take a sequence of Program AST nodes which together form an entire B
+    program and return a frozenset of names of external variables defined in
+    the program which are never written to and whose addresses never escape.
+
+    """
+    simple_names, vector_names = set(), set()
+    for program in programs:
+        for definition in program.definitions:
+            if isinstance(definition, SimpleDefinition):
+                simple_names.add(definition.name)
+            elif isinstance(definition, VectorDefinition):
+                vector_names.add(definition.name)
+
+    unsafe_names = set()
+    for program in programs:
+        _find_unsafe_names(program, _READ, vector_names, unsafe_names)
+
+    return frozenset((simple_names | vector_names) - unsafe_names)
+
+def _find_unsafe_names(node, use, vector_names, unsafe_names):
+    """Walk the AST rooted at node, whose value is used as specified by use,
+    and add the names of any variables which may be written to or whose
+    address may escape to unsafe_names.
+
+    """
+    def walk(child, child_use=_READ):
+        _find_unsafe_names(child, child_use, vector_names, unsafe_names)
+
+    if isinstance(node, (list, tuple)):
+        for child in node:
+            walk(child)
+        return
+
+    if not isinstance(node, ASTNode):
+        return
+
+    if isinstance(node, ScopeValue):
+        if use == _WRITE or (node.name in vector_names and use != _INDEX):
+            unsafe_names.add(node.name)
+    elif isinstance(node, AssignmentOpValue):
+        walk(node.lhs, _WRITE)
+        walk(node.rhs)
+    elif isinstance(node, LeftUnaryOpValue) and node.op == '*':
+        _find_unsafe_dereferenced_names(
+            node.rhs, use, vector_names, unsafe_names)
+    elif isinstance(node, LeftUnaryOpValue) and node.op in ['&', '++', '--']:
+        walk(node.rhs, _WRITE)
+    elif isinstance(node, RightUnaryOpValue) and node.op in ['++', '--']:
+        walk(node.lhs, _WRITE)
+    elif isinstance(node, DereferencedRValue):
+        _find_unsafe_dereferenced_names(
+            node.rvalue, use, vector_names, unsafe_names)
+    elif isinstance(node, BinaryOpValue) and use == _INDEX and \
+            node.op in ('+', '-'):
+        walk(node.lhs, _INDEX)
+        walk(node.rhs, _INDEX)
+    elif isinstance(node, FunctionCallValue):
+        # Be conservative about what may be called.
+        walk(node.func, _WRITE)
+        walk(node.args)
+    else:
+        for attr_name, child in vars(node).items():
+            if not attr_name.startswith('_'):
+                walk(child)
+
+def _find_unsafe_dereferenced_names(rvalue, use, vector_names, unsafe_names):
+    """Like _find_unsafe_names but for an rvalue which is dereferenced."""
+    # An address which is only dereferenced to be read cannot be used to write.
+    if use in (_READ, _INDEX):
+        address_use = _INDEX
+    else:
+        address_use = _READ
+    _find_unsafe_names(rvalue, address_use, vector_names, unsafe_names)
+
+# Module partitions
+# =================
+#
+# When code generation for a module is split between several processes, the
+# functions should be shared out so that each process has a similar amount of
+# work. The work needed for a function is estimated by the number of AST nodes
+# in its body. Functions are taken from largest to smallest and each is given
+# to the partition with the least work so far.
+
+def partition_functions(program, n_partitions):
+    """Take a Program AST node and return a list of n_partitions frozensets
+    which together contain the names of all the functions defined in the
+    program. Some partitions may be empty if there are few functions.
+
+    """
+    functions = [
+        (_count_nodes(definition), definition.name)
+        for definition in program.definitions
+        if isinstance(definition, FunctionDefinition)
+    ]
+    functions.sort(key=lambda size_and_name: -size_and_name[0])
+
+    names = [set() for _ in range(n_partitions)]
+    sizes = [0] * n_partitions
+    for size, name in functions:
+        part_idx = sizes.index(min(sizes))
+        names[part_idx].add(name)
+        sizes[part_idx] += size
+
+    return [frozenset(part_names) for part_names in names]
+
+def _count_nodes(node):
+    """Return the number of AST nodes in the tree rooted at node."""
+    if isinstance(node, (list, tuple)):
+        return sum(_count_nodes(child) for child in node)
+
+    if not isinstance(node, ASTNode):
+        return 0
+
+    return 1 + sum(
+        _count_nodes(child) for attr_name, child in vars(node).items()
+        if not attr_name.startswith('_'))
+
+# Function dependencies
+# =====================
+#
+# The code emitted for a function depends only on the function's own AST and
+# on how the external names it uses are defined elsewhere in the program. A
+# call to a function defined in the program is a direct call with the right
+# number of arguments and a vector defined in the program has a known size and
+# layout. A function may therefore be compiled on its own, and its compiled
+# code reused, given the "signatures" of the names it refers to.
+
+def definition_signatures(program):
+    """Take a Program AST node and return a dict mapping the names of its
+    top-level definitions to tuples describing how they are declared.
+
+    """
+    signatures = {}
+    for definition in program.definitions:
+        if isinstance(definition, FunctionDefinition):
+            signature = ('function', len(definition.arg_names))
+        elif isinstance(definition, VectorDefinition):
+            # Partially initialised vectors have a different llvm type.
+            signature = (
+                'vector', definition.element_count(),
+                definition.constant_element_count())
+        else:
+            signature = ('simple',)
+        signatures[definition.name] = signature
+    return signatures
+
+def referenced_names(node):
+    """Return a frozenset of the names used in the AST rooted at node. Local
+    variables are not distinguished from externals with the same name.
+
+    """
+    names = set()
+    _find_names(node, names)
+    return frozenset(names)
+
+def _find_names(node, names):
+    """Add the names used in the AST rooted at node to names."""
+    if isinstance(node, (list, tuple)):
+        for child in node:
+            _find_names(child, names)
+        return
+
+    if not isinstance(node, ASTNode):
+        return
+
+    if isinstance(node, (ScopeValue, ExtrnStatement)):
+        names.add(node.name)
+    for attr_name, child in vars(node).items():
+        if not attr_name.startswith('_'):
+            _find_names(child, names)
+
+def serialize_ast(node, positions=False):
+    """Return a string which uniquely describes the AST rooted at node. Source
+    positions are only included if positions is True.
+
+    """
+    if isinstance(node, (list, tuple)):
+        return '[' + ','.join(
+            serialize_ast(child, positions) for child in node) + ']'
+
+    if not isinstance(node, ASTNode):
+        return repr(node)
+
+    attrs = sorted(
+        (attr_name, serialize_ast(child, positions))
+        for attr_name, child in vars(node).items()
+        if not attr_name.startswith('_') and
+        (positions or attr_name != 'position'))
+    return '{}({})'.format(type(node).__name__, ','.join(
+        '{}={}'.format(attr_name, value) for attr_name, value in attrs))
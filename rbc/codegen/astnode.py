@@ -41,7 +41,13 @@ def ast_node(cls):
 # values directly as attributes.
 
 class ASTNode(object):
-    """An AST node with parameters directly accessible as attributes."""
+    """An AST node with parameters directly accessible as attributes. If known,
+    the position attribute is a tuple giving the line and column of the node in
+    the source.
+
+    """
+    position = None
+
     def __init__(self, **kwargs):
         # Set attributes on ourself directly from the keyword args.
         for k, v in kwargs.items():
@@ -58,12 +64,14 @@ class ASTNode(object):
 def needs_builder(emit):
     """A decorator for emit() methods which make use of the context's builder
     attribute. If the builder attribute is None, an InternalCompilerError is
-    raised.
+    raised. Instructions emitted are given the node's source position as their
+    debug location if known.
 
     """
     @functools.wraps(emit)
     def _wrapped_emit(self, context):
         if context.builder is None:
             raise exc.InternalCompilerError('AST node requires builder.')
-        return emit(self, context)
+        with context.at_source_position(self.position):
+            return emit(self, context)
     return _wrapped_emit
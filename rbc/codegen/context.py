@@ -1,9 +1,12 @@
 from __future__ import print_function
 import contextlib
+import os
 from future.moves import collections
 
 from llvmlite import ir
 
+import rbc.exception as exc
+
 # Emitting code from the AST
 # ==========================
 #
@@ -17,13 +20,63 @@ from llvmlite import ir
 
 class EmitContext(object):
     """A context is initialised with an llvm Target and TargetMachine instance.
+    If byte_addressed is True, B addresses are emitted as byte-oriented
+    addresses. See the discussion of addresses below. External variables whose
+    names are in constant_externals are known never to be written to and are
+    emitted as constants where possible. If aggressive_semantics is True, code
+    is emitted assuming that the program never overflows signed arithmetic or
+    accesses one object via an address derived from another. See the
+    discussion of aggressive semantics below. Functions whose names are in
+    memoized_functions are assumed to be pure and their results are cached. If
+    debug_info is True, DWARF debug information is emitted referring to the
+    source file filename. If profile is not None, it is a profile as returned
+    by profile.read_profile() which is used to annotate the emitted code. If
+    emitted_functions is not None, only the bodies of the functions named in it
+    are emitted and other functions are merely declared. If define_externals
+    is False, external variables are declared but not defined. See the
+    discussion of module partitions below. If shared_constructor is True, the
+    initialisers of all external variables are emitted into a single
+    constructor function rather than one constructor each.
 
     """
-    def __init__(self, target, machine):
+    def __init__(self, target, machine, byte_addressed=False,
+                 constant_externals=frozenset(), aggressive_semantics=False,
+                 memoized_functions=frozenset(), debug_info=False,
+                 filename=None, profile=None, emitted_functions=None,
+                 define_externals=True, shared_constructor=False):
         # Record target and machine
         self.target = target
         self.machine = machine
 
+        # Are addresses byte-oriented rather than word-oriented?
+        self.byte_addressed = byte_addressed
+
+        # Names of external variables which are never written to
+        self.constant_externals = constant_externals
+
+        # May code assume that undefined overflow and aliasing never happen?
+        self.aggressive_semantics = aggressive_semantics
+
+        # Names of pure functions whose results should be cached
+        self.memoized_functions = memoized_functions
+
+        # Should debug information be emitted and, if so, for which file?
+        self.debug_info = debug_info
+        self.filename = filename if filename is not None else '<source>'
+
+        # Profile used to annotate the emitted code
+        self.profile = profile
+
+        # Names of functions whose bodies are emitted or None for all
+        # functions and whether external variables are defined
+        self.emitted_functions = emitted_functions
+        self.define_externals = define_externals
+
+        # Should external variables be initialised by a single constructor
+        # and, if so, the block at the end of the constructor emitted so far
+        self.shared_constructor = shared_constructor
+        self.shared_constructor_block = None
+
         # We choose the word type to be an integer with the same size as a
         # pointer to i8. The word size is expressed in bytes
         word_size = ir.IntType(8).as_pointer().get_abi_size(
@@ -58,12 +111,38 @@ class EmitContext(object):
         # Block which new switch tests should be appended to
         self.switch_block = None
 
+        # Ordered mapping from llvm.loop metadata hint names to values for the
+        # innermost loop being emitted. None if not within a loop.
+        self.loop_hints = None
+
         # Labels are mappings from names to.basic blocks A goto branches to the
-        # block. The labels dict is only created within functions.
+        # block. The labels dict is only created within functions. Blocks may be
+        # created by a goto before the corresponding label is reached and so
+        # the names of labels which have actually been defined are recorded
+        # separately.
         self.labels = None
+        self.defined_labels = None
 
         # Callables which should be called after all code has been emitted
         self.post_emit_hooks = []
+        if aggressive_semantics:
+            self.post_emit_hooks.append(_add_alias_scopes)
+
+        # The llvm Functions for B functions which have been emitted. These
+        # are the functions which are instrumented or annotated when using
+        # profiles.
+        self.profiled_functions = []
+
+        # Pairs of llvm load or store instructions and the object they access.
+        # See record_memory_access().
+        self.memory_accesses = []
+
+        # Debug information metadata for the source file, compile unit and
+        # the subprogram corresponding to the function being emitted.
+        self.debug_file = None
+        self.debug_compile_unit = None
+        self.debug_word_type = None
+        self.debug_subprogram = None
 
         # Flag to indicate when one is within the emitting_code() context.
         self._is_emitting = False
@@ -94,10 +173,18 @@ class EmitContext(object):
         self.module.triple = self.target.triple
         self.module.data_layout = str(self.machine.target_data)
 
+        if self.debug_info:
+            _add_compile_unit(self)
+
         self._is_emitting = True
         yield
         self._is_emitting = False
 
+        # Call any post-commit hooks. These may create constructors.
+        for hook in self.post_emit_hooks:
+            hook(self)
+        self.post_emit_hooks = []
+
         # Create the global variable constructors if necessary
         if len(self.ctor_records) > 0:
             ctor_array_type = ir.ArrayType(
@@ -108,11 +195,6 @@ class EmitContext(object):
             var.linkage = 'appending'
             var.initializer = ir.Constant(ctor_array_type, self.ctor_records)
 
-        # Call any post-commit hooks
-        for hook in self.post_emit_hooks:
-            hook(self)
-        self.post_emit_hooks = []
-
     # Scopes
     # ======
     #
@@ -144,6 +226,12 @@ class EmitContext(object):
     # attribute should be set to the instruction builder while emitting
     # top-level definitions containing code. If should be None if there is no
     # currently defined point to insert code.
+    #
+    # Statements such as return, goto and break terminate the current block.
+    # Rather than create a new block for any following code, the builder is left
+    # positioned at the end of the terminated block. Code emitted at such a
+    # position is unreachable and statements should not be emitted there unless
+    # control may enter them via a label.
 
     @contextlib.contextmanager
     def new_function_body(self, entry_block):
@@ -156,17 +244,75 @@ class EmitContext(object):
         builder = ir.IRBuilder(entry_block)
         old_builder, self.builder = self.builder, builder
         old_labels, self.labels = self.labels, {}
+        old_defined_labels, self.defined_labels = self.defined_labels, set()
         with self.in_child_scope():
             yield
+
+        # Any label which was the target of a goto must have been defined.
+        for label in self.labels:
+            if label not in self.defined_labels:
+                raise exc.SemanticError('No such label: {}'.format(label))
+
+        self.defined_labels = old_defined_labels
         self.labels = old_labels
         self.builder = old_builder
 
+    @contextlib.contextmanager
+    def in_debug_subprogram(self, subprogram, line):
+        """A context manager which sets the debug information subprogram for
+        the function being emitted. Instructions emitted within it are given
+        the location of line, the start of the function, unless a more precise
+        location is known.
+
+        """
+        old_subprogram, self.debug_subprogram = \
+            self.debug_subprogram, subprogram
+        old_location = self.builder.debug_metadata
+        self.builder.debug_metadata = self.module.add_debug_info(
+            'DILocation', {'line': line, 'column': 0, 'scope': subprogram})
+        yield
+        self.builder.debug_metadata = old_location
+        self.debug_subprogram = old_subprogram
+
+    @contextlib.contextmanager
+    def at_source_position(self, position):
+        """A context manager which sets the debug location of instructions
+        emitted within it to position, a line and column tuple. Does nothing if
+        position is None or no debug information is being emitted.
+
+        """
+        if position is None or self.debug_subprogram is None:
+            yield
+            return
+
+        line, column = position
+        old_location = self.builder.debug_metadata
+        self.builder.debug_metadata = self.module.add_debug_info(
+            'DILocation', {'line': line, 'column': column,
+                           'scope': self.debug_subprogram})
+        yield
+        self.builder.debug_metadata = old_location
+
+    @property
+    def is_reachable(self):
+        """True if code emitted at the builder's current position may be
+        executed.
+
+        """
+        return not self.builder.block.is_terminated
+
     @contextlib.contextmanager
     def setting_break_block(self, block):
         old_block, self.break_block = self.break_block, block
         yield
         self.break_block = old_block
 
+    @contextlib.contextmanager
+    def setting_loop_hints(self, hints):
+        old_hints, self.loop_hints = self.loop_hints, hints
+        yield
+        self.loop_hints = old_hints
+
     @contextlib.contextmanager
     def setting_switch_context(self, val, block):
         old_val, self.switch_val = self.switch_val, val
@@ -204,6 +350,16 @@ def mangle_symbol_name(name):
 # word-oriented which requires that the alignment of the target be suitable.
 # This also necessitates the use of constructor functions and wrappers to
 # shuffle between "addresses" and pointers used by LLVM.
+#
+# Alternatively, the code generator may be asked to emit byte-addressed code.
+# In that case addresses are simply pointers punned to words and converting
+# between the two is free. The word scaling is instead performed at the "+" and
+# "-" operators which directly feed a dereference, i.e. "a[b]" and "*(a+b)".
+# The operand which is not known to be an address, or the right-hand operand if
+# neither is, is multiplied by the number of bytes per word. Address arithmetic
+# which does not feed a dereference is in bytes. This changes the meaning of
+# some B programs and so byte-addressed code must be linked with a byte
+# addressed standard library.
 
 def address_to_llvm_ptr(context, address_val, ptr_type):
     """Cast a llvm Value representing a word into a pointer. Performs the
@@ -223,9 +379,12 @@ def address_to_llvm_ptr(context, address_val, ptr_type):
     if hasattr(address_val, 'b_ptr'):
         return context.builder.bitcast(address_val.b_ptr, ptr_type)
 
-    bpw_const = ir.Constant(context.word_type, context.bytes_per_word)
-    byte_address = context.builder.mul(address_val, bpw_const,
-                                       flags=['nuw', 'nsw'])
+    if context.byte_addressed:
+        byte_address = address_val
+    else:
+        bpw_const = ir.Constant(context.word_type, context.bytes_per_word)
+        byte_address = context.builder.mul(address_val, bpw_const,
+                                           flags=['nuw', 'nsw'])
     ptr_val = context.builder.inttoptr(byte_address, ptr_type)
 
     # HACK: we tag the value with a 'b_address' attribute so that
@@ -251,10 +410,11 @@ def llvm_ptr_to_address(context, ptr_val):
     if hasattr(ptr_val, 'b_address'):
         return ptr_val.b_address
 
-    bpw_const = ir.Constant(context.word_type, context.bytes_per_word)
-    byte_address = context.builder.ptrtoint(ptr_val, context.word_type)
-    address_val = context.builder.udiv(byte_address, bpw_const,
-                                       flags=['exact'])
+    address_val = context.builder.ptrtoint(ptr_val, context.word_type)
+    if not context.byte_addressed:
+        bpw_const = ir.Constant(context.word_type, context.bytes_per_word)
+        address_val = context.builder.udiv(address_val, bpw_const,
+                                           flags=['exact'])
 
     # HACK: we tag the value with a 'b_ptr' attribute so that
     # address_to_llvm_ptr() can elide pointer to address followed by address
@@ -263,22 +423,308 @@ def llvm_ptr_to_address(context, ptr_val):
 
     return address_val
 
+# Pointer provenance
+# ==================
+#
+# Most address arithmetic in B is of the form "a[b]" where "a" is an auto
+# vector, external vector or string constant. In these cases the address "a" was
+# created from a llvm pointer via llvm_ptr_to_address() and so we statically
+# know which object the address points into. Offsetting such an address is
+# emitted as a getelementptr from the original pointer rather than as integer
+# arithmetic. The address to pointer conversion when the result is dereferenced
+# is then elided and LLVM's alias analysis and loop optimisers see real pointer
+# arithmetic rather than an opaque inttoptr.
+
+def address_provenance(address_val):
+    """Return the llvm pointer which a word-oriented address was derived from
+    or None if the address has no statically known provenance.
+
+    """
+    ptr_val = getattr(address_val, 'b_ptr', None)
+
+    # Function addresses are only useful for calling and so we don't consider
+    # them to be a base for address arithmetic.
+    if ptr_val is None or isinstance(ptr_val.type.pointee, ir.FunctionType):
+        return None
+
+    return ptr_val
+
+def offset_address(context, address_val, offset_val):
+    """Return an address which is offset_val addressable units (words or bytes
+    depending on the addressing mode) after address_val. If address_val has a
+    known provenance, the offset is emitted as a getelementptr and the returned
+    address retains that provenance. Requires builder to be not None.
+
+    """
+    base_ptr = address_provenance(address_val)
+    if base_ptr is None:
+        return context.builder.add(address_val, offset_val)
+
+    if context.byte_addressed:
+        unit_ptr_type = ir.IntType(8).as_pointer()
+    else:
+        unit_ptr_type = context.word_type.as_pointer()
+    if base_ptr.type != unit_ptr_type:
+        base_ptr = context.builder.bitcast(base_ptr, unit_ptr_type)
+    offset_ptr = context.builder.gep(
+        base_ptr, [offset_val], inbounds=context.aggressive_semantics)
+
+    return llvm_ptr_to_address(context, offset_ptr)
+
+# Aggressive semantics
+# ====================
+#
+# By default the code generator assumes very little about the program. Signed
+# arithmetic wraps on overflow, division traps only when it is executed and an
+# address derived from one object may be used to access any other object. This
+# is faithful to B but prevents LLVM from widening induction variables or
+# proving that loads and stores in loops are independent.
+#
+# With aggressive semantics the program promises to behave more like a C
+# program. Signed overflow of "+", "-", "*" and "<<" is undefined and the
+# arithmetic is emitted with the "nsw" flag. Address arithmetic on an address
+# with known provenance is emitted as an "inbounds" getelementptr and so must
+# stay within the auto vector, external or string it started in. Accesses via
+# such addresses are tagged with scoped alias metadata which records that
+# accesses to distinct objects never alias. Finally, division by zero yields
+# the dividend rather than trapping and so division may be evaluated
+# speculatively. (Dividing the most negative word by -1 is signed overflow and
+# is undefined.)
+
+def underlying_object(ptr_val):
+    """Return the llvm alloca or global variable which the llvm pointer ptr_val
+    was derived from via getelementptr and bitcast instructions. Returns None
+    if that object cannot be determined statically.
+
+    """
+    while True:
+        if isinstance(ptr_val, ir.GEPInstr):
+            ptr_val = ptr_val.pointer
+        elif isinstance(ptr_val, ir.CastInstr) and ptr_val.opname == 'bitcast':
+            ptr_val = ptr_val.operands[0]
+        else:
+            break
+
+    if isinstance(ptr_val, (ir.AllocaInstr, ir.GlobalVariable)):
+        return ptr_val
+    return None
+
+def record_memory_access(context, instr, ptr_val):
+    """Record that the llvm load or store instruction instr accesses memory via
+    the llvm pointer ptr_val. With aggressive semantics, accesses to distinct
+    objects are tagged as not aliasing once all code has been emitted.
+
+    """
+    if not context.aggressive_semantics:
+        return
+
+    obj = underlying_object(ptr_val)
+    if obj is not None:
+        context.memory_accesses.append((instr, obj))
+
+def _add_alias_scopes(context):
+    """Post-emit hook which adds scoped alias metadata to the recorded memory
+    accesses. Each function has its own alias domain in which each object
+    accessed by the function has a scope.
+
+    """
+    accesses_by_function = collections.OrderedDict()
+    for instr, obj in context.memory_accesses:
+        function = instr.parent.parent
+        accesses_by_function.setdefault(function, []).append((instr, obj))
+
+    module = context.module
+    for function, accesses in accesses_by_function.items():
+        objects = []
+        for _, obj in accesses:
+            if obj not in objects:
+                objects.append(obj)
+
+        # Alias information is only useful if there are at least two objects.
+        if len(objects) < 2:
+            continue
+
+        domain = module.add_metadata([ir.MetaDataString(module, function.name)])
+        scopes = []
+        for idx in range(len(objects)):
+            name = ir.MetaDataString(
+                module, '{}.{}'.format(function.name, idx))
+            scopes.append(module.add_metadata([name, domain]))
+
+        for instr, obj in accesses:
+            idx = objects.index(obj)
+            instr.set_metadata(
+                'alias.scope', module.add_metadata([scopes[idx]]))
+            instr.set_metadata('noalias', module.add_metadata(
+                scopes[:idx] + scopes[idx+1:]))
+
+    context.memory_accesses = []
+
+# Loop metadata
+# =============
+#
+# Hints to the LLVM loop unroller and vectoriser are attached as "llvm.loop"
+# metadata to the branch at the end of the loop body which jumps back to its
+# start. The metadata is a node whose first operand is the node itself followed
+# by one node per hint. The self-reference makes each loop's node unique.
+#
+# llvm.ir caches metadata nodes by their operands and so cannot create a
+# self-referential node directly. Instead the node is created with a
+# placeholder first operand which is unique to the module and the placeholder
+# is then replaced by the node itself.
+
+def add_loop_metadata(context, branch, hints):
+    """Attach llvm.loop metadata to branch, the llvm branch instruction at the
+    end of a loop body. The hints are an ordered mapping from hint names, such
+    as "llvm.loop.unroll.count", to an llvm Value or None if the hint has no
+    value.
+
+    """
+    if len(hints) == 0:
+        return
+
+    module = context.module
+    hint_nodes = []
+    for name, value in hints.items():
+        operands = [ir.MetaDataString(module, name)]
+        if value is not None:
+            operands.append(value)
+        hint_nodes.append(module.add_metadata(operands))
+
+    # The number of metadata nodes in the module only grows and so the
+    # placeholder is never used for another node.
+    placeholder = ir.MetaDataString(
+        module, 'rbc.loop.{}'.format(len(module.metadata)))
+    node = module.add_metadata([placeholder] + hint_nodes)
+    node.operands = (node,) + node.operands[1:]
+
+    branch.set_metadata('llvm.loop', node)
+
+# Debug information
+# =================
+#
+# If requested, DWARF debug information is emitted as LLVM metadata so that
+# debuggers and profilers can map machine code back to lines of B source. The
+# module has a single compile unit and each B function has a subprogram.
+# Statements and expressions whose position in the source is known set the
+# location of the instructions emitted for them. Since B has no DWARF language
+# code of its own, the compile unit claims to be C.
+
+def _add_compile_unit(context):
+    """Add the debug information file and compile unit to the module."""
+    module = context.module
+    context.debug_file = module.add_debug_info('DIFile', {
+        'filename': os.path.basename(context.filename),
+        'directory': os.path.dirname(os.path.abspath(context.filename)),
+    })
+    context.debug_compile_unit = module.add_debug_info('DICompileUnit', {
+        'language': ir.DIToken('DW_LANG_C'),
+        'file': context.debug_file,
+        'producer': 'rbc',
+        'runtimeVersion': 0,
+        'isOptimized': True,
+        'emissionKind': ir.DIToken('FullDebug'),
+    }, is_distinct=True)
+    module.add_named_metadata('llvm.dbg.cu', context.debug_compile_unit)
+    context.debug_word_type = module.add_debug_info('DIBasicType', {
+        'name': 'word',
+        'size': context.word_type.width,
+        'encoding': ir.DIToken('DW_ATE_signed'),
+    })
+
+    # Without a debug info version, LLVM discards the debug information.
+    i32 = ir.IntType(32)
+    module.add_named_metadata('llvm.module.flags', [
+        ir.Constant(i32, 2), 'Debug Info Version', ir.Constant(i32, 3)])
+    module.add_named_metadata('llvm.module.flags', [
+        ir.Constant(i32, 2), 'Dwarf Version', ir.Constant(i32, 4)])
+
+def create_debug_subprogram(context, func, name, line):
+    """Create and return the debug information subprogram for the llvm Function
+    func which is the B function name defined at line in the source.
+
+    """
+    module = context.module
+    word_types = [context.debug_word_type] * (1 + len(func.args))
+    func_type = module.add_debug_info('DISubroutineType', {
+        'types': module.add_metadata(word_types),
+    })
+    subprogram = module.add_debug_info('DISubprogram', {
+        'name': name,
+        'linkageName': func.name,
+        'scope': context.debug_file,
+        'file': context.debug_file,
+        'line': line,
+        'type': func_type,
+        'isLocal': func.linkage == 'private',
+        'isDefinition': True,
+        'scopeLine': line,
+        'isOptimized': True,
+        'unit': context.debug_compile_unit,
+    }, is_distinct=True)
+    func.set_metadata('dbg', subprogram)
+    return subprogram
+
+# Module partitions
+# =================
+#
+# Code generation for a large module may be split between several processes.
+# The program is emitted once per partition. Each partition contains the bodies
+# of some of the functions and merely declares the others. The first partition
+# defines the external variables and their constructors while the others
+# declare them. Since B functions and external variables have external linkage,
+# the native objects for the partitions may then be linked together. String
+# constants are private and so each partition has its own copy.
+
+def is_emitted_function(context, name):
+    """Return True if the body of the B function name should be emitted."""
+    return context.emitted_functions is None or \
+        name in context.emitted_functions
+
 # Convenience functions
 # =====================
 #
 # Code generation can be quite repetitive. Define some functions which express
 # common functionality.
 
-def if_else(context, cond):
+def emit_condition(context, cond):
+    """Emit a single AST node representing an expression which should be
+    treated as a condition. Returns an i1 llvm Value.
+
+    """
+    return cond.emit_bool(context)
+
+def if_then(context, cond):
+    """Convenience wrapper around llvm.ir.Builder.if_then. Takes a single AST
+    node representing an expression which should be treated as a condition and
+    evaluates that node.
+
+    """
+    return context.builder.if_then(emit_condition(context, cond))
+
+@contextlib.contextmanager
+def if_else(context, cond, merge=True):
     """Convenience wrapper around llvm.ir.Builder.if_else. Takes a single AST
     node representing an expression which should be treated as a condition and
     evaluates that node.
 
+    If merge is False, no block is created for the two arms to merge into. The
+    caller is responsible for terminating the blocks which end each arm and
+    for positioning the builder after the context manager exits.
+
     """
-    cond_val = cond.emit(context)
-    zero = ir.Constant(context.word_type, 0)
-    bool_val = context.builder.icmp_signed('!=', cond_val, zero)
-    return context.builder.if_else(bool_val)
+    bool_val = emit_condition(context, cond)
+    if merge:
+        with context.builder.if_else(bool_val) as arms:
+            yield arms
+        return
+
+    builder = context.builder
+    then_block = builder.append_basic_block('then')
+    otherwise_block = builder.append_basic_block('otherwise')
+    builder.cbranch(bool_val, then_block, otherwise_block)
+    yield (builder.goto_block(then_block),
+           builder.goto_block(otherwise_block))
 
 def create_constructor(context, priority=0, name_hint=None):
     """Create a function which is called on module load. Functions are called in
@@ -304,6 +750,36 @@ def create_constructor(context, priority=0, name_hint=None):
 
     return func
 
+@contextlib.contextmanager
+def initializer_body(context, name):
+    """A context manager which sets values in the context ready for emitting
+    code which initialises the external variable name when the module is
+    loaded. Unless the context's shared_constructor attribute is True, each
+    initialiser gets a constructor function of its own.
+
+    """
+    if not context.shared_constructor:
+        func = create_constructor(context, priority=0, name_hint=name)
+        with context.new_function_body(func.append_basic_block(name='entry')):
+            yield
+            context.builder.ret_void()
+        return
+
+    # Initialisers are appended to the shared constructor in the order they
+    # are emitted. The constructor returns once all code has been emitted.
+    if context.shared_constructor_block is None:
+        func = create_constructor(context, priority=0, name_hint='externals')
+        context.shared_constructor_block = func.append_basic_block(
+            name='entry')
+        context.post_emit_hooks.append(_finish_shared_constructor)
+    with context.new_function_body(context.shared_constructor_block):
+        yield
+        context.shared_constructor_block = context.builder.block
+
+def _finish_shared_constructor(context):
+    """Post-emit hook which terminates the shared constructor."""
+    ir.IRBuilder(context.shared_constructor_block).ret_void()
+
 def create_aligned_global(module, type_, name):
     """Construct and return an ir.GlobalVariable instance which is guaranteed to
     have a word-aligned pointer. The symbol name is automatically mangled to
@@ -6,7 +6,9 @@ import rbc.exception as exc
 
 from .astnode import ast_node, needs_builder, ASTNode
 from .context import (
-    address_to_llvm_ptr, llvm_ptr_to_address, create_aligned_global, if_else
+    address_to_llvm_ptr, llvm_ptr_to_address, address_provenance,
+    offset_address, record_memory_access, create_aligned_global,
+    emit_condition, if_else
 )
 
 def get_or_create_string_constant(context, string_bytes):
@@ -60,8 +62,41 @@ def get_or_create_string_constant(context, string_bytes):
 # the "&" or "reference" operator. This address is itself an rvalue. An rvalue
 # may not be referenced. Both lvalues and rvalues may be "dereferenced" via the
 # "*" operator to yield an lvalue.
+#
+# Some values may be evaluated speculatively, i.e. even if their value is not
+# needed. Such values have no side effects and cannot trap. This lets the code
+# generator replace branches by selects.
+#
+# Values used as conditions are emitted in a "boolean context" which yields an
+# llvm i1 value rather than a word. Values which are known to always be 0 or 1,
+# such as the result of relational operators, may produce the i1 directly
+# rather than converting to a word and comparing with zero.
 
 class RValue(ASTNode):
+    def is_boolean(self):
+        """Return True if this value is always either 0 or 1. The default
+        implementation returns False.
+
+        """
+        return False
+
+    def emit_bool(self, context):
+        """Emit this value in a boolean context returning an llvm i1 Value which
+        is true if and only if the value is non-zero. The default implementation
+        compares the emitted value with zero.
+
+        """
+        zero = ir.Constant(context.word_type, 0)
+        return context.builder.icmp_signed('!=', self.emit(context), zero)
+
+    def can_speculate(self, context):
+        """Return True if evaluating this value in the passed context has no
+        side effects and cannot trap. The default implementation
+        conservatively returns False.
+
+        """
+        return False
+
     def dereference(self):
         """Return an LValue corresponding to the dereferencing of this value.
         The default implementation returns a DereferencedRValue instance.
@@ -82,6 +117,10 @@ class DereferencedRValue(RValue):
     that it has a reference() method.
 
     """
+    def __init__(self, **kwargs):
+        RValue.__init__(self, **kwargs)
+        _mark_index(self.rvalue)
+
     def reference(self):
         return self.rvalue
 
@@ -93,7 +132,9 @@ class DereferencedRValue(RValue):
         word_ptr = address_to_llvm_ptr(context, rvalue_val, ptr_type)
 
         # Load from pointer
-        return context.builder.load(word_ptr)
+        load_val = context.builder.load(word_ptr)
+        record_memory_access(context, load_val, word_ptr)
+        return load_val
 
 @ast_node
 class ScopeValue(RValue):
@@ -102,6 +143,10 @@ class ScopeValue(RValue):
     def reference(self):
         return AddressOfScopeValue(name=self.name)
 
+    def can_speculate(self, context):
+        # Loading from a variable in scope is always safe.
+        return True
+
     def emit(self, context):
         try:
             val = context.scope[self.name]
@@ -116,6 +161,9 @@ class ScopeValue(RValue):
 @ast_node
 class AddressOfScopeValue(RValue):
     """RValue corresponding to an address retrieved from the current scope."""
+    def can_speculate(self, context):
+        return True
+
     def emit(self, context):
         try:
             val = context.scope[self.name]
@@ -131,8 +179,22 @@ class ReferencedLValue(RValue):
 
 @ast_node
 class ConditionalOpValue(RValue):
+    def can_speculate(self, context):
+        return self.cond.can_speculate(context) and \
+            self.then.can_speculate(context) and \
+            self.otherwise.can_speculate(context)
+
     @needs_builder
     def emit(self, context):
+        # If both arms may be evaluated speculatively, select between them
+        # rather than branching.
+        if self.then.can_speculate(context) and \
+                self.otherwise.can_speculate(context):
+            cond_val = emit_condition(context, self.cond)
+            then = self.then.emit(context)
+            otherwise = self.otherwise.emit(context)
+            return context.builder.select(cond_val, then, otherwise)
+
         with if_else(context, self.cond) as (then, otherwise):
             with then:
                 then = self.then.emit(context)
@@ -162,14 +224,52 @@ _SIMPLE_OPS = {
 # and can be used directly in LLVM IR(!)
 _REL_OPS = frozenset(['<', '<=', '>', '>=', '==', '!='])
 
+# Signed arithmetic which may overflow. With aggressive semantics, overflow is
+# undefined.
+_OVERFLOWING_OPS = frozenset(['*', '+', '-', '<<'])
+
 # Helper functions for binary operators
+def _arithmetic_flags(context, op):
+    """Return the llvm instruction flags for the binary op in the passed
+    context.
+
+    """
+    if op in _OVERFLOWING_OPS and context.aggressive_semantics:
+        return ['nsw']
+    return []
+
 def _emit_binary_op(context, lhs, op, rhs):
     # No short-cutting in B(!)
     lhs_val, rhs_val = lhs.emit(context), rhs.emit(context)
+    return _apply_binary_op(context, lhs_val, op, rhs_val)
+
+def _apply_binary_op(context, lhs_val, op, rhs_val):
+    """Apply a binary op to two llvm Values which have already been emitted."""
+    # Addition or subtraction of an offset to an address with known provenance
+    # is emitted as pointer arithmetic.
+    lhs_base = address_provenance(lhs_val)
+    rhs_base = address_provenance(rhs_val)
+    if op == '+' and lhs_base is not None and rhs_base is None:
+        return offset_address(context, lhs_val, rhs_val)
+    if op == '+' and rhs_base is not None and lhs_base is None:
+        return offset_address(context, rhs_val, lhs_val)
+    if op == '-' and lhs_base is not None and rhs_base is None:
+        return offset_address(
+            context, lhs_val, context.builder.neg(rhs_val))
+
+    # With aggressive semantics, division by zero yields the dividend. A zero
+    # divisor is replaced by one.
+    if op in ('/', '%') and context.aggressive_semantics:
+        is_zero = context.builder.icmp_signed(
+            '==', rhs_val, ir.Constant(context.word_type, 0))
+        rhs_val = context.builder.or_(
+            rhs_val, context.builder.zext(is_zero, context.word_type))
 
     if op in _SIMPLE_OPS:
         instr_name = _SIMPLE_OPS[op]
-        return getattr(context.builder, instr_name)(lhs_val, rhs_val)
+        flags = _arithmetic_flags(context, op)
+        return getattr(context.builder, instr_name)(
+            lhs_val, rhs_val, flags=flags)
 
     if op in _REL_OPS:
         cmp_val = context.builder.icmp_signed(op, lhs_val, rhs_val)
@@ -179,38 +279,160 @@ def _emit_binary_op(context, lhs, op, rhs):
 
 @ast_node
 class BinaryOpValue(RValue):
+    # Set to True by _mark_index() if this is the address calculation for a
+    # dereference such as in "a[b]" or "*(a+b)".
+    is_index = False
+
+    def can_speculate(self, context):
+        if not self.lhs.can_speculate(context) or \
+                not self.rhs.can_speculate(context):
+            return False
+
+        # Division traps if the divisor is zero or on overflow when dividing by
+        # -1. Only speculate division by other constants unless division is
+        # non-trapping.
+        if self.op in ('/', '%') and not context.aggressive_semantics:
+            return isinstance(self.rhs, ConstantIntValue) and \
+                self.rhs.value not in (0, -1)
+
+        return True
+
+    def is_boolean(self):
+        if self.op in _REL_OPS:
+            return True
+
+        # Bitwise and/or of boolean values is equivalent to logical and/or.
+        return self.op in ('&', '|') and self.lhs.is_boolean() and \
+            self.rhs.is_boolean()
+
+    @needs_builder
+    def emit_bool(self, context):
+        if self.op in _REL_OPS:
+            lhs_val, rhs_val = self.lhs.emit(context), self.rhs.emit(context)
+            return context.builder.icmp_signed(self.op, lhs_val, rhs_val)
+
+        if self.is_boolean():
+            lhs_bool = self.lhs.emit_bool(context)
+            rhs_bool = self.rhs.emit_bool(context)
+            instr_name = _SIMPLE_OPS[self.op]
+            return getattr(context.builder, instr_name)(lhs_bool, rhs_bool)
+
+        return RValue.emit_bool(self, context)
+
     @needs_builder
     def emit(self, context):
+        if self.is_index and context.byte_addressed:
+            return _emit_byte_index(context, self.lhs, self.op, self.rhs)
+        if self.op in ('&', '|') and self.is_boolean():
+            return context.builder.zext(
+                self.emit_bool(context), context.word_type)
         return _emit_binary_op(context, self.lhs, self.op, self.rhs)
 
+def _mark_index(rvalue):
+    """Address arithmetic which directly feeds a dereference is scaled to words
+    in byte-addressed code. Let the arithmetic know if rvalue is such a
+    calculation.
+
+    """
+    if isinstance(rvalue, BinaryOpValue) and rvalue.op in ('+', '-'):
+        rvalue.is_index = True
+
+def _emit_byte_index(context, lhs, op, rhs):
+    """Emit the address calculation feeding a dereference in byte-addressed
+    code. The index operand is scaled by the number of bytes per word. The index
+    is the operand which is not statically known to be an address or, if that
+    can't be determined, the right-hand operand.
+
+    """
+    lhs_val, rhs_val = lhs.emit(context), rhs.emit(context)
+    bpw_const = ir.Constant(context.word_type, context.bytes_per_word)
+    if op == '+' and address_provenance(lhs_val) is None and \
+            address_provenance(rhs_val) is not None:
+        lhs_val = context.builder.mul(lhs_val, bpw_const)
+    else:
+        rhs_val = context.builder.mul(rhs_val, bpw_const)
+    return _apply_binary_op(context, lhs_val, op, rhs_val)
+
+def _emit_lvalue_ptr(context, lvalue):
+    """Emit the address of an lvalue and return it as an llvm pointer to a
+    word. Read-modify-write operations should call this once and use the
+    returned pointer for both the load and the store so that the address
+    expression, and any side effects within it, are evaluated only once.
+
+    """
+    addr_val = lvalue.reference().emit(context)
+    return address_to_llvm_ptr(
+        context, addr_val, context.word_type.as_pointer())
+
+def _emit_increment(context, lvalue, op):
+    """Emit a pre- or post-{inc,dec}rement of an lvalue. Returns a tuple giving
+    the llvm Values of the lvalue before and after modification.
+
+    """
+    ptr = _emit_lvalue_ptr(context, lvalue)
+    old_val = context.builder.load(ptr)
+    record_memory_access(context, old_val, ptr)
+    one = ir.Constant(context.word_type, 1)
+    if op == '++':
+        new_val = _apply_binary_op(context, old_val, '+', one)
+    else:
+        new_val = _apply_binary_op(context, old_val, '-', one)
+    store = context.builder.store(new_val, ptr)
+    record_memory_access(context, store, ptr)
+    return old_val, new_val
+
 @ast_node
 class AssignmentOpValue(RValue):
+    @needs_builder
     def emit(self, context):
         # In an assignment, the lhs is an lvalue and so has an address. Get the
         # address by referencing it and store the rhs to that address. Return
         # the rhs value.
-        lhs_addr = self.lhs.reference().emit(context)
-        ptr_type = context.word_type.as_pointer()
-        lhs_ptr = address_to_llvm_ptr(context, lhs_addr, ptr_type)
+        lhs_ptr = _emit_lvalue_ptr(context, self.lhs)
 
-        # If the op is anything other than '=', apply the given binary op
-        # explicitly and rely on LLVM to perform any optimisation.
+        # If the op is anything other than '=', load the lhs through the
+        # pointer we already have, apply the given binary op explicitly and
+        # rely on LLVM to perform any optimisation.
         if self.op != '=':
-            rhs_val = _emit_binary_op(context, self.lhs, self.op[1:], self.rhs)
-            context.builder.store(rhs_val, lhs_ptr)
+            lhs_val = context.builder.load(lhs_ptr)
+            record_memory_access(context, lhs_val, lhs_ptr)
+            rhs_val = _apply_binary_op(
+                context, lhs_val, self.op[1:], self.rhs.emit(context))
         else:
             rhs_val = self.rhs.emit(context)
-            context.builder.store(rhs_val, lhs_ptr)
+        store = context.builder.store(rhs_val, lhs_ptr)
+        record_memory_access(context, store, lhs_ptr)
         return rhs_val
 
 @ast_node
 class LeftUnaryOpValue(RValue):
+    def __init__(self, **kwargs):
+        RValue.__init__(self, **kwargs)
+        if self.op == '*':
+            _mark_index(self.rhs)
+
     def reference(self):
         """The unary op '*' yields an LValue in that &*x is identically x."""
         if self.op != '*':
             return RValue.reference(self)
         return self.rhs
 
+    def can_speculate(self, context):
+        if self.op == '&':
+            return self.rhs.reference().can_speculate(context)
+        elif self.op in ['-', '~', '!']:
+            return self.rhs.can_speculate(context)
+        return False
+
+    def is_boolean(self):
+        return self.op == '!'
+
+    @needs_builder
+    def emit_bool(self, context):
+        if self.op == '!':
+            return context.builder.not_(self.rhs.emit_bool(context))
+        return RValue.emit_bool(self, context)
+
     @needs_builder
     def emit(self, context):
         if self.op == '&':
@@ -225,23 +447,12 @@ class LeftUnaryOpValue(RValue):
             return context.builder.not_(rhs)
         elif self.op == '!':
             # Logical not
-            rhs = self.rhs.emit(context)
-            zero = ir.Constant(context.word_type, 0)
-            is_zero = context.builder.icmp_unsigned('==', rhs, zero)
-            return context.builder.zext(is_zero, context.word_type)
+            return context.builder.zext(
+                self.emit_bool(context), context.word_type)
         elif self.op in ['++', '--']:
             # pre-{inc,dec}rement
-            rhs = self.rhs.emit(context)
-            rhs_addr_val = self.rhs.reference().emit(context)
-            rhs_ptr = address_to_llvm_ptr(
-                context, rhs_addr_val, context.word_type.as_pointer())
-            one = ir.Constant(context.word_type, 1)
-            if self.op == '++':
-                val = context.builder.add(rhs, one)
-            else:
-                val = context.builder.sub(rhs, one)
-            context.builder.store(val, rhs_ptr)
-            return val
+            _, new_val = _emit_increment(context, self.rhs, self.op)
+            return new_val
 
         raise exc.InternalCompilerError('Unknown unary op: {}'.format(self.op))
 
@@ -251,25 +462,44 @@ class RightUnaryOpValue(RValue):
     def emit(self, context):
         if self.op in ['++', '--']:
             # post-{inc,dec}rement
-            lhs = self.lhs.emit(context)
-            lhs_addr_val = self.lhs.reference().emit(context)
-            lhs_ptr = address_to_llvm_ptr(
-                context, lhs_addr_val, context.word_type.as_pointer())
-            one = ir.Constant(context.word_type, 1)
-            if self.op == '++':
-                val = context.builder.add(lhs, one)
-            else:
-                val = context.builder.sub(lhs, one)
-            context.builder.store(val, lhs_ptr)
-            return lhs
+            old_val, _ = _emit_increment(context, self.lhs, self.op)
+            return old_val
 
         raise exc.InternalCompilerError('Unknown unary op: {}'.format(self.op))
 
+def _defined_function(context, value):
+    """Return the llvm Function for a B function defined in this program if the
+    AST node value statically refers to one via the current scope. Otherwise
+    return None.
+
+    """
+    if not isinstance(value, ScopeValue):
+        return None
+
+    lvalue = context.scope.get(value.name)
+    if not isinstance(lvalue, DereferencedRValue) or \
+            not isinstance(lvalue.rvalue, LLVMPointerValue):
+        return None
+
+    func = lvalue.rvalue.value
+    return func if isinstance(func, ir.Function) else None
+
 @ast_node
 class FunctionCallValue(RValue):
     @needs_builder
     def emit(self, context):
-        # Emit function and args expressions to llvm Values
+        # Builtins which look like function calls are handled by the builtin.
+        if isinstance(self.func, BuiltinValue):
+            return self.func.emit_call(context, self.args)
+
+        # Calls to a function defined in this program with the correct number
+        # of arguments can be direct calls. This lets LLVM inline them.
+        func = _defined_function(context, self.func)
+        if func is not None and len(func.args) == len(self.args):
+            arg_vals = [arg.emit(context) for arg in self.args]
+            return context.builder.call(func, arg_vals)
+
+        # Otherwise, emit function and args expressions to llvm Values
         func_addr_val = self.func.reference().emit(context)
         arg_vals = [arg.emit(context) for arg in self.args]
 
@@ -284,13 +514,66 @@ class FunctionCallValue(RValue):
 
 @ast_node
 class BuiltinValue(RValue):
+    """A value provided by the compiler. Some builtins are called like functions
+    and give hints to the optimiser about the innermost enclosing while loop:
+
+        __unroll(n)      Unroll the loop n times. If n is 0 or 1, don't unroll
+                         the loop.
+        __vectorize(n)   Vectorise the loop with vector width n. If n is 0,
+                         don't vectorise the loop. If n is 1, let LLVM choose
+                         the width.
+
+    The argument must be a constant. The value of the call is zero.
+
+    """
+    def can_speculate(self, context):
+        return True
+
     def emit(self, context):
         if self.name == '__bytes_per_word':
             return ir.Constant(context.word_type, context.bytes_per_word)
+        elif self.name in _LOOP_HINT_BUILTINS:
+            raise exc.SemanticError(
+                'Builtin must be called: {}'.format(self.name))
 
         raise exc.InternalCompilerError(
             'Unknown builtin value: {}'.format(self.name))
 
+    def emit_call(self, context, args):
+        """Emit a call to this builtin with the passed argument AST nodes."""
+        if self.name not in _LOOP_HINT_BUILTINS:
+            raise exc.SemanticError(
+                'Builtin cannot be called: {}'.format(self.name))
+
+        if len(args) != 1 or not isinstance(args[0], ConstantIntValue):
+            raise exc.SemanticError(
+                'Builtin takes one constant argument: {}'.format(self.name))
+        if context.loop_hints is None:
+            raise exc.SemanticError(
+                'Builtin used outside of a loop: {}'.format(self.name))
+
+        _LOOP_HINT_BUILTINS[self.name](context.loop_hints, args[0].value)
+        return ir.Constant(context.word_type, 0)
+
+def _set_unroll_hints(hints, count):
+    if count > 1:
+        hints['llvm.loop.unroll.count'] = ir.Constant(ir.IntType(32), count)
+    else:
+        hints['llvm.loop.unroll.disable'] = None
+
+def _set_vectorize_hints(hints, width):
+    hints['llvm.loop.vectorize.enable'] = ir.Constant(
+        ir.IntType(1), int(width != 0))
+    if width > 1:
+        hints['llvm.loop.vectorize.width'] = ir.Constant(ir.IntType(32), width)
+
+# Mapping from names of loop hint builtins to a function which takes the loop
+# hints mapping and the builtin's argument and sets the appropriate hints.
+_LOOP_HINT_BUILTINS = {
+    '__unroll': _set_unroll_hints,
+    '__vectorize': _set_vectorize_hints,
+}
+
 # Constants
 # =========
 #
@@ -301,11 +584,23 @@ class BuiltinValue(RValue):
 @ast_node
 class ConstantIntValue(RValue):
     """An constant integer value."""
+    def can_speculate(self, context):
+        return True
+
+    def is_boolean(self):
+        return self.value in (0, 1)
+
+    def emit_bool(self, context):
+        return ir.Constant(ir.IntType(1), int(self.value != 0))
+
     def emit(self, context):
         return ir.Constant(context.word_type, self.value)
 
 @ast_node
 class StringConstantValue(RValue):
+    def can_speculate(self, context):
+        return True
+
     @needs_builder
     def emit(self, context):
         # Get a pointer to the string
@@ -339,6 +634,9 @@ class LLVMPointerValue(RValue):
     not intended for construction by the semantics.
 
     """
+    def can_speculate(self, context):
+        return True
+
     @needs_builder
     def emit(self, context):
         return llvm_ptr_to_address(context, self.value)
@@ -1,12 +1,13 @@
 from __future__ import print_function
+import contextlib
 
 from llvmlite import ir
 
 from .astnode import ast_node, ASTNode
 
 from .context import (
-    address_to_llvm_ptr, create_constructor, create_aligned_global,
-    mangle_symbol_name
+    address_to_llvm_ptr, create_aligned_global, create_debug_subprogram,
+    initializer_body, is_emitted_function, mangle_symbol_name
 )
 
 from .expression import ConstantIntValue, LLVMPointerValue
@@ -36,6 +37,14 @@ class SimpleDefinition(ASTNode):
             context.module, context.word_type, self.name)
         value.modifiers = ['align {}'.format(context.bytes_per_word)]
 
+        # Register this variable as an external symbol.
+        self._lvalue = LLVMPointerValue(value=value).dereference()
+        context.externals[self.name] = self._lvalue
+
+        # The variable may be defined in another module partition.
+        if not context.define_externals:
+            return
+
         # Set variable's initialiser. Don't bother with a constructor function
         # if the initialiser is a constant integer
         if self.init is not None and isinstance(self.init, ConstantIntValue):
@@ -44,32 +53,34 @@ class SimpleDefinition(ASTNode):
             init_val = 0
         value.initializer = ir.Constant(context.word_type, init_val)
 
-        # Register this variable as an external symbol.
-        self._lvalue = LLVMPointerValue(value=value).dereference()
-        context.externals[self.name] = self._lvalue
+        # A variable which is never written to and needs no constructor can be
+        # a constant.
+        if self.name in context.constant_externals and not self._needs_ctor():
+            value.global_constant = True
+
+    def _needs_ctor(self):
+        """Constructors are required for initialisers which aren't constant
+        integers."""
+        return self.init is not None and \
+            not isinstance(self.init, ConstantIntValue)
 
     def emit(self, context):
         assert self._lvalue is not None
 
-        # If we have no initialiser, we do not need to emit a constructor
-        if self.init is None or isinstance(self.init, ConstantIntValue):
+        # If we have no initialiser or the variable is defined in another
+        # module partition, we do not need to emit a constructor
+        if not self._needs_ctor() or not context.define_externals:
             return
 
         # Initialisers may themselves be global variables. In which case we need
         # to make sure we initialise them in the correct order.
-        func = create_constructor(context, priority=0, name_hint=self.name)
-
-        # Create entry block for function and associated builder
-        block = func.append_basic_block(name='entry')
-
         # Assign the variable's value
-        with context.new_function_body(block):
+        with initializer_body(context, self.name):
             init = self.init.emit(context)
             lvalue_address = self._lvalue.reference().emit(context)
             value_ptr = address_to_llvm_ptr(
                 context, lvalue_address, context.word_type.as_pointer())
             context.builder.store(init, value_ptr)
-            context.builder.ret_void()
 
 @ast_node
 class VectorDefinition(ASTNode):
@@ -77,7 +88,8 @@ class VectorDefinition(ASTNode):
         ASTNode.__init__(self, **kwargs)
         self._lvalue = None
 
-    def declare(self, context):
+    def element_count(self):
+        """Return the number of words in the vector."""
         # SCJ: "The actual size of the vector is the maximum of constant+1 and
         # the number of initial values. Any vector elements which are not
         # explicitly initialized have undefined values."
@@ -85,34 +97,88 @@ class VectorDefinition(ASTNode):
             maxidx = self.maxidx.value
         else:
             maxidx = 0
-        n_elems = max(len(self.ivals), maxidx + 1)
+        return max(len(self.ivals), maxidx + 1)
+
+    def constant_element_count(self):
+        """Return the number of leading words in the vector which are given
+        constant initial values by its llvm initialiser. Vectors whose initial
+        values are not all constant integers are initialised by a constructor
+        and so this is zero for them.
+
+        """
+        if self._needs_ctor():
+            return 0
+        return len(self.ivals)
 
-        # Initialise the value with zeros
-        value_type = ir.ArrayType(context.word_type, n_elems)
+    def declare(self, context):
+        n_elems = self.element_count()
+
+        # Initialise the value directly if all the initial values are constant
+        # integers. Otherwise initialise with zeros and leave initialisation to
+        # a constructor.
+        value_type = self._value_type(context)
         value = create_aligned_global(context.module, value_type, self.name)
         value.modifiers = ['align {}'.format(context.bytes_per_word)]
-        value.initializer = ir.Constant(value_type, None)
 
         # Register this variable as an external symbol. Note that the pointer
         # value itself is registered unlike SimpleDefinition.
         self._lvalue = LLVMPointerValue(value=value)
         context.externals[self.name] = self._lvalue
 
+        # The vector may be defined in another module partition.
+        if not context.define_externals:
+            return
+
+        if len(self.ivals) == 0 or self._needs_ctor():
+            value.initializer = ir.Constant(value_type, None)
+        else:
+            init_vals = [ival.value for ival in self.ivals]
+            if n_elems == len(init_vals):
+                value.initializer = ir.Constant(value_type, init_vals)
+            else:
+                head_type, tail_type = value_type.elements
+                value.initializer = ir.Constant(value_type, [
+                    ir.Constant(head_type, init_vals),
+                    ir.Constant(tail_type, None)])
+
+        # A vector which is never written to can be a constant.
+        if self.name in context.constant_externals and not self._needs_ctor():
+            value.global_constant = True
+
+    def _value_type(self, context):
+        """Return the llvm type of the vector. A vector with some but not all
+        elements given constant initial values is a packed structure of the
+        initialised elements followed by the remaining elements so that the
+        remaining elements can have a zero initialiser rather than one
+        constant for each element.
+
+        """
+        n_elems = self.element_count()
+        n_init = self.constant_element_count()
+        if n_init == 0 or n_init == n_elems:
+            return ir.ArrayType(context.word_type, n_elems)
+        return ir.LiteralStructType([
+            ir.ArrayType(context.word_type, n_init),
+            ir.ArrayType(context.word_type, n_elems - n_init),
+        ], packed=True)
+
+    def _needs_ctor(self):
+        """Constructors are required if any initial value is not a constant
+        integer."""
+        return any(not isinstance(ival, ConstantIntValue)
+                   for ival in self.ivals)
+
     def emit(self, context):
         assert self._lvalue is not None
-        if len(self.ivals) == 0:
-            # No initialisation required
+        if not self._needs_ctor() or not context.define_externals:
+            # No initialisation required beyond the static initialiser or the
+            # vector is defined in another module partition
             return
 
         # Initialisers may themselves be global variables. In which case we need
         # to make sure we initialise them in the correct order.
-        func = create_constructor(context, priority=0, name_hint=self.name)
-
-        # Create entry block for function and associated builder
-        block = func.append_basic_block(name='entry')
-
         # Assign the variable's values
-        with context.new_function_body(block):
+        with initializer_body(context, self.name):
             lvalue = self._lvalue.emit(context)
             value_ptr = address_to_llvm_ptr(
                 context, lvalue, context.word_type.as_pointer())
@@ -121,7 +187,6 @@ class VectorDefinition(ASTNode):
                 idx_val = ir.Constant(context.word_type, idx)
                 dest_ptr = context.builder.gep(value_ptr, [idx_val])
                 context.builder.store(llvm_val, dest_ptr)
-            context.builder.ret_void()
 
 @ast_node
 class FunctionDefinition(ASTNode):
@@ -145,11 +210,32 @@ class FunctionDefinition(ASTNode):
             value=self._func).dereference()
 
     def emit(self, context):
+        # The function may be defined in another module partition.
+        if not is_emitted_function(context, self.name):
+            return
+
+        # A memoised function is a wrapper around a private function containing
+        # the body.
+        if self.name in context.memoized_functions:
+            body_func = ir.Function(
+                context.module, self._func.type.pointee,
+                name=context.module.get_unique_name(
+                    '__memo.{}'.format(self.name)))
+            body_func.linkage = 'private'
+            self._emit_body(context, body_func)
+            _emit_memoizing_wrapper(context, self._func, body_func)
+        else:
+            self._emit_body(context, self._func)
+
+    def _emit_body(self, context, func):
+        context.profiled_functions.append(func)
+
         # Create entry block for function and associated builder
-        block = self._func.append_basic_block(name='entry')
-        with context.new_function_body(block):
+        block = func.append_basic_block(name='entry')
+        with context.new_function_body(block), self._debug_subprogram(
+                context, func):
             # Add function arguments to the function scope
-            for arg_name, arg_value in zip(self.arg_names, self._func.args):
+            for arg_name, arg_value in zip(self.arg_names, func.args):
                 arg_value.name = arg_name
 
                 # Allocate stack variable for this argument and copy argument
@@ -167,3 +253,92 @@ class FunctionDefinition(ASTNode):
             # All functions implicitly return 0 if there's no other return
             if not context.builder.block.is_terminated:
                 context.builder.ret(ir.Constant(context.word_type, 0))
+
+    @contextlib.contextmanager
+    def _debug_subprogram(self, context, func):
+        """A context manager which sets the debug information subprogram while
+        emitting the body of the function if debug information is emitted.
+
+        """
+        if not context.debug_info:
+            yield
+            return
+
+        line = self.position[0] if self.position is not None else 0
+        subprogram = create_debug_subprogram(context, func, self.name, line)
+        with context.in_debug_subprogram(subprogram, line):
+            yield
+
+# Memoisation
+# ===========
+#
+# Functions named in the context's memoized_functions set are assumed to be
+# pure: their return value depends only on their arguments and calling them has
+# no side effects. The function body is emitted into a private function and the
+# public function becomes a wrapper which looks the arguments up in a
+# fixed-size cache. The cache is a module global with one entry per hash value
+# of the arguments. Each entry records whether it is valid, the arguments and
+# the result. On a miss, the body is called and the result overwrites whatever
+# was in the entry. Recursive calls go via the wrapper and so are memoised too.
+
+# Number of entries in a memoised function's cache. Must be a power of two.
+MEMO_CACHE_ENTRIES = 1024
+
+def _emit_memoizing_wrapper(context, func, body_func):
+    """Emit the body of func as a memoising wrapper around body_func."""
+    word_type = context.word_type
+    word_bits = word_type.width
+    n_args = len(func.args)
+
+    # Create the cache. Entries are [valid, arg1, ..., argN, result].
+    entry_type = ir.ArrayType(word_type, n_args + 2)
+    cache_type = ir.ArrayType(entry_type, MEMO_CACHE_ENTRIES)
+    cache = ir.GlobalVariable(
+        context.module, cache_type,
+        context.module.get_unique_name('{}.cache'.format(body_func.name)))
+    cache.linkage = 'internal'
+    cache.initializer = ir.Constant(cache_type, None)
+
+    builder = ir.IRBuilder(func.append_basic_block(name='entry'))
+    def field_ptr(entry_ptr, idx):
+        return builder.gep(entry_ptr, [
+            ir.Constant(ir.IntType(32), 0), ir.Constant(ir.IntType(32), idx)])
+
+    # Hash the arguments via Fibonacci hashing. The top bits of the hash index
+    # the cache.
+    multiplier = ir.Constant(
+        word_type, 0x9E3779B97F4A7C15 >> (64 - word_bits))
+    hash_val = ir.Constant(word_type, 0)
+    for arg in func.args:
+        hash_val = builder.mul(builder.xor(hash_val, arg), multiplier)
+    index_bits = MEMO_CACHE_ENTRIES.bit_length() - 1
+    index_val = builder.lshr(
+        hash_val, ir.Constant(word_type, word_bits - index_bits))
+    entry_ptr = builder.gep(
+        cache, [ir.Constant(ir.IntType(32), 0), index_val])
+
+    # The entry is a hit if it is valid and its arguments match.
+    zero = ir.Constant(word_type, 0)
+    is_hit = builder.icmp_signed(
+        '!=', builder.load(field_ptr(entry_ptr, 0)), zero)
+    for arg_idx, arg in enumerate(func.args):
+        cached_arg = builder.load(field_ptr(entry_ptr, arg_idx + 1))
+        is_hit = builder.and_(
+            is_hit, builder.icmp_signed('==', cached_arg, arg))
+
+    hit_block = func.append_basic_block(name='hit')
+    miss_block = func.append_basic_block(name='miss')
+    builder.cbranch(is_hit, hit_block, miss_block)
+
+    # On a hit, return the cached result.
+    builder.position_at_end(hit_block)
+    builder.ret(builder.load(field_ptr(entry_ptr, n_args + 1)))
+
+    # On a miss, call the body and record the result.
+    builder.position_at_end(miss_block)
+    result = builder.call(body_func, func.args)
+    for arg_idx, arg in enumerate(func.args):
+        builder.store(arg, field_ptr(entry_ptr, arg_idx + 1))
+    builder.store(result, field_ptr(entry_ptr, n_args + 1))
+    builder.store(ir.Constant(word_type, 1), field_ptr(entry_ptr, 0))
+    builder.ret(result)
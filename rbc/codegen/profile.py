@@ -0,0 +1,211 @@
+"""
+Profile-guided optimisation.
+
+"""
+from llvmlite import ir
+
+from .context import create_constructor
+
+# Profiles
+# ========
+#
+# Profile-guided optimisation is a two-phase process. Firstly, the program is
+# compiled with instrumentation which counts how many times each B function is
+# entered and, for each conditional branch, how many times it is executed and
+# how many times it is taken. Each function has an array of counters:
+#
+#   [entry, branch 0 taken, branch 0 executed, branch 1 taken, ...]
+#
+# Conditional branches are numbered in the order they appear in the emitted
+# function and so the numbering is the same whenever the same source is
+# compiled with the same options. A constructor registers the counter arrays
+# with the standard library which appends them to a profile file when the
+# program exits. Each line of the profile file is a function's symbol name
+# followed by its counters separated by spaces. Running the program several
+# times appends several lines for each function which are summed when read.
+#
+# Secondly, the program is recompiled with the profile. Functions are given
+# entry counts and conditional branches are given weights. A profile summary
+# is also added to the module so that LLVM can tell hot code from cold code.
+# The counts for functions whose number of branches has changed since the
+# profile was recorded are ignored.
+
+# Name of the C function in the standard library which registers counters.
+_REGISTER_FUNCTION_NAME = 'rbc_profile_register'
+
+def read_profile(fobj):
+    """Read a profile from a file object. Returns a dict mapping function
+    symbol names to tuples of counters.
+
+    """
+    profile = {}
+    for line in fobj:
+        fields = line.split()
+        if len(fields) == 0:
+            continue
+        name, counters = fields[0], tuple(int(f) for f in fields[1:])
+
+        # Sum the counters from multiple runs.
+        previous = profile.get(name)
+        if previous is not None and len(previous) == len(counters):
+            counters = tuple(a + b for a, b in zip(previous, counters))
+        profile[name] = counters
+    return profile
+
+def _conditional_branches(func):
+    """Return a list of the conditional branches in an llvm Function."""
+    return [
+        instr for block in func.blocks for instr in block.instructions
+        if instr.opname == 'br' and len(instr.operands) == 3
+    ]
+
+def instrument_functions(context):
+    """Post-emit hook which adds counters to the profiled functions in the
+    context and a constructor which registers them.
+
+    """
+    module = context.module
+    counter_type = ir.IntType(64)
+    one = ir.Constant(counter_type, 1)
+
+    records = []
+    for func in context.profiled_functions:
+        branches = _conditional_branches(func)
+        counters_type = ir.ArrayType(counter_type, 1 + 2 * len(branches))
+        counters = ir.GlobalVariable(
+            module, counters_type,
+            module.get_unique_name('__prof.{}'.format(func.name)))
+        counters.linkage = 'internal'
+        counters.initializer = ir.Constant(counters_type, None)
+
+        builder = ir.IRBuilder(func.blocks[0])
+        builder.position_at_start(func.blocks[0])
+        _increment_counter(builder, counters, 0, one)
+        for branch_idx, branch in enumerate(branches):
+            builder.position_before(branch)
+            taken = builder.zext(branch.operands[0], counter_type)
+            _increment_counter(builder, counters, 1 + 2 * branch_idx, taken)
+            _increment_counter(builder, counters, 2 + 2 * branch_idx, one)
+
+        records.append((func.name, counters))
+
+    if len(records) == 0:
+        return
+
+    # Declare the registration function from the standard library.
+    char_ptr_type = ir.IntType(8).as_pointer()
+    register_type = ir.FunctionType(ir.VoidType(), [
+        char_ptr_type, counter_type.as_pointer(), counter_type])
+    register_func = ir.Function(
+        module, register_type, _REGISTER_FUNCTION_NAME)
+
+    ctor = create_constructor(context, name_hint='profile')
+    builder = ir.IRBuilder(ctor.append_basic_block(name='entry'))
+    for name, counters in records:
+        name_ptr = builder.bitcast(
+            _create_c_string(module, name), char_ptr_type)
+        counters_ptr = builder.bitcast(counters, counter_type.as_pointer())
+        n_counters = ir.Constant(counter_type, counters.type.pointee.count)
+        builder.call(register_func, [name_ptr, counters_ptr, n_counters])
+    builder.ret_void()
+
+def _increment_counter(builder, counters, idx, amount):
+    """Emit code to add amount to counters[idx]."""
+    zero = ir.Constant(ir.IntType(32), 0)
+    counter_ptr = builder.gep(
+        counters, [zero, ir.Constant(ir.IntType(32), idx)])
+    builder.store(builder.add(builder.load(counter_ptr), amount), counter_ptr)
+
+def _create_c_string(module, string):
+    """Create a private NUL-terminated string constant and return it."""
+    contents = bytearray(string.encode('utf8'))
+    contents.append(0)
+    str_type = ir.ArrayType(ir.IntType(8), len(contents))
+    str_ptr = ir.GlobalVariable(
+        module, str_type, module.get_unique_name('__prof.name'))
+    str_ptr.global_constant = True
+    str_ptr.linkage = 'private'
+    str_ptr.initializer = ir.Constant(str_type, contents)
+    return str_ptr
+
+# Applying profiles
+# =================
+
+# Largest weight which can be given to a branch.
+_MAX_BRANCH_WEIGHT = 0xffffffff
+
+# Cutoffs, in parts per million of the total count, for the detailed profile
+# summary. These are the cutoffs used by LLVM's own profiling tools.
+_SUMMARY_CUTOFFS = (
+    10000, 100000, 200000, 300000, 400000, 500000, 600000, 700000, 800000,
+    900000, 950000, 990000, 999000, 999900, 999990, 999999,
+)
+
+def apply_profile(context):
+    """Post-emit hook which annotates the profiled functions in the context
+    with the counts in the context's profile.
+
+    """
+    module = context.module
+    for func in context.profiled_functions:
+        counters = context.profile.get(func.name)
+        branches = _conditional_branches(func)
+        if counters is None or len(counters) != 1 + 2 * len(branches):
+            continue
+
+        func.set_metadata('prof', module.add_metadata([
+            'function_entry_count', ir.Constant(ir.IntType(64), counters[0])]))
+        for branch_idx, branch in enumerate(branches):
+            taken = counters[1 + 2 * branch_idx]
+            executed = counters[2 + 2 * branch_idx]
+            if executed > 0:
+                branch.set_weights(_branch_weights(taken, executed - taken))
+
+    _add_profile_summary(context)
+
+def _branch_weights(taken, not_taken):
+    """Scale a pair of counts so that they fit in a branch weight."""
+    scale = max(taken, not_taken) // _MAX_BRANCH_WEIGHT + 1
+    return [taken // scale, not_taken // scale]
+
+def _add_profile_summary(context):
+    """Add a profile summary describing the entire profile to the module."""
+    module = context.module
+    i32, i64 = ir.IntType(32), ir.IntType(64)
+
+    entry_counts, internal_counts = [], []
+    for counters in context.profile.values():
+        entry_counts.append(counters[0])
+        for taken, executed in zip(counters[1::2], counters[2::2]):
+            internal_counts.extend([taken, executed - taken])
+
+    counts = sorted(entry_counts + internal_counts, reverse=True)
+    total = sum(counts)
+    if total == 0:
+        return
+
+    detailed = []
+    cumulative, count_idx = 0, 0
+    for cutoff in _SUMMARY_CUTOFFS:
+        while count_idx < len(counts) and \
+                cumulative * 1000000 < cutoff * total:
+            cumulative += counts[count_idx]
+            count_idx += 1
+        detailed.append(module.add_metadata([
+            ir.Constant(i32, cutoff), ir.Constant(i64, counts[count_idx - 1]),
+            ir.Constant(i32, count_idx)]))
+
+    fields = [
+        ['ProfileFormat', 'InstrProf'],
+        ['TotalCount', ir.Constant(i64, total)],
+        ['MaxCount', ir.Constant(i64, counts[0])],
+        ['MaxInternalCount', ir.Constant(i64, max(internal_counts or [0]))],
+        ['MaxFunctionCount', ir.Constant(i64, max(entry_counts))],
+        ['NumCounts', ir.Constant(i64, len(counts))],
+        ['NumFunctions', ir.Constant(i64, len(entry_counts))],
+        ['DetailedSummary', module.add_metadata(detailed)],
+    ]
+    summary = module.add_metadata(
+        [module.add_metadata(field) for field in fields])
+    module.add_named_metadata('llvm.module.flags', [
+        ir.Constant(i32, 1), 'ProfileSummary', summary])
@@ -1,12 +1,18 @@
 from __future__ import print_function
 
+from future.moves import collections
 from llvmlite import ir
 
 import rbc.exception as exc
 
 from .astnode import ast_node, needs_builder, ASTNode
-from .context import create_aligned_global, if_else
-from .expression import LLVMPointerValue
+from .context import (
+    add_loop_metadata, create_aligned_global, emit_condition, if_then, if_else
+)
+from .expression import (
+    AssignmentOpValue, BinaryOpValue, ConditionalOpValue, DereferencedRValue,
+    LLVMPointerValue, ScopeValue
+)
 
 def get_or_create_global(context, name):
     """Retrieve the LValue and llvm GlobalValue associated with an external
@@ -22,22 +28,42 @@ def get_or_create_global(context, name):
     # Create a new variable in the module and add it to the externals.
     value = create_aligned_global(context.module, context.word_type, name)
     value.modifiers = ['align {}'.format(context.bytes_per_word)]
+    if name in context.constant_externals:
+        value.global_constant = True
 
     lvalue = LLVMPointerValue(value=value).dereference()
     context.externals[name] = lvalue
     return lvalue
 
+def get_or_create_label_block(context, label):
+    """Return the basic block associated with a label in the current function.
+    The block is created if this is the first time the label has been seen.
+
+    """
+    block = context.labels.get(label)
+    if block is None:
+        block = context.builder.append_basic_block(label)
+        context.labels[label] = block
+    return block
+
 # Statements
 # ==========
 #
 # Statements, unlike rvalues or lvalues, do not return llvm Values when emitted.
 
+# Auto variables are allocated in the entry block of the function irrespective
+# of where they are declared. This means that they are allocated once even if
+# declared within a loop and that LLVM may promote them to registers. It also
+# means that declarations may be emitted when the current position is
+# unreachable.
+
 @ast_node
 class AutoStatement(ASTNode):
     """An auto variable is automatically allocated onto the stack."""
     @needs_builder
     def emit(self, context):
-        val = context.builder.alloca(context.word_type, name=self.name)
+        with context.builder.goto_entry_block():
+            val = context.builder.alloca(context.word_type, name=self.name)
         context.scope[self.name] = LLVMPointerValue(value=val).dereference()
 
 @ast_node
@@ -51,8 +77,9 @@ class AutoVectorStatement(ASTNode):
         vector_length = 1 + self.maxidx.value
 
         # Allocate values and record in scope
-        val = context.builder.alloca(context.word_type, size=vector_length,
-                                     name=self.name)
+        with context.builder.goto_entry_block():
+            val = context.builder.alloca(
+                context.word_type, size=vector_length, name=self.name)
 
         # In contrast to non-vector auto variables, the "value" of a vecotr auto
         # is the actual underlying pointer rather than the dereferenced pointer.
@@ -69,8 +96,52 @@ class MultipartStatement(ASTNode):
     scope."""
     def emit(self, context):
         for statement in self.statements:
+            if not context.is_reachable:
+                if _may_be_entered(statement):
+                    # Labels and cases are happy to be emitted when unreachable
+                    # but other statements which contain them need a (dead)
+                    # block to emit code into.
+                    if not isinstance(statement,
+                                      (LabelStatement, CaseStatement)):
+                        dead_block = context.builder.append_basic_block(
+                            'unreachable')
+                        context.builder.position_at_end(dead_block)
+                elif not _declares_names(statement):
+                    # Skip unreachable statements. Declarations must still be
+                    # emitted but don't emit code into the current block.
+                    continue
             statement.emit(context)
 
+def _substatements(statement):
+    """Return a list of the statements directly contained within a statement."""
+    substatements = list(getattr(statement, 'statements', []))
+    for attr_name in ('then', 'otherwise', 'body', 'statement'):
+        substatement = getattr(statement, attr_name, None)
+        if substatement is not None:
+            substatements.append(substatement)
+    return substatements
+
+def _may_be_entered(statement):
+    """Return True if a statement contains a label or case through which control
+    may enter it.
+
+    """
+    if isinstance(statement, (LabelStatement, CaseStatement)):
+        return True
+    return any(_may_be_entered(substatement)
+               for substatement in _substatements(statement))
+
+def _declares_names(statement):
+    """Return True if a statement declares names in the current scope."""
+    if isinstance(statement, (AutoStatement, AutoVectorStatement,
+                              ExtrnStatement)):
+        return True
+    if isinstance(statement, MultipartStatement) and \
+            not isinstance(statement, CompoundStatement):
+        return any(_declares_names(substatement)
+                   for substatement in statement.statements)
+    return False
+
 @ast_node
 class CompoundStatement(MultipartStatement):
     """A group of statements emitted within a brand new scope. This isn't in any
@@ -92,60 +163,158 @@ class ReturnStatement(ASTNode):
         else:
             ret_val = self.return_value.emit(context)
 
-        # Emit the return instruction
+        # Emit the return instruction. Any following code is unreachable.
         context.builder.ret(ret_val)
 
-        # A return instruction is a terminator and so we should create a new
-        # block which any post-return instructions are appended to.
-        new_block = context.builder.append_basic_block('post_return')
-        context.builder.position_at_end(new_block)
-
 @ast_node
 class WhileStatement(ASTNode):
+    """A while loop is emitted in "rotated" form. The condition is tested once
+    before entering the loop and again at the end of the loop body which then
+    branches back to the start of the body. Loop hints given by builtins within
+    the loop are attached to that final branch.
+
+    """
     @needs_builder
     def emit(self, context):
         # Create basic blocks for builder
-        while_cond = context.builder.append_basic_block('while')
         while_body = context.builder.append_basic_block('whilethen')
         while_end = context.builder.append_basic_block('whileend')
 
-        # Initially, branch into while loop condition test
-        context.builder.branch(while_cond)
-
-        # Position at start of condition block and emit condition and
-        # test
-        context.builder.position_at_end(while_cond)
-        cond = self.cond.emit(context)
-        zero = ir.Constant(context.word_type, 0)
-        cond_is_not_zero = context.builder.icmp_signed('!=', cond, zero)
-
-        # Conditionally branch to body or end of while
+        # Guard entry to the loop by the condition
+        cond_is_not_zero = emit_condition(context, self.cond)
         context.builder.cbranch(cond_is_not_zero, while_body, while_end)
 
         # Position in body and emit
         context.builder.position_at_end(while_body)
+        hints = collections.OrderedDict()
         with context.setting_break_block(while_end):
-            self.body.emit(context)
+            with context.setting_loop_hints(hints):
+                self.body.emit(context)
 
-        # Branch back to condition
-        context.builder.branch(while_cond)
+        # Re-test the condition and branch back to the body
+        if context.is_reachable:
+            cond_is_not_zero = emit_condition(context, self.cond)
+            branch = context.builder.cbranch(
+                cond_is_not_zero, while_body, while_end)
+            add_loop_metadata(context, branch, hints)
 
         # Position after loop for further instructions
         context.builder.position_at_end(while_end)
 
+def _is_local_variable(context, name):
+    """Return True if name refers to an auto variable or function argument in
+    the current scope. Such variables are stored on the stack and so no one
+    else may observe a store to them.
+
+    """
+    lvalue = context.scope.get(name)
+    if not isinstance(lvalue, DereferencedRValue):
+        return False
+    pointer = lvalue.rvalue
+    return isinstance(pointer, LLVMPointerValue) and \
+        isinstance(pointer.value, ir.AllocaInstr)
+
+def _speculatable_assignment(context, statement):
+    """If statement is an expression statement which assigns a value which may
+    be evaluated speculatively in the passed context to a local variable,
+    return a tuple giving the variable and the value which is assigned to it.
+    Otherwise return None. External variables are excluded since storing to
+    them when the original code would not could be observed by C code or
+    signal handlers.
+
+    """
+    # Look through compound statements wrapping a single statement.
+    while isinstance(statement, CompoundStatement) and \
+            len(statement.statements) == 1:
+        statement = statement.statements[0]
+
+    if not isinstance(statement, ExpressionStatement):
+        return None
+
+    expression = statement.expression
+    if not isinstance(expression, AssignmentOpValue) or \
+            not isinstance(expression.lhs, ScopeValue) or \
+            not _is_local_variable(context, expression.lhs.name):
+        return None
+
+    if expression.op == '=':
+        value = expression.rhs
+    else:
+        value = BinaryOpValue(lhs=expression.lhs, op=expression.op[1:],
+                              rhs=expression.rhs)
+
+    if not value.can_speculate(context):
+        return None
+
+    return expression.lhs, value
+
+def _select_assignment(context, if_statement):
+    """If an if statement conditionally assigns a value to a single variable and
+    the values assigned may be evaluated speculatively, return an equivalent
+    assignment of a conditional expression to that variable. Otherwise return
+    None.
+
+    """
+    then = _speculatable_assignment(context, if_statement.then)
+    if then is None:
+        return None
+    variable, then_value = then
+
+    if if_statement.otherwise is None:
+        # An if without an else leaves the variable unchanged.
+        otherwise_value = variable
+    else:
+        otherwise = _speculatable_assignment(context, if_statement.otherwise)
+        if otherwise is None or otherwise[0].name != variable.name:
+            return None
+        otherwise_value = otherwise[1]
+
+    return AssignmentOpValue(
+        lhs=variable, op='=', rhs=ConditionalOpValue(
+            cond=if_statement.cond, then=then_value, otherwise=otherwise_value))
+
 @ast_node
 class IfStatement(ASTNode):
     @needs_builder
     def emit(self, context):
-        with if_else(context, self.cond) as (then, otherwise):
+        # Simple conditional assignments can be emitted without branching.
+        assignment = _select_assignment(context, self)
+        if assignment is not None:
+            assignment.emit(context)
+            return
+
+        if self.otherwise is None:
+            with if_then(context, self.cond):
+                self.then.emit(context)
+            return
+
+        # Emit both arms recording the blocks which fall through to the end of
+        # the if statement.
+        fallthrough_blocks = []
+        with if_else(context, self.cond, merge=False) as (then, otherwise):
             with then:
                 self.then.emit(context)
+                if context.is_reachable:
+                    fallthrough_blocks.append(context.builder.block)
             with otherwise:
-                if self.otherwise is not None:
-                    self.otherwise.emit(context)
+                self.otherwise.emit(context)
+                if context.is_reachable:
+                    fallthrough_blocks.append(context.builder.block)
+
+        # If neither arm falls through, the code after the if statement is
+        # unreachable and there's no need for a block to hold it.
+        if len(fallthrough_blocks) == 0:
+            return
+
+        end_block = context.builder.append_basic_block('endif')
+        for block in fallthrough_blocks:
+            context.builder.position_at_end(block)
+            context.builder.branch(end_block)
+        context.builder.position_at_end(end_block)
 
 @ast_node
 class ExpressionStatement(ASTNode):
+    @needs_builder
     def emit(self, context):
         """An expression statement simply evaluates its expression and discards
         the result."""
@@ -160,13 +329,17 @@ class NullStatement(ASTNode):
 class LabelStatement(ASTNode):
     @needs_builder
     def emit(self, context):
-        # Create a new basic block and record
-        assert self.label not in context.labels
-        new_block = context.builder.append_basic_block(self.label)
-        context.labels[self.label] = new_block
-
-        # Unconditionally branch to new block
-        context.builder.branch(new_block)
+        # Retrieve the label's basic block, which may have been created by an
+        # earlier goto, and record that the label is defined.
+        if self.label in context.defined_labels:
+            raise exc.SemanticError(
+                'Label defined twice: {}'.format(self.label))
+        new_block = get_or_create_label_block(context, self.label)
+        context.defined_labels.add(self.label)
+
+        # Fall through to new block
+        if context.is_reachable:
+            context.builder.branch(new_block)
 
         # Move context to new block
         context.builder.position_at_end(new_block)
@@ -177,36 +350,17 @@ class LabelStatement(ASTNode):
 @ast_node
 class GotoStatement(ASTNode):
     """The goto statement becomes an unconditional branch. Since labels may be
-    defined after the goto statement is emitted, the goto statement creates a
-    new basic block for the branch to be appended to but does not immediately
-    emit the branch instruction. Instead, a post-emit hook is added to emit the
-    branch instruction once all labels have been defined.
+    defined after the goto statement is emitted, the goto statement creates the
+    label's basic block if necessary. The label statement will then emit code
+    into that block. It is an error for the label to never be defined. This is
+    checked once the entire function body has been emitted.
 
     """
+    @needs_builder
     def emit(self, context):
-        current_block = context.builder.block
-        current_builder = context.builder
-        labels = context.labels
-
-        # We create a post-emit hook so that the goto's label is resolved after
-        # all the rest of the code is emitted.
-        def hook(_):
-            # Move back to the correct block
-            current_builder.position_at_end(current_block)
-
-            # Reset scope and retrieve block
-            try:
-                block = labels[self.label]
-            except KeyError:
-                raise exc.SemanticError('No such label: {}'.format(self.label))
-
-            # Branch to label
-            current_builder.branch(block)
-        context.post_emit_hooks.append(hook)
-
-        # Create a new block for appending future instructions
-        new_block = context.builder.append_basic_block('post_goto')
-        context.builder.position_at_end(new_block)
+        # Branch to label. Any following code is unreachable.
+        block = get_or_create_label_block(context, self.label)
+        context.builder.branch(block)
 
 @ast_node
 class BreakStatement(ASTNode):
@@ -223,13 +377,10 @@ class BreakStatement(ASTNode):
         if context.break_block is None:
             return
 
-        # Jump straight to the end of context
+        # Jump straight to the end of context. Any following code is
+        # unreachable.
         context.builder.branch(context.break_block)
 
-        # Add a new block for any following instructions
-        new_block = context.builder.append_basic_block('post_break')
-        context.builder.position_at_end(new_block)
-
 @ast_node
 class SwitchStatement(ASTNode):
     @needs_builder
@@ -2,22 +2,29 @@
 High-level interface to the B compiler.
 
 """
+import contextlib
+import copy
+import functools
+import multiprocessing
+import multiprocessing.util
 import os
+import shutil
 import subprocess
+import tempfile
 
 import llvmlite.binding as llvm
-import pkg_resources
 import whichcraft
 
+import rbc.cache
 import rbc.codegen as codegen
 
 from rbc.parser import BParser
 from rbc.semantics import BSemantics
 from rbc._backport import TemporaryDirectory
 
-# pylint: disable=assignment-from-no-return
-_LIBB_C_SOURCE_FILE = pkg_resources.resource_filename(__name__, 'libb.c')
-_LIBB_B_SOURCE_FILE = pkg_resources.resource_filename(__name__, 'libb.b')
+# Source files of the B standard library which are installed with rbc.
+_LIBB_C_SOURCE_FILE = os.path.join(os.path.dirname(__file__), 'libb.c')
+_LIBB_B_SOURCE_FILE = os.path.join(os.path.dirname(__file__), 'libb.b')
 
 def _ensure_llvm():
     """Ensure that LLVM has been initialised."""
@@ -48,37 +55,169 @@ class CompilerOptions(object):
         machine: The llvm.TargetMachine which is the target of compilation.
         opt_level: The optimisation level from 0 (no optimisation) to 3 (full
                    optimisation.)
+        byte_addressed: If True, B addresses are byte-oriented rather than
+                        word-oriented. Vector indices and offsets in "*(a+b)"
+                        are scaled by the word size but other address
+                        arithmetic is in bytes. Code compiled with this option
+                        must be linked with a matching standard library.
+        whole_program: If True, compile_and_link() treats the B source files
+                       and the B standard library as the entire B program.
+                       See compile_b_to_whole_program_object().
+        lto: If True, compile_and_link() links the B modules, including the B
+             standard library, together before optimising them. Unlike
+             whole_program, all B symbols remain visible to C code. See
+             compile_b_to_linked_object().
+        aggressive_semantics: If True, signed overflow is undefined, address
+                              arithmetic may not move between objects and
+                              division by zero yields the dividend. This
+                              changes the meaning of some B programs but lets
+                              LLVM optimise loops more aggressively.
+        memoize: A set of names of B functions whose results are cached. The
+                 functions must be pure: their result must depend only on
+                 their arguments and they must have no side effects.
+        debug_info: If True, emit DWARF line and function debug information.
+        profile_generate: If True, instrument B code so that running it
+                          appends a profile to the file named by the
+                          RBC_PROFILE environment variable or "rbc.prof".
+        profile_use: If not None, the name of a profile file recorded by a
+                     program compiled with profile_generate. The profile is
+                     used to guide optimisation.
+        codegen_partitions: If greater than one, compile_b_to_native_object()
+                            splits each module into this many partitions by
+                            function and optimises and generates native code
+                            for them in parallel. Functions in different
+                            partitions cannot be inlined into one another.
+        output_cache: If not None, an rbc.cache.OutputCache holding output
+                      from earlier compilations. See cached_compile().
+        function_cache: If not None, an rbc.cache.OutputCache holding
+                        optimised code for individual functions. See
+                        compile_b_to_module().
+        fast: If True, compile for the lowest latency. Modules are not
+              optimised whatever opt_level is, external variables are
+              initialised by a single constructor per module and machine is
+              replaced by a target machine which uses LLVM's fast instruction
+              selector.
+        verify: If True, modules are checked by the LLVM verifier before they
+                are optimised. Verification only finds bugs in the compiler.
+
+    Compiler options may be pickled so that they can be sent to worker
+    processes. The target machine is then recreated for the target's triple
+    with default settings for the fast option.
 
     """
     def __init__(self):
         _ensure_llvm()
         self.target = llvm.Target.from_default_triple()
-        self.machine = self.target.create_target_machine(codemodel='default')
+        self._fast = False
+        self.machine = self._create_machine()
         self.opt_level = 1
+        self.byte_addressed = False
+        self.whole_program = False
+        self.lto = False
+        self.aggressive_semantics = False
+        self.memoize = frozenset()
+        self.debug_info = False
+        self.profile_generate = False
+        self.profile_use = None
+        self.codegen_partitions = 1
+        self.output_cache = None
+        self.function_cache = None
+        self.verify = True
+
+    @property
+    def fast(self):
+        return self._fast
+
+    @fast.setter
+    def fast(self, value):
+        self._fast = value
+        self.machine = self._create_machine()
+
+    def _create_machine(self):
+        """Create a target machine for the target. Fast compilation uses the
+        lowest code generation optimisation level which selects instructions
+        with LLVM's fast instruction selector.
+
+        """
+        return self.target.create_target_machine(
+            codemodel='default', opt=0 if self._fast else 2)
+
+    def __getstate__(self):
+        state = dict(self.__dict__)
+        state['target'] = self.target.triple
+        del state['machine']
+        return state
+
+    def __setstate__(self, state):
+        _ensure_llvm()
+        self.__dict__.update(state)
+        self.target = llvm.Target.from_triple(state['target'])
+        self.machine = self._create_machine()
 
-def compile_b_source(source, options):
+def compile_b_source(source, options, filename=None):
     """The B front end converts B source code into a LLVM module. No significant
     optimisation is performed.
 
     Args:
         source (str): B source code as a string
         options (CompilerOptions): compiler options
+        filename (str or None): name of the source file used in debug
+                                information
 
     Returns:
         A string with the LLVM assembly code for an unoptimised module
         corresponding to the input source.
 
     """
-    # Set parser semantics and go forth and parse.
-    program = BParser().parse(source, 'program',
-                              semantics=BSemantics(codegen.make_node))
+    return _emit_program(parse_b_source(source), options, filename=filename)
+
+def parse_b_source(source):
+    """Parse B source code into an abstract syntax tree.
+
+    Args:
+        source (str): B source code as a string
+
+    Returns:
+        A Program AST node.
 
+    """
+    # Set parser semantics and go forth and parse. Source positions are
+    # recorded for debug information.
+    semantics = BSemantics(codegen.make_node, record_positions=True)
+    return BParser().parse(source, 'program', semantics=semantics,
+                           parseinfo=True)
+
+def _emit_program(program, options, constant_externals=frozenset(),
+                  filename=None, emitted_functions=None,
+                  define_externals=True):
+    """Emit LLVM module assembly for a Program AST node."""
     # Emit LLVM assembly for the correct target.
-    module_str = program.emit(options.target, options.machine)
+    module_str = program.emit(
+        options.target, options.machine,
+        byte_addressed=options.byte_addressed,
+        constant_externals=constant_externals,
+        aggressive_semantics=options.aggressive_semantics,
+        memoized_functions=frozenset(options.memoize),
+        debug_info=options.debug_info, filename=filename,
+        profile_generate=options.profile_generate,
+        profile=_load_profile(options),
+        emitted_functions=emitted_functions,
+        define_externals=define_externals,
+        shared_constructor=options.fast)
 
     # Return the string representation of the module.
     return module_str
 
+def _load_profile(options):
+    """Return the profile named by the profile_use compiler option or None if
+    there is no such option.
+
+    """
+    if options.profile_use is None:
+        return None
+    with open(options.profile_use) as fobj:
+        return codegen.profile.read_profile(fobj)
+
 def optimize_module(module_assembly, options):
     """Verify and optimise the passed LLVM module assembly.
 
@@ -91,11 +230,36 @@ def optimize_module(module_assembly, options):
 
     """
     _ensure_llvm()
+    return _parse_and_optimize(
+        module_assembly, options,
+        functools.partial(_optimize_module_ref, options=options))
 
-    # Parse LLVM module assembly
-    module = llvm.parse_assembly(module_assembly)
-    module.verify()
+# Inlining thresholds for each optimisation level. These are the thresholds
+# used by clang. Functions are not inlined at lower optimisation levels.
+_INLINING_THRESHOLDS = {2: 225, 3: 275}
+
+def _optimize_module_ref(module, options):
+    """Optimise a llvmlite.binding.ModuleRef in place. Modules are not
+    optimised if the fast compiler option is set.
+
+    """
+    if options.fast:
+        return
+    _create_pass_manager(options).run(module)
+
+def _verify_module(module, options):
+    """Verify a llvmlite.binding.ModuleRef if the verify compiler option is
+    set.
+
+    """
+    if options.verify:
+        module.verify()
 
+def _create_pass_manager(options):
+    """Create a llvm.ModulePassManager which optimises modules according to
+    the passed compiler options.
+
+    """
     # Create optimiser pass manager
     pass_manager = llvm.ModulePassManager()
 
@@ -105,13 +269,261 @@ def optimize_module(module_assembly, options):
     # Populate with optimisation passes
     pass_manager_builder = llvm.PassManagerBuilder()
     pass_manager_builder.opt_level = options.opt_level
+    inlining_threshold = _INLINING_THRESHOLDS.get(options.opt_level)
+    if inlining_threshold is not None:
+        pass_manager_builder.inlining_threshold = inlining_threshold
     pass_manager_builder.populate(pass_manager)
 
-    # Run optimiser
-    pass_manager.run(module)
+    return pass_manager
+
+def compile_b_to_module(source, options, filename=None, optimizer=None):
+    """Compile B source code to an optimised LLVM module. If the
+    function_cache compiler option is set, each function is optimised
+    separately and optimised functions are reused from the cache.
+
+    Args:
+        source (str): B source code as a string
+        options (CompilerOptions): compiler options
+        filename (str or None): name of the source file
+        optimizer (callable or None): function which optimises a
+                                      llvmlite.binding.ModuleRef in place. The
+                                      default creates a new pass manager for
+                                      each module.
+
+    Returns:
+        A llvmlite.binding.ModuleRef for the verified and optimised module.
+
+    """
+    _ensure_llvm()
+    if optimizer is None:
+        optimizer = functools.partial(_optimize_module_ref, options=options)
+
+    if options.function_cache is not None:
+        module = _compile_b_to_module_by_function(
+            source, options, filename, optimizer)
+    else:
+        module = _parse_and_optimize(
+            compile_b_source(source, options, filename=filename), options,
+            optimizer)
+
+    if filename is not None:
+        module.name = os.path.basename(filename)
+    return module
 
+def _parse_and_optimize(module_assembly, options, optimizer):
+    """Parse and verify LLVM module assembly and optimise it with optimizer.
+    Returns a llvmlite.binding.ModuleRef.
+
+    """
+    module = llvm.parse_assembly(module_assembly)
+    _verify_module(module, options)
+    optimizer(module)
     return module
 
+# Function caching
+# ================
+#
+# A small change to a large B file should not require the whole file to be
+# optimised again. If the function_cache compiler option is set, each function
+# is emitted into a module of its own along with declarations of the external
+# names it refers to. See codegen.analysis.definition_signatures(). The module
+# is optimised and its bitcode cached under a key made from the function's AST,
+# the signatures of the names it refers to and the compiler options. External
+# variable definitions and their constructors are emitted into a separate
+# module. The modules are then linked together without further optimisation.
+# Since each function is optimised on its own, functions cannot be inlined
+# into one another.
+
+def _compile_b_to_module_by_function(source, options, filename, optimizer):
+    """Compile B source code to an optimised LLVM module function by function
+    using the function cache. Modules are optimised by optimizer.
+
+    """
+    cache = options.function_cache
+    program = parse_b_source(source)
+    signatures = codegen.analysis.definition_signatures(program)
+
+    # Emit the external variables without any function bodies. Emitting a
+    # program stores state in the AST and so a copy is emitted.
+    module = _parse_and_optimize(_emit_program(
+        copy.deepcopy(program), options, filename=filename,
+        emitted_functions=frozenset()), options, optimizer)
+
+    for definition in program.definitions:
+        if not isinstance(definition, codegen.external.FunctionDefinition):
+            continue
+
+        referenced = codegen.analysis.referenced_names(definition)
+        key = _function_cache_key(
+            definition, referenced, signatures, filename, options)
+        bitcode = cache.fetch_bytes(key)
+        if bitcode is not None:
+            module.link_in(llvm.parse_bitcode(bitcode))
+            continue
+
+        unit = _parse_and_optimize(_emit_function(
+            program, definition, referenced, options, filename), options,
+            optimizer)
+        cache.store_bytes(key, unit.as_bitcode())
+        module.link_in(unit)
+
+    _verify_module(module, options)
+    return module
+
+def _emit_function(program, definition, referenced, options, filename):
+    """Emit LLVM module assembly for a module containing the function
+    definition from program along with declarations of the referenced names.
+
+    """
+    definitions = [copy.deepcopy(definition)]
+    for other in program.definitions:
+        if other is definition or other.name not in referenced:
+            continue
+        if isinstance(other, codegen.external.FunctionDefinition):
+            # Only the name and arguments of other functions are needed.
+            other = codegen.make_node(
+                'FunctionDefinition', name=other.name,
+                arg_names=other.arg_names, body=None)
+        definitions.append(copy.deepcopy(other))
+
+    unit_program = codegen.make_node('Program', definitions=definitions)
+    return _emit_program(
+        unit_program, options, filename=filename,
+        emitted_functions=frozenset([definition.name]),
+        define_externals=False)
+
+def _function_cache_key(definition, referenced, signatures, filename, options):
+    """Return the function cache key for a function definition."""
+    parts = [
+        'function', rbc.cache.compiler_fingerprint(),
+        codegen.analysis.serialize_ast(
+            definition, positions=options.debug_info),
+    ]
+    for name in sorted(referenced):
+        parts.extend([name, signatures.get(name)])
+    parts.extend(_options_cache_key_parts(options))
+
+    # Debug information records where the source is.
+    if options.debug_info and filename is not None:
+        parts.append(os.path.abspath(filename))
+
+    return rbc.cache.hash_key(parts)
+
+# Whole-program compilation
+# =========================
+#
+# When all of the B source making up a program is available, the B modules may
+# be linked together before native code is generated. Nothing outside of the
+# program can refer to B symbols other than "main", which is called by the C
+# portion of the standard library, and so all other B symbols may be given
+# internal linkage. LLVM is then free to discard unused definitions and to
+# change the calling convention of functions whose address is never taken.
+
+# Symbols in a whole B program which must remain visible to C.
+_WHOLE_PROGRAM_ROOTS = frozenset([codegen.context.mangle_symbol_name('main')])
+
+def link_b_modules(b_filenames, options):
+    """Compile several on-disk B files and link the resulting modules
+    together. No significant optimisation is performed.
+
+    If the whole_program compiler option is set, the files are assumed to be
+    the entire B program. External variables which are never written to are
+    then emitted as constants.
+
+    Args:
+        b_filenames (sequence): files containing B source
+        options (CompilerOptions): compiler options to use
+
+    Returns:
+        A llvmlite.binding.ModuleRef for the verified linked module.
+
+    """
+    _ensure_llvm()
+
+    programs = []
+    for b_filename in b_filenames:
+        with open(b_filename) as fobj:
+            programs.append(parse_b_source(fobj.read()))
+
+    if options.whole_program:
+        constant_externals = codegen.analysis.find_constant_externals(programs)
+    else:
+        constant_externals = frozenset()
+
+    module = None
+    for b_filename, program in zip(b_filenames, programs):
+        unit = llvm.parse_assembly(_emit_program(
+            program, options, constant_externals=constant_externals,
+            filename=b_filename))
+        if module is None:
+            module = unit
+        else:
+            module.link_in(unit)
+
+    _verify_module(module, options)
+    return module
+
+def internalize_module(module, roots=_WHOLE_PROGRAM_ROOTS):
+    """Give internal linkage to all externally visible definitions in a
+    llvmlite.binding.ModuleRef except those whose names are in roots. Then
+    switch functions whose address is not taken to the fast calling convention
+    and remove unreachable definitions.
+
+    """
+    for value in list(module.functions) + list(module.global_variables):
+        if value.is_declaration or value.name in roots:
+            continue
+        if value.linkage == llvm.Linkage.external:
+            value.linkage = llvm.Linkage.internal
+
+    # Calls between B modules are made via bitcast pointers. Combine
+    # instructions so that they become direct calls and then let the global
+    # optimiser change the calling convention of internal functions. Finally,
+    # remove anything which is unused.
+    pass_manager = llvm.ModulePassManager()
+    pass_manager.add_instruction_combining_pass()
+    pass_manager.add_global_optimizer_pass()
+    pass_manager.add_global_dce_pass()
+    pass_manager.run(module)
+
+def compile_b_to_whole_program_object(obj_filename, b_filenames, options):
+    """Compile on-disk B files forming an entire B program to a single native
+    object. The B modules are linked together and all B symbols other than
+    main are made internal to the object. The B standard library is not
+    implicitly included.
+
+    Args:
+        obj_filename (str): file to write object code to
+        b_filenames (sequence): files containing B source
+        options (CompilerOptions): compiler options to use
+
+    """
+    module = link_b_modules(b_filenames, options)
+    internalize_module(module)
+    _optimize_module_ref(module, options)
+
+    with open(obj_filename, 'wb') as fobj:
+        fobj.write(options.machine.emit_object(module))
+
+def compile_b_to_linked_object(obj_filename, b_filenames, options):
+    """Compile on-disk B files to a single native object. The B modules are
+    linked together before they are optimised so that functions may be
+    inlined and constants folded across modules. Unlike
+    compile_b_to_whole_program_object(), all B symbols remain visible. The B
+    standard library is not implicitly included.
+
+    Args:
+        obj_filename (str): file to write object code to
+        b_filenames (sequence): files containing B source
+        options (CompilerOptions): compiler options to use
+
+    """
+    module = link_b_modules(b_filenames, options)
+    _optimize_module_ref(module, options)
+
+    with open(obj_filename, 'wb') as fobj:
+        fobj.write(options.machine.emit_object(module))
+
 class CompilationEnvironment(object):
     """
     Detect compiler tools available in the environment.
@@ -127,16 +539,31 @@ class CompilationEnvironment(object):
         cflags: list of C compiler flags
         ldflags: list of linker flags
 
+    GCC is searched for when the gcc attribute is first used.
+
     """
     def __init__(self):
-        self.gcc = whichcraft.which('gcc')
+        self._gcc = None
+        self._gcc_detected = False
         self.cflags = ['-std=gnu99']
         self.cppflags = []
         self.ldflags = []
 
-    def compile_c_source(self, obj_filename, c_filename):
+    @property
+    def gcc(self):
+        if not self._gcc_detected:
+            self._gcc = whichcraft.which('gcc')
+            self._gcc_detected = True
+        return self._gcc
+
+    @gcc.setter
+    def gcc(self, value):
+        self._gcc = value
+        self._gcc_detected = True
+
+    def compile_c_source(self, obj_filename, c_filename, extra_cppflags=()):
         subprocess.check_call(
-            [self.gcc] + self.cppflags + self.cflags +
+            [self.gcc] + self.cppflags + list(extra_cppflags) + self.cflags +
             ['-c', '-o', obj_filename, c_filename])
 
     def link_objects(self, output_filename, obj_filenames):
@@ -144,37 +571,315 @@ class CompilationEnvironment(object):
             [self.gcc] + self.ldflags +
             ['-o', output_filename] + obj_filenames)
 
+    def combine_objects(self, output_filename, obj_filenames):
+        subprocess.check_call(
+            [self.gcc, '-r', '-nostdlib', '-o', output_filename] +
+            obj_filenames)
+
 _DEFAULT_ENVIRONMENT = CompilationEnvironment()
 
-def compile_b_to_native_object(obj_filename, b_filename, options):
+def compile_b_to_native_object(obj_filename, b_filename, options,
+                               env=_DEFAULT_ENVIRONMENT):
     """Convenience function to compile an on-disk B file to a native object.
 
+    If the codegen_partitions compiler option is greater than one, the module
+    is partitioned and the partitions are compiled in parallel. The
+    compilation environment is then used to combine the resulting objects. If
+    the output_cache compiler option is set, the object may be copied from the
+    cache.
+
     Args:
         obj_filename (str): file to write object code to
         b_filename (str): file containing B source
         options (CompilerOptions): compiler options to use
+        env (CompilationEnvironment): specify custom compiler environment
 
     """
+    def _compile(output_filename, source):
+        if options.codegen_partitions > 1:
+            _compile_b_to_partitioned_object(
+                output_filename, b_filename, source, options, env)
+            return
+
+        module = compile_b_to_module(source, options, filename=b_filename)
+        with open(output_filename, 'wb') as fobj:
+            fobj.write(options.machine.emit_object(module))
+
+    cached_compile(obj_filename, b_filename, options, 'obj', _compile)
+
+# Kinds of output which may be written by compile_b_to_outputs().
+OUTPUT_KINDS = ('obj', 'asm', 'llvm-ir', 'llvm-bc')
+
+def compile_b_to_outputs(outputs, b_filename, options):
+    """Compile an on-disk B file once and write several kinds of output from
+    the same optimised module. If the output_cache compiler option is set,
+    outputs may be copied from the cache and the file is only compiled if
+    some output is not cached. The codegen_partitions compiler option is
+    ignored.
+
+    Args:
+        outputs (dict): mapping from output kinds in OUTPUT_KINDS to the files
+                        to write them to
+        b_filename (str): file containing B source
+        options (CompilerOptions): compiler options to use
+
+    Raises:
+        ValueError if an output kind is unknown.
+
+    """
+    for kind in outputs:
+        if kind not in OUTPUT_KINDS:
+            raise ValueError('Unknown output kind: ' + kind)
+
     with open(b_filename) as fobj:
         source = fobj.read()
 
-    module_asm = compile_b_source(source, options)
+    # Cache keys describe an unpartitioned compilation.
+    options = copy.copy(options)
+    options.codegen_partitions = 1
+
+    cache, keys = options.output_cache, {}
+    pending = dict(outputs)
+    if cache is not None:
+        for kind, output_filename in outputs.items():
+            keys[kind] = _output_cache_key(kind, source, b_filename, options)
+            if cache.fetch(keys[kind], output_filename):
+                del pending[kind]
+    if len(pending) == 0:
+        return
+
+    module = compile_b_to_module(source, options, filename=b_filename)
+    for kind, output_filename in pending.items():
+        with open(output_filename, 'wb') as fobj:
+            fobj.write(_module_output(kind, module, options))
+        if cache is not None:
+            cache.store(keys[kind], output_filename)
+
+def _module_output(kind, module, options):
+    """Return the output of a kind in OUTPUT_KINDS for a llvm ModuleRef as
+    bytes.
+
+    """
+    if kind == 'obj':
+        return options.machine.emit_object(module)
+    elif kind == 'asm':
+        return options.machine.emit_assembly(module).encode('utf8')
+    elif kind == 'llvm-ir':
+        return str(module).encode('utf8')
+    return module.as_bitcode()
+
+# Cached compilation
+# ==================
+#
+# The output of compiling a B file is determined by the source, the compiler
+# options, the name of the file and the compiler itself. If the output_cache
+# compiler option is set, output is looked up in the cache by a hash of all of
+# these. The compiler is identified by rbc.cache.compiler_fingerprint().
+
+def cached_compile(output_filename, b_filename, options, kind, compile_func):
+    """Compile an on-disk B file, reusing the output of an earlier compilation
+    if the output_cache compiler option is set.
+
+    If the output is not cached, compile_func is called with output_filename
+    and the B source as a string. It should write the output.
+
+    Args:
+        output_filename (str): file to write output to
+        b_filename (str): file containing B source
+        options (CompilerOptions): compiler options to use
+        kind (str): kind of output written by compile_func such as "obj"
+        compile_func (callable): function which compiles the source
+
+    """
+    with open(b_filename) as fobj:
+        source = fobj.read()
+
+    cache = options.output_cache
+    if cache is None:
+        compile_func(output_filename, source)
+        return
+
+    key = _output_cache_key(kind, source, b_filename, options)
+    if cache.fetch(key, output_filename):
+        return
+    compile_func(output_filename, source)
+    cache.store(key, output_filename)
+
+def _output_cache_key(kind, source, b_filename, options):
+    """Return the output cache key for compiling source."""
+    parts = [
+        kind, rbc.cache.compiler_fingerprint(), source,
+        os.path.basename(b_filename), options.codegen_partitions,
+    ]
+    parts.extend(_options_cache_key_parts(options))
+
+    # Debug information records the directory containing the source.
+    if options.debug_info:
+        parts.append(os.path.abspath(b_filename))
+
+    return rbc.cache.hash_key(parts)
+
+def _options_cache_key_parts(options):
+    """Return a list of the parts of a cache key which describe the compiler
+    options affecting code generation.
+
+    """
+    parts = [
+        options.target.triple, options.machine.target_data,
+        options.opt_level, options.byte_addressed,
+        options.aggressive_semantics, ','.join(sorted(options.memoize)),
+        options.debug_info, options.profile_generate, options.fast,
+    ]
+    if options.profile_use is not None:
+        with open(options.profile_use, 'rb') as fobj:
+            parts.append(fobj.read())
+    return parts
+
+# Partitioned compilation
+# =======================
+#
+# Optimisation and native code generation dominate the time taken to compile a
+# large module. A module may instead be emitted as several partitions, each
+# containing the bodies of some of the functions. See
+# codegen.analysis.partition_functions(). The partitions are optimised and
+# compiled to native objects in a pool of worker processes. LLVM modules cannot
+# be passed between processes and so workers are sent module assembly and
+# return the object code.
+
+def _compile_b_to_partitioned_object(obj_filename, b_filename, source, options,
+                                     env):
+    """Compile B source to a native object via several module partitions."""
+    program = parse_b_source(source)
+    partitions = codegen.analysis.partition_functions(
+        program, options.codegen_partitions)
+
+    # The first partition defines external variables and so is always
+    # compiled. Emitting a program stores state in the AST and so each
+    # partition is emitted from a fresh copy.
+    jobs = []
+    for part_idx, function_names in enumerate(partitions):
+        if part_idx > 0 and len(function_names) == 0:
+            continue
+        module_asm = _emit_program(
+            copy.deepcopy(program), options, filename=b_filename,
+            emitted_functions=function_names,
+            define_externals=(part_idx == 0))
+        module_name = '{}.part{}'.format(os.path.basename(b_filename), part_idx)
+        jobs.append((module_asm, module_name, options))
+
+    objects = map_jobs(_compile_partition, jobs, len(jobs))
+
+    with TemporaryDirectory() as tmp_dir:
+        part_obj_filenames = []
+        for part_idx, object_code in enumerate(objects):
+            part_obj_filename = os.path.join(
+                tmp_dir, 'part{}.o'.format(part_idx))
+            with open(part_obj_filename, 'wb') as fobj:
+                fobj.write(object_code)
+            part_obj_filenames.append(part_obj_filename)
+        env.combine_objects(obj_filename, part_obj_filenames)
+
+def _compile_partition(job):
+    """Worker process function which takes a tuple of module assembly, module
+    name and compiler options and returns native object code for the module.
+
+    """
+    module_asm, module_name, options = job
     module = optimize_module(module_asm, options)
-    module.name = os.path.basename(b_filename)
+    module.name = module_name
+    return options.machine.emit_object(module)
 
-    with open(obj_filename, 'wb') as fobj:
-        fobj.write(options.machine.emit_object(module))
+# Runtime objects
+# ===============
+#
+# Every executable is linked with the standard library which is compiled from
+# libb.c and libb.b. These files never change and so, rather than compiling
+# them for every link, each process keeps the objects compiled for each
+# combination of options which affect them in a private directory. The
+# directory is removed when the process exits.
+
+# Maps from option tuples to the filenames of compiled runtime objects.
+_RUNTIME_OBJECTS = {}
+
+def _runtime_object(key, build):
+    """Return the filename of the runtime object for the hashable key. If the
+    object has not yet been compiled, build is called with the filename to
+    compile it to.
+
+    """
+    obj_filename = _RUNTIME_OBJECTS.get(key)
+    if obj_filename is not None and os.path.exists(obj_filename):
+        return obj_filename
+
+    obj_fd, obj_filename = tempfile.mkstemp(
+        prefix='libb', suffix='.o', dir=_runtime_object_dir())
+    os.close(obj_fd)
+    build(obj_filename)
+    _RUNTIME_OBJECTS[key] = obj_filename
+    return obj_filename
+
+def _runtime_object_dir():
+    """Return the directory holding runtime objects, creating it if
+    necessary.
+
+    """
+    if _runtime_object_dir.path is None:
+        _runtime_object_dir.path = tempfile.mkdtemp(prefix='rbc-runtime-')
+
+        # Worker processes exit without running atexit functions but do run
+        # multiprocessing finalizers, as does the main process when it exits.
+        multiprocessing.util.Finalize(
+            None, shutil.rmtree, args=(_runtime_object_dir.path, True),
+            exitpriority=0)
+    return _runtime_object_dir.path
+
+_runtime_object_dir.path = None
+
+def _runtime_c_object(env, libb_cppflags):
+    """Return the filename of the object compiled from libb.c."""
+    def _build(obj_filename):
+        env.compile_c_source(obj_filename, _LIBB_C_SOURCE_FILE, libb_cppflags)
+
+    key = ('c', env.gcc, tuple(env.cppflags), tuple(libb_cppflags),
+           tuple(env.cflags))
+    return _runtime_object(key, _build)
+
+def _runtime_b_object(options, env):
+    """Return the filename of the object compiled from libb.b."""
+    def _build(obj_filename):
+        compile_b_to_native_object(
+            obj_filename, _LIBB_B_SOURCE_FILE, options, env)
+
+    key = ('b', options.target.triple, options.opt_level,
+           options.byte_addressed, options.aggressive_semantics,
+           frozenset(options.memoize), options.debug_info,
+           options.profile_generate, options.fast)
+    return _runtime_object(key, _build)
 
 def compile_and_link(output, source_files, options=None,
-                     env=_DEFAULT_ENVIRONMENT):
+                     env=_DEFAULT_ENVIRONMENT, jobs=1):
     """Compile and link source files into an output file. Uses GCC for the heavy
     lifting. This will implicitly link in the B standard library.
 
-    Input files may be anything GCC accepts along with B source files.
+    Input files may be anything GCC accepts along with B source files. The
+    objects for the B standard library are compiled once per process for each
+    combination of options and compilation environment.
 
     If no compiler options are used, a new CompilerOptions object is
     constructed.
 
+    If the whole_program compiler option is set, all B source files are compiled
+    into a single object in which only main is externally visible. Any C
+    source files should not refer to other B symbols. If the lto compiler
+    option is set, all B source files are also compiled into a single object
+    but all B symbols remain visible.
+
+    If jobs is greater than one, B and C source files are compiled in a pool of
+    that many worker processes. The compiler options and environment must then
+    be picklable. Modules are not partitioned when compiled by a worker. The
+    objects are linked in the same order as the source files whatever the
+    number of jobs.
+
     Note: the passed compiler options *only* affect the B compiler. Use the
     'cflags', 'ldflags' and 'cppflags' attributes in the compilation
     environment.
@@ -184,25 +889,173 @@ def compile_and_link(output, source_files, options=None,
         source_files (sequence): paths of input files
         options (CompilerOptions): compiler options
         env (CompilationEnvironment): specify custom compiler environment
+        jobs (int): number of source files to compile in parallel
 
     """
     options = options if options is not None else CompilerOptions()
 
+    # The C portion of the standard library needs to know how B addresses
+    # are represented.
+    libb_cppflags = ['-DB_BYTE_ADDRESSED'] if options.byte_addressed else []
+
     with TemporaryDirectory() as tmp_dir:
-        libb1_obj = os.path.join(tmp_dir, 'libb1.o')
-        env.compile_c_source(libb1_obj, _LIBB_C_SOURCE_FILE)
-        libb2_obj = os.path.join(tmp_dir, 'libb2.o')
-        compile_b_to_native_object(libb2_obj, _LIBB_B_SOURCE_FILE, options)
+        libb1_obj = _runtime_c_object(env, libb_cppflags)
+        b_files = [_LIBB_B_SOURCE_FILE] + [
+            f for f in source_files if os.path.splitext(f)[1] == '.b']
+        if options.whole_program:
+            libb2_obj = os.path.join(tmp_dir, 'libb2.o')
+            compile_b_to_whole_program_object(libb2_obj, b_files, options)
+        elif options.lto:
+            libb2_obj = os.path.join(tmp_dir, 'libb2.o')
+            compile_b_to_linked_object(libb2_obj, b_files, options)
+        elif options.profile_use is not None:
+            # The profile may change between links and so the object compiled
+            # with it is not kept.
+            libb2_obj = os.path.join(tmp_dir, 'libb2.o')
+            compile_b_to_native_object(
+                libb2_obj, _LIBB_B_SOURCE_FILE, options, env)
+        else:
+            libb2_obj = _runtime_b_object(options, env)
+
+        # Worker processes may not start pools of their own.
+        worker_options = options
+        if jobs > 1 and options.codegen_partitions > 1:
+            worker_options = copy.copy(options)
+            worker_options.codegen_partitions = 1
+
         compiled_source_files = [libb1_obj, libb2_obj]
+        compile_jobs = []
         for file_idx, source_file in enumerate(source_files):
             out_file = os.path.join(tmp_dir, 'tmp{}.o'.format(file_idx))
             _, ext = os.path.splitext(source_file)
             if ext == '.b':
-                compile_b_to_native_object(out_file, source_file, options)
-                compiled_source_files.append(out_file)
+                # In whole-program and LTO modes, B sources have already been
+                # compiled
+                if not (options.whole_program or options.lto):
+                    compile_jobs.append(
+                        (out_file, source_file, worker_options, env))
+                    compiled_source_files.append(out_file)
             elif ext == '.c':
-                env.compile_c_source(out_file, source_file)
+                compile_jobs.append(
+                    (out_file, source_file, worker_options, env))
                 compiled_source_files.append(out_file)
             else:
                 compiled_source_files.append(source_file)
+
+        map_jobs(_compile_source_file, compile_jobs, jobs)
         env.link_objects(output, compiled_source_files)
+
+def _compile_source_file(job):
+    """Worker function which takes a tuple of object filename, B or C source
+    filename, compiler options and compilation environment and compiles the
+    source file.
+
+    """
+    obj_filename, source_file, options, env = job
+    if os.path.splitext(source_file)[1] == '.b':
+        compile_b_to_native_object(obj_filename, source_file, options, env)
+    else:
+        env.compile_c_source(obj_filename, source_file)
+
+# Parallel jobs
+# =============
+
+def map_jobs(func, args, jobs):
+    """Return a list of the results of calling func with each element of args.
+    If jobs is greater than one and there is more than one element of args,
+    the calls are made in a pool of at most that many worker processes. The
+    results are in the same order as args.
+
+    """
+    args = list(args)
+    if jobs <= 1 or len(args) <= 1:
+        return [func(arg) for arg in args]
+
+    pool = multiprocessing.Pool(min(jobs, len(args)))
+    with contextlib.closing(pool):
+        results = pool.map(func, args)
+    pool.join()
+    return results
+
+# Compilation sessions
+# ====================
+#
+# Applications which compile many small programs should not pay to set up the
+# compiler for each one. A Compiler session keeps its compiler options, and
+# therefore the target machine, along with pass managers for each optimisation
+# level which are created when first needed. Objects for the B standard
+# library are already kept by each process. See "Runtime objects" above. The
+# emit context holds the state of a single module being emitted and so is
+# not reused.
+
+class Compiler(object):
+    """A compilation session which reuses state between compilations. A
+    session must only be used by one thread at a time. The target machine of
+    the compiler options should not be changed once the session has been used.
+
+    Attributes:
+        options: The CompilerOptions used by the session.
+        env: The CompilationEnvironment used to link executables.
+
+    """
+    def __init__(self, options=None, env=_DEFAULT_ENVIRONMENT):
+        self.options = options if options is not None else CompilerOptions()
+        self.env = env
+        self._pass_managers = {}
+
+    def compile(self, source, filename=None):
+        """Compile B source code to native object code. If the output_cache
+        compiler option is set, the object code may come from the cache.
+
+        Args:
+            source (str): B source code as a string
+            filename (str or None): name of the source file
+
+        Returns:
+            The object code as bytes.
+
+        """
+        cache = self.options.output_cache
+        if cache is not None:
+            key = _output_cache_key(
+                'obj', source, filename or '', self.options)
+            object_code = cache.fetch_bytes(key)
+            if object_code is not None:
+                return object_code
+
+        module = self.compile_to_module(source, filename)
+        object_code = self.options.machine.emit_object(module)
+        if cache is not None:
+            cache.store_bytes(key, object_code)
+        return object_code
+
+    def compile_to_module(self, source, filename=None):
+        """Compile B source code to an optimised llvmlite.binding.ModuleRef.
+        See compile_b_to_module().
+
+        """
+        return compile_b_to_module(
+            source, self.options, filename=filename,
+            optimizer=self.optimize_module_ref)
+
+    def optimize_module_ref(self, module):
+        """Optimise a llvmlite.binding.ModuleRef in place with the session's
+        pass manager for the current optimisation level. Modules are not
+        optimised if the fast compiler option is set.
+
+        """
+        if self.options.fast:
+            return
+        opt_level = self.options.opt_level
+        pass_manager = self._pass_managers.get(opt_level)
+        if pass_manager is None:
+            pass_manager = _create_pass_manager(self.options)
+            self._pass_managers[opt_level] = pass_manager
+        pass_manager.run(module)
+
+    def compile_and_link(self, output, source_files, jobs=1):
+        """Compile and link source files into an output file. See
+        compile_and_link().
+
+        """
+        compile_and_link(output, source_files, self.options, self.env, jobs)
@@ -9,6 +9,15 @@ typedef intptr_t word_t;
 /* Number of bytes in a word */
 #define BYTES_PER_WORD (sizeof(word_t))
 
+/* Convert a B address into a C pointer to char. Addresses in B are
+ * word-oriented unless the B code was compiled to use byte-oriented
+ * addresses. */
+#ifdef B_BYTE_ADDRESSED
+#define B_ADDRESS_TO_PTR(a) ((char*)(a))
+#else
+#define B_ADDRESS_TO_PTR(a) ((char*)((a) * BYTES_PER_WORD))
+#endif
+
 /* GCC, clang and work-alike compilers provide the predefined macro
  * __USER_LABEL_PREFIX__. This expands to a single token which is the prefix
  * used on symbol names visible to C. This is also the prefix added to symbols
@@ -28,6 +37,63 @@ typedef intptr_t word_t;
     extern word_t b_ ## name args asm(B_SYMBOL_PREFIX_STR #name) ; \
     word_t __attribute__((aligned(BYTES_PER_WORD))) b_ ## name args
 
+/* Profiling
+ *
+ * B code compiled to generate a profile registers an array of counters for each
+ * B function. When the program exits, each function's symbol name and counters
+ * are appended as a line to the profile file. The file is named by the
+ * RBC_PROFILE environment variable or is "rbc.prof" if that is not set. */
+struct profile_record {
+    const char* name;
+    const uint64_t* counters;
+    int64_t n_counters;
+    struct profile_record* next;
+};
+
+static struct profile_record* profile_records = NULL;
+
+static void write_profile(void) {
+    const char* filename = getenv("RBC_PROFILE");
+    if(filename == NULL) {
+        filename = "rbc.prof";
+    }
+
+    FILE* fp = fopen(filename, "a");
+    if(fp == NULL) {
+        perror(filename);
+        return;
+    }
+
+    for(struct profile_record* r = profile_records; r != NULL; r = r->next) {
+        fputs(r->name, fp);
+        for(int64_t i=0; i<r->n_counters; i++) {
+            fprintf(fp, " %" PRIu64, r->counters[i]);
+        }
+        fputc('\n', fp);
+    }
+
+    fclose(fp);
+}
+
+void rbc_profile_register(const char* name, const uint64_t* counters,
+                          int64_t n_counters) {
+    struct profile_record* record = malloc(sizeof(struct profile_record));
+    if(record == NULL) {
+        return;
+    }
+
+    /* Write the profile at exit once the first function is registered. */
+    if(profile_records == NULL) {
+        atexit(write_profile);
+    }
+
+    record->name = name;
+    record->counters = counters;
+    record->n_counters = n_counters;
+    record->next = profile_records;
+    profile_records = record;
+}
+
 /* Main entry point */
 B_FUNCTION(main, ());
 
@@ -71,8 +137,7 @@ B_FUNCTION(exit, ()) {
 
 /* Put string up to terminating *e. */
 B_FUNCTION(putstr, (word_t s_ptr)) {
-    /* Addresses in B are word-oriented. */
-    char *s = (char*)(s_ptr * BYTES_PER_WORD);
+    char *s = B_ADDRESS_TO_PTR(s_ptr);
     while(*s != '\04') {
         putchar(*s); ++s;
     }
@@ -83,8 +148,7 @@ B_FUNCTION(putstr, (word_t s_ptr)) {
  * justified with zero fill. Characters are numbered from left to right,
  * starting at zero. Thus char("abc",1) returns 'b'. */
 B_FUNCTION(char, (word_t s_ptr, word_t n)) {
-    /* Addresses in B are word-oriented. */
-    char *s = (char*)(s_ptr * BYTES_PER_WORD);
+    char *s = B_ADDRESS_TO_PTR(s_ptr);
     return s[n];
 }
 
@@ -93,7 +157,6 @@ B_FUNCTION(char, (word_t s_ptr, word_t n)) {
  * "abc", lchar(s,1,'x') returns the value 'x', and sets s to have the value
  * "axc". */
 B_FUNCTION(lchar, (word_t s_ptr, word_t n, word_t c)) {
-    /* Addresses in B are word-oriented. */
-    char *s = (char*)(s_ptr * BYTES_PER_WORD);
+    char *s = B_ADDRESS_TO_PTR(s_ptr);
     s[n] = c;
 }
@@ -732,7 +732,14 @@ class BParser(Parser):
 
     @graken()
     def _builtinexpr_(self):
-        self._token('__bytes_per_word')
+        with self._choice():
+            with self._option():
+                self._token('__bytes_per_word')
+            with self._option():
+                self._token('__unroll')
+            with self._option():
+                self._token('__vectorize')
+            self._error('expecting one of: __bytes_per_word __unroll __vectorize')
 
     @graken()
     def _numericexpr_(self):
@@ -23,15 +23,36 @@ class BSemantics(object):
     string specifying the AST node name and a set of zero or more keyword
     arguments giving the parameters to the node.
 
+    If record_positions is True, nodes for statements and most expressions are
+    passed an additional "position" keyword argument giving the line and column
+    of the start of the node in the source as a tuple. Lines and columns are
+    numbered from 1. The parser must be run with parseinfo=True.
+
     Args:
         make_node (callable): callable used to make new AST nodes
+        record_positions (bool): pass source positions to make_node
 
     """
-    def __init__(self, make_node):
+    def __init__(self, make_node, record_positions=False):
         # A callable which takes an AST node name and set of keyword arguments
         # and returns the corresponding AST node object.
         self._node = make_node
 
+        # Should source positions be passed to make_node?
+        self._record_positions = record_positions
+
+    def _located_node(self, ast, type_name, **kwargs):
+        """Like self._node() but also passes the source position of the parser
+        AST if positions are being recorded and the position is known.
+
+        """
+        if self._record_positions:
+            parseinfo = getattr(ast, 'parseinfo', None)
+            if parseinfo is not None:
+                line_info = parseinfo.buffer.line_info(parseinfo.pos)
+                kwargs['position'] = (line_info.line + 1, line_info.col + 1)
+        return self._node(type_name, **kwargs)
+
     # Programs
     # ========
     #
@@ -56,8 +77,8 @@ class BSemantics(object):
 
     def functiondef(self, ast):
         args = ast.args if ast.args is not None else []
-        return self._node(
-            'FunctionDefinition', name=ast.name, arg_names=args,
+        return self._located_node(
+            ast, 'FunctionDefinition', name=ast.name, arg_names=args,
             body=ast.body)
 
     # Statements
@@ -96,33 +117,41 @@ class BSemantics(object):
         return self._node('CompoundStatement', statements=statements)
 
     def ifstatement(self, ast):
-        return self._node('IfStatement', cond=ast.cond, then=ast.then,
-                          otherwise=ast.otherwise)
+        return self._located_node(ast, 'IfStatement', cond=ast.cond,
+                                  then=ast.then, otherwise=ast.otherwise)
 
     def whilestatement(self, ast):
-        return self._node('WhileStatement', cond=ast.cond, body=ast.body)
+        return self._located_node(ast, 'WhileStatement', cond=ast.cond,
+                                  body=ast.body)
 
     def returnstatement(self, ast):
-        return self._node('ReturnStatement', return_value=ast.return_value)
+        return self._located_node(ast, 'ReturnStatement',
+                                  return_value=ast.return_value)
 
     def exprstatement(self, expression):
+        # The expression statement has the position of its expression.
+        if self._record_positions:
+            return self._node('ExpressionStatement', expression=expression,
+                              position=getattr(expression, 'position', None))
         return self._node('ExpressionStatement', expression=expression)
 
     def nullstatement(self, _):
         return self._node('NullStatement')
 
     def labelstatement(self, ast):
-        return self._node('LabelStatement', label=ast.label,
-                          statement=ast.statement)
+        return self._located_node(ast, 'LabelStatement', label=ast.label,
+                                  statement=ast.statement)
 
     def gotostatement(self, ast):
-        return self._node('GotoStatement', label=ast.label)
+        return self._located_node(ast, 'GotoStatement', label=ast.label)
 
     def switchstatement(self, ast):
-        return self._node('SwitchStatement', rvalue=ast.rvalue, body=ast.body)
+        return self._located_node(ast, 'SwitchStatement', rvalue=ast.rvalue,
+                                  body=ast.body)
 
     def casestatement(self, ast):
-        return self._node('CaseStatement', cond=ast.cond, then=ast.then)
+        return self._located_node(ast, 'CaseStatement', cond=ast.cond,
+                                  then=ast.then)
 
     def breakstatement(self, _):
         return self._node('BreakStatement')
@@ -133,14 +162,14 @@ class BSemantics(object):
     def assignexpr(self, ast):
         if ast.op is None:
             return ast.lhs
-        return self._node('AssignmentOpValue', lhs=ast.lhs, op=ast.op,
-                          rhs=ast.rhs)
+        return self._located_node(ast, 'AssignmentOpValue', lhs=ast.lhs,
+                                  op=ast.op, rhs=ast.rhs)
 
     def condexpr(self, ast):
         if ast.then is None:
             return ast.cond
-        return self._node('ConditionalOpValue', cond=ast.cond, then=ast.then,
-                          otherwise=ast.otherwise)
+        return self._located_node(ast, 'ConditionalOpValue', cond=ast.cond,
+                                  then=ast.then, otherwise=ast.otherwise)
 
     def _leftbinopexpr(self, ast):
         """All left-to-right binary operators are handled similarly."""
@@ -203,7 +232,8 @@ class BSemantics(object):
             else:
                 # Otherwise, this is a function call
                 args = tail_elem.args if tail_elem.args is not None else []
-                val = self._node('FunctionCallValue', func=val, args=args)
+                val = self._located_node(ast, 'FunctionCallValue', func=val,
+                                         args=args)
 
         return val
 
@@ -0,0 +1,288 @@
+"""
+Persistent compile server.
+
+"""
+import contextlib
+import errno
+import json
+import multiprocessing
+import os
+import socket
+import stat
+import tempfile
+import threading
+import traceback
+
+try:
+    import socketserver
+except ImportError: # Python 2
+    import SocketServer as socketserver
+
+# Compile server
+# ==============
+#
+# Starting Python, importing the compiler and initialising LLVM takes much
+# longer than compiling a small B file. A compile server started by "rbc
+# --server" keeps a pool of warm worker processes and listens on a Unix-domain
+# socket. When the socket exists, the rbc command sends its parsed command line
+# to the server rather than compiling itself. If there is no server, the
+# command compiles locally.
+#
+# Each request is a single line of JSON describing the command line with all
+# file names made absolute since the server has its own working directory.
+# The request also carries the fingerprint of the client's compiler, see
+# rbc.cache.compiler_fingerprint(), and the client's values of the environment
+# variables which affect compilation. The response is a single line of JSON
+# with a "compiled" member which is false if the server's compiler or
+# environment differs from the client's, in which case the client compiles
+# locally, and an "error" member which is null if compilation succeeded.
+# Worker processes cannot start worker pools of their own and so requests are
+# compiled with a single job and no module partitions.
+#
+# The server shuts down once it has been idle for a while. The socket must be
+# within a directory which is owned by the user and which no one else may
+# access. Otherwise another user could pose as the server. Neither the client
+# nor the server uses a socket in any other directory.
+
+# Default number of seconds after which an idle server shuts down.
+DEFAULT_IDLE_TIMEOUT = 600
+
+# Environment variables which affect compilation. PATH is searched for the C
+# compiler and the others name the output cache directory.
+_COMPILE_ENVIRONMENT = ['PATH', 'RBC_CACHE_DIR', 'XDG_CACHE_HOME', 'HOME']
+
+class RemoteCompileError(RuntimeError):
+    """An error reported by the compile server."""
+
+def default_socket_path():
+    """Return the path of the server socket. This is the path named by the
+    RBC_SERVER_SOCKET environment variable if set or a path within a private
+    directory otherwise. If RBC_SERVER_SOCKET is empty, returns None and the
+    server is not used.
+
+    """
+    socket_path = os.environ.get('RBC_SERVER_SOCKET')
+    if socket_path is not None:
+        return socket_path if socket_path != '' else None
+
+    runtime_dir = os.environ.get('XDG_RUNTIME_DIR')
+    if runtime_dir is not None:
+        socket_dir = os.path.join(runtime_dir, 'rbc')
+    else:
+        socket_dir = os.path.join(
+            tempfile.gettempdir(), 'rbc-{}'.format(os.getuid()))
+    return os.path.join(socket_dir, 'server.sock')
+
+def is_private_directory(path):
+    """Return True if path is a directory, rather than a symbolic link, which
+    is owned by the user and which no other user may access.
+
+    """
+    try:
+        dir_stat = os.lstat(path)
+    except OSError:
+        return False
+    return stat.S_ISDIR(dir_stat.st_mode) and \
+        dir_stat.st_uid == os.getuid() and (dir_stat.st_mode & 0o077) == 0
+
+# Client
+# ======
+
+def compile_remotely(opts, socket_path=None):
+    """Ask the compile server to carry out the command described by the rbc
+    Options object opts. Returns False if there is no server.
+
+    Raises:
+        RemoteCompileError if the server reports an error.
+
+    """
+    socket_path = socket_path or default_socket_path()
+    if socket_path is None or not os.path.exists(socket_path):
+        return False
+    if not is_private_directory(os.path.dirname(socket_path)):
+        return False
+
+    client = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+    with contextlib.closing(client):
+        try:
+            client.connect(socket_path)
+        except socket.error as err:
+            if err.errno in (errno.ENOENT, errno.ECONNREFUSED):
+                return False
+            raise
+
+        # A server which shuts down as the request is sent never replies.
+        request = _request_from_options(opts)
+        try:
+            client.sendall(json.dumps(request).encode('utf8') + b'\n')
+            with contextlib.closing(client.makefile('rb')) as fobj:
+                response_line = fobj.readline()
+        except socket.error:
+            return False
+        if len(response_line) == 0:
+            return False
+
+    response = json.loads(response_line.decode('utf8'))
+    if not response.get('compiled', False):
+        return False
+    if response['error'] is not None:
+        raise RemoteCompileError(response['error'])
+    return True
+
+def _request_from_options(opts):
+    """Return a JSON-compatible request for an rbc Options object."""
+    import rbc.cache
+    request = dict(vars(opts))
+    request['fingerprint'] = rbc.cache.compiler_fingerprint()
+    request['environment'] = _compile_environment()
+    request['output_type'] = opts.output_type.name
+    request['memoize'] = sorted(opts.memoize)
+    request['input_files'] = [os.path.abspath(f) for f in opts.input_files]
+
+    output_file = opts.output_file
+    if output_file is None and opts.output_type.name == 'executable':
+        output_file = 'a.out'
+    if output_file is not None:
+        output_file = os.path.abspath(output_file)
+    request['output_file'] = output_file
+
+    if opts.profile_use is not None:
+        request['profile_use'] = os.path.abspath(opts.profile_use)
+
+    return request
+
+def _compile_environment():
+    """Return a dict mapping the names of the environment variables which
+    affect compilation to their values or None if they are not set.
+
+    """
+    return dict((name, os.environ.get(name)) for name in _COMPILE_ENVIRONMENT)
+
+def _options_from_request(request):
+    """Return an rbc Options object for a request."""
+    import rbc
+    opts = rbc.Options.__new__(rbc.Options)
+    opts.__dict__.update(
+        (name, value) for name, value in request.items()
+        if name not in ('fingerprint', 'environment'))
+    opts.output_type = rbc.OutputType[request['output_type']]
+    opts.memoize = frozenset(request['memoize'])
+    opts.jobs = 1
+    opts.codegen_partitions = 1
+    return opts
+
+# Server
+# ======
+
+def serve(socket_path=None, jobs=None, idle_timeout=DEFAULT_IDLE_TIMEOUT):
+    """Run a compile server listening on socket_path until it has been idle
+    for idle_timeout seconds. At most jobs requests are compiled at once. If
+    jobs is None, the number of CPUs is used.
+
+    """
+    import rbc.cache
+    socket_path = socket_path or default_socket_path()
+    _prepare_socket_path(socket_path)
+
+    pool = multiprocessing.Pool(jobs or multiprocessing.cpu_count(),
+                                initializer=_initialize_worker)
+    server = _CompileServer(
+        socket_path, pool, rbc.cache.compiler_fingerprint(),
+        _compile_environment())
+    server.timeout = idle_timeout
+    try:
+        while not server.is_idle:
+            server.handle_request()
+    finally:
+        server.server_close()
+        os.unlink(socket_path)
+        pool.close()
+        pool.join()
+
+def _prepare_socket_path(socket_path):
+    """Create the private directory containing socket_path if necessary and
+    remove any stale socket.
+
+    Raises:
+        RuntimeError if the directory exists but is not private.
+
+    """
+    socket_dir = os.path.dirname(socket_path)
+    if not os.path.lexists(socket_dir):
+        os.makedirs(socket_dir, 0o700)
+    if not is_private_directory(socket_dir):
+        raise RuntimeError(
+            'Refusing to use a directory which other users may access: ' +
+            socket_dir)
+
+    if not os.path.exists(socket_path):
+        return
+
+    # Refuse to replace the socket of a running server.
+    client = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+    with contextlib.closing(client):
+        try:
+            client.connect(socket_path)
+        except socket.error:
+            os.unlink(socket_path)
+            return
+    raise RuntimeError('A server is already listening on ' + socket_path)
+
+def _initialize_worker():
+    """Import the compiler and initialise LLVM in a worker process."""
+    import rbc.compiler
+    rbc.compiler.CompilerOptions()
+
+def _compile_request(request):
+    """Worker process function which carries out a request. Returns None on
+    success or a description of the error.
+
+    """
+    import rbc
+    try:
+        rbc.run(_options_from_request(request))
+    except Exception: # pylint: disable=broad-except
+        return traceback.format_exc()
+    return None
+
+class _CompileServer(socketserver.ThreadingMixIn,
+                     socketserver.UnixStreamServer):
+    """A server which hands each connection's request to a pool of worker
+    processes. Requests from clients whose compiler fingerprint differs from
+    fingerprint or whose compilation environment differs from environment are
+    refused. The is_idle attribute becomes True once no request has been
+    received or handled for the server's timeout.
+
+    """
+    daemon_threads = True
+
+    def __init__(self, socket_path, pool, fingerprint, environment):
+        socketserver.UnixStreamServer.__init__(
+            self, socket_path, _CompileRequestHandler)
+        self.pool = pool
+        self.fingerprint = fingerprint
+        self.environment = environment
+        self.is_idle = False
+        self.n_active = 0
+        self.lock = threading.Lock()
+
+    def handle_timeout(self):
+        with self.lock:
+            self.is_idle = self.n_active == 0
+
+class _CompileRequestHandler(socketserver.StreamRequestHandler):
+    def handle(self):
+        with self.server.lock:
+            self.server.n_active += 1
+        try:
+            request = json.loads(self.rfile.readline().decode('utf8'))
+            if request.get('fingerprint') != self.server.fingerprint or \
+                    request.get('environment') != self.server.environment:
+                response = {'compiled': False, 'error': None}
+            else:
+                error = self.server.pool.apply(_compile_request, (request,))
+                response = {'compiled': True, 'error': error}
+            self.wfile.write(json.dumps(response).encode('utf8') + b'\n')
+        finally:
+            with self.server.lock:
+                self.server.n_active -= 1
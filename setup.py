@@ -24,13 +24,18 @@ setup(
     license='MIT',
     packages=find_packages(),
 
+    # The llvmlite versions rbc is written against need Python 3.9 or later.
+    # The last release of grako uses aliases in the collections module which
+    # were removed in Python 3.10.
+    python_requires='>=3.9,<3.10',
+
     # PyPI packages required for the *installation* and usual running of the
     # tools.
     install_requires=[
         'docopt',
         'future',
         'grako',
-        'llvmlite<0.9.0',
+        'llvmlite>=0.43.0,<0.45.0',
         'whichcraft',
     ] + enum_requires,
 
@@ -51,7 +56,6 @@ setup(
         'Topic :: Software Development :: Compilers',
         'License :: OSI Approved :: MIT License',
         'Environment :: Console',
-        'Programming Language :: Python :: 2.7',
         'Programming Language :: Python :: 3',
     ],
     keywords='compiler B llvm example',
@@ -11,18 +11,30 @@ def compile_b():
         return mod
     return _compile_b
 
+@pytest.fixture(scope='session')
+def word_type():
+    """The LLVM type of a B word on the host target as a string such as
+    "i64"."""
+    from llvmlite import ir
+    from rbc import compiler
+    options = compiler.CompilerOptions()
+    word_size = ir.IntType(8).as_pointer().get_abi_size(
+        options.machine.target_data)
+    return 'i{}'.format(8 * word_size)
+
 @pytest.fixture()
 def output_from(tmpdir):
     """A function which takes a string with B source, compiles and executes it
-    returning the output as a string."""
+    returning the output as a string. Optionally, compiler options may be
+    passed."""
     import subprocess
     import rbc.compiler
     b_source = tmpdir.join('test.b').strpath
     executable = tmpdir.join('test').strpath
-    def _output_from(source):
+    def _output_from(source, options=None):
         with open(b_source, 'w') as fobj:
             fobj.write(source)
-        rbc.compiler.compile_and_link(executable, [b_source])
+        rbc.compiler.compile_and_link(executable, [b_source], options=options)
         return subprocess.check_output([executable])
     return _output_from
 
@@ -0,0 +1,71 @@
+import pytest
+
+@pytest.fixture
+def aggressive_options():
+    import rbc.compiler as compiler
+    options = compiler.CompilerOptions()
+    options.aggressive_semantics = True
+    return options
+
+def test_aggressive_output(output_from, aggressive_options):
+    output = output_from('''
+        main() {
+            extrn putnumb, v;
+            auto w[3], i, s;
+            i = 0; s = 0;
+            while(i < 3) { w[i] = v[i] * 2; s =+ w[i]; ++i; }
+            putnumb(s); putnumb(w[2]); putnumb(7 / 2); putnumb(7 % 3);
+        }
+        v[] 1, 2, 3;
+    ''', aggressive_options)
+    assert output == b'12631'
+
+def test_division_by_zero_yields_dividend(output_from, aggressive_options):
+    output = output_from('''
+        main() {
+            extrn putnumb;
+            auto a, b;
+            a = 7; b = 0;
+            putnumb(b ? a / b : 5);
+            putnumb(a / b);
+            putnumb(a % b);
+        }
+    ''', aggressive_options)
+    assert output == b'570'
+
+def test_aggressive_module(aggressive_options):
+    import rbc.compiler as compiler
+    module_asm = compiler.compile_b_source('''
+        f(n, d) {
+            auto v[10], w[10];
+            v[n] = n + 1;
+            w[n] = v[n] * 2;
+            return (w[n] + (d ? n / d : n));
+        }
+    ''', aggressive_options)
+
+    # Arithmetic has no signed wrap and vectors are indexed in bounds.
+    assert 'add nsw' in module_asm
+    assert 'mul nsw' in module_asm
+    assert 'getelementptr inbounds' in module_asm
+
+    # Accesses to distinct vectors are marked as not aliasing.
+    assert '!alias.scope' in module_asm
+    assert '!noalias' in module_asm
+
+    # Division is speculated.
+    assert 'select' in module_asm
+
+    # None of the above happens by default.
+    module_asm = compiler.compile_b_source('''
+        f(n, d) {
+            auto v[10], w[10];
+            v[n] = n + 1;
+            w[n] = v[n] * 2;
+            return (w[n] + (d ? n / d : n));
+        }
+    ''', compiler.CompilerOptions())
+    assert 'nsw' not in module_asm.replace('nuw nsw', '')
+    assert 'inbounds' not in module_asm
+    assert '!noalias' not in module_asm
+    assert 'select' not in module_asm
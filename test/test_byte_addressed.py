@@ -0,0 +1,58 @@
+import pytest
+
+@pytest.fixture
+def check_byte_addressed(output_from):
+    """Like check_output but compiles with byte-oriented addresses."""
+    import codecs
+    import rbc.compiler
+    options = rbc.compiler.CompilerOptions()
+    options.byte_addressed = True
+    def _check(source, expected):
+        output = output_from(source, options)
+        assert output == codecs.encode(str(expected), 'utf8')
+    return _check
+
+def test_vectors(check_byte_addressed):
+    check_byte_addressed('''
+        main() {
+            extrn v, putnumb;
+            auto w[2], i;
+            i = 0;
+            while(i <= 2) { w[i] = v[i] * 2; ++i; }
+            putnumb(w[0]); putnumb(w[1]); putnumb(*(w+2)); putnumb(1[v]);
+        }
+        v[] 1, 2, 3;
+    ''', '2462')
+
+def test_pointer_to_element(check_byte_addressed):
+    check_byte_addressed('''
+        main() {
+            extrn v, putnumb;
+            auto p;
+            p = &v[1];
+            putnumb(*p); putnumb(p[1]); putnumb(p[-1]);
+            p = p + __bytes_per_word;
+            putnumb(*p);
+        }
+        v[] 1, 2, 3;
+    ''', '2313')
+
+def test_strings(check_byte_addressed):
+    check_byte_addressed('''
+        main() {
+            extrn putstr, putchar, char, lchar, printn, msg;
+            auto s[1];
+            lchar(s, 0, 'o'); lchar(s, 1, 'k'); lchar(s, 2, '*e');
+            putstr(msg[0]); putstr(s); putchar(char(msg[1], 1));
+            printn(42, 10);
+        }
+        msg[] "hello ", "x!";
+    ''', 'hello ok!42')
+
+def test_no_word_scaling_on_dereference():
+    import rbc.compiler as compiler
+    options = compiler.CompilerOptions()
+    options.byte_addressed = True
+    mod_asm = compiler.compile_b_source('f(p) { return(*p); }', options)
+    assert 'udiv' not in mod_asm
+    assert 'mul' not in mod_asm
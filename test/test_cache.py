@@ -0,0 +1,87 @@
+import os
+
+def test_cached_object(tmpdir):
+    import rbc.cache
+    import rbc.compiler as compiler
+
+    b_source = tmpdir.join('test.b')
+    b_source.write('main() { extrn putchar; putchar(\'!\'); }')
+    options = compiler.CompilerOptions()
+    options.output_cache = rbc.cache.OutputCache(tmpdir.join('cache').strpath)
+
+    first_obj = tmpdir.join('first.o').strpath
+    second_obj = tmpdir.join('second.o').strpath
+    compiler.compile_b_to_native_object(first_obj, b_source.strpath, options)
+    compiler.compile_b_to_native_object(second_obj, b_source.strpath, options)
+    assert (options.output_cache.misses, options.output_cache.hits) == (1, 1)
+    with open(first_obj, 'rb') as first, open(second_obj, 'rb') as second:
+        assert first.read() == second.read()
+
+    # Changing the options or the source changes the key.
+    options.opt_level = 2
+    compiler.compile_b_to_native_object(second_obj, b_source.strpath, options)
+    b_source.write('main() { extrn putchar; putchar(\'?\'); }')
+    compiler.compile_b_to_native_object(second_obj, b_source.strpath, options)
+    assert (options.output_cache.misses, options.output_cache.hits) == (3, 1)
+
+def test_least_recently_used_are_evicted(tmpdir):
+    import rbc.cache
+    cache = rbc.cache.OutputCache(tmpdir.join('cache').strpath, max_size=25)
+    output = tmpdir.join('output')
+
+    for idx, key in enumerate(['a', 'b', 'c']):
+        output.write('x' * 10)
+        cache.store(key, output.strpath)
+        os.utime(os.path.join(cache.directory, key), (idx, idx))
+
+        # Using a file makes it the most recently used.
+        if key == 'b':
+            assert cache.fetch('a', output.strpath)
+
+    assert not cache.fetch('b', output.strpath)
+    assert cache.fetch('a', output.strpath)
+    assert cache.fetch('c', output.strpath)
+
+_FUNCTIONS_PROGRAM = '''
+    square(x) return(x * x);
+    sum(n) {
+        extrn v;
+        auto i, s;
+        i = s = 0;
+        while(i < n) { s =+ square(v[i]); i++; }
+        return(s);
+    }
+    main() {
+        extrn putnumb, putstr, greeting;
+        putstr(greeting); putnumb(sum(3));
+    }
+    v[] 1, 2, 3;
+    greeting "sum: ";
+'''
+
+def test_function_cache(tmpdir, output_from):
+    import rbc.cache
+    import rbc.compiler as compiler
+    options = compiler.CompilerOptions()
+    cache = rbc.cache.OutputCache(tmpdir.join('cache').strpath)
+    options.function_cache = cache
+
+    compiler.compile_b_to_module(_FUNCTIONS_PROGRAM, options)
+    assert (cache.misses, cache.hits) == (3, 0)
+
+    # Only the changed function is compiled again.
+    source = _FUNCTIONS_PROGRAM.replace('x * x', 'x * x * x')
+    compiler.compile_b_to_module(source, options)
+    assert (cache.misses, cache.hits) == (4, 2)
+
+    # Changing the size of a vector changes functions which refer to it.
+    source = source.replace('1, 2, 3', '1, 2, 3, 4')
+    compiler.compile_b_to_module(source, options)
+    assert (cache.misses, cache.hits) == (5, 4)
+
+    # Partially initialising a vector of the same size changes its layout.
+    source = source.replace('v[] 1, 2, 3, 4', 'v[3] 1, 2, 3')
+    compiler.compile_b_to_module(source, options)
+    assert (cache.misses, cache.hits) == (6, 6)
+
+    assert output_from(source, options) == b'sum: 36'
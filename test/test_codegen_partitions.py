@@ -0,0 +1,52 @@
+import pytest
+
+@pytest.fixture
+def partitioned_options():
+    import rbc.compiler as compiler
+    options = compiler.CompilerOptions()
+    options.codegen_partitions = 3
+    return options
+
+def test_partitioned_output(output_from, partitioned_options):
+    output = output_from('''
+        square(x) return(x * x);
+        sum(v, n) {
+            auto i, s;
+            i = s = 0;
+            while(i < n) { s =+ square(v[i]); i++; }
+            return(s);
+        }
+        main() {
+            extrn putnumb, putstr, v, w, c;
+            putstr("sum: ");
+            putnumb(sum(v, 3)); putstr(w); putnumb(c);
+            c = 9; putnumb(c);
+        }
+        v[] 1, 2, 3;
+        w "!";
+        c 4;
+    ''', partitioned_options)
+    assert output == b'sum: 14!49'
+
+def test_partition_functions():
+    import rbc.codegen as codegen
+    import rbc.compiler as compiler
+    program = compiler.parse_b_source('''
+        big(a, b) {
+            if(a < b) return(a + b * 2 - 1);
+            return(big(b, a) + big(a - 1, b) + big(a, b - 1));
+        }
+        f() return(1);
+        g() return(2);
+        x 3;
+    ''')
+
+    # The largest function has a partition to itself.
+    partitions = codegen.analysis.partition_functions(program, 2)
+    assert sorted(partitions, key=len) == [
+        frozenset(['big']), frozenset(['f', 'g'])]
+
+    # Surplus partitions are empty.
+    partitions = codegen.analysis.partition_functions(program, 4)
+    assert frozenset() in partitions
+    assert frozenset().union(*partitions) == frozenset(['big', 'f', 'g'])
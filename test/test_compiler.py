@@ -6,3 +6,157 @@ def test_putchar(check_output):
 def test_putnumb(check_output):
     check_output('main() { extrn putnumb; putnumb(-010); }', '-8')
 
+
+def test_direct_call_to_defined_function(word_type):
+    options = compiler.CompilerOptions()
+    mod_asm = compiler.compile_b_source('''
+        f(x) { return(x+1); }
+        main() { auto g; f(1); g = &f; (*g)(2); }
+    ''', options)
+    assert 'call {0} @"b.f"({0} 1)'.format(word_type) in mod_asm
+    assert '@"b.f"({0} 2)'.format(word_type) not in mod_asm
+
+def test_call_via_function_pointer(check_output):
+    check_output('''
+        f(x) { return(x+1); }
+        main() {
+            extrn putnumb;
+            auto g;
+            g = &f; putnumb((*g)(2)); putnumb(f(4));
+        }
+    ''', '35')
+
+def test_debug_info():
+    options = compiler.CompilerOptions()
+    options.debug_info = True
+    mod_asm = compiler.compile_b_source('''
+        f(x) {
+            return(x+1);
+        }
+    ''', options, filename='/src/f.b')
+    assert 'DIFile(directory: "/src", filename: "f.b")' in mod_asm
+    assert 'DISubprogram(' in mod_asm
+    assert 'name: "f"' in mod_asm
+    assert 'line: 3' in mod_asm
+
+    # Debug information survives optimisation.
+    module = compiler.optimize_module(mod_asm, options)
+    assert '!dbg' in str(module)
+
+def test_debug_info_output(output_from):
+    options = compiler.CompilerOptions()
+    options.debug_info = True
+    options.memoize = frozenset(['f'])
+    assert output_from('''
+        f(x) return(x+1);
+        main() { extrn putnumb; putnumb(f(2)); }
+    ''', options) == b'3'
+
+def test_debug_info_object(tmpdir):
+    # The rbc command compiles with -g.
+    import docopt
+    import rbc
+    b_source = tmpdir.join('test.b')
+    b_source.write('main() { return(0); }')
+    rbc.run(rbc.Options(docopt.docopt(
+        rbc.__doc__, argv=['-g', '-c', b_source.strpath])))
+    assert b'.debug_info' in tmpdir.join('test.o').read_binary()
+
+def test_runtime_objects_are_reused(tmpdir):
+    import subprocess
+
+    class CountingEnvironment(compiler.CompilationEnvironment):
+        def __init__(self):
+            compiler.CompilationEnvironment.__init__(self)
+            self.n_compiled = 0
+
+        def compile_c_source(self, obj_filename, c_filename,
+                             extra_cppflags=()):
+            self.n_compiled += 1
+            compiler.CompilationEnvironment.compile_c_source(
+                self, obj_filename, c_filename, extra_cppflags)
+
+    # Use distinct C flags so that earlier tests' objects are not reused.
+    env = CountingEnvironment()
+    env.cflags = env.cflags + ['-O1']
+
+    b_source = tmpdir.join('test.b')
+    b_source.write('main() { extrn putchar; putchar(\'!\'); }')
+    executable = tmpdir.join('test').strpath
+
+    compiler.compile_and_link(executable, [b_source.strpath], env=env)
+    assert env.n_compiled == 1
+    compiler.compile_and_link(executable, [b_source.strpath], env=env)
+    assert env.n_compiled == 1
+    assert subprocess.check_output([executable]) == b'!'
+
+def test_parallel_compile_and_link(tmpdir):
+    import subprocess
+    files = []
+    for idx in range(3):
+        b_source = tmpdir.join('f{}.b'.format(idx))
+        b_source.write('f{0}() {{ extrn putchar; putchar(\'{0}\'); }}'.format(
+            idx))
+        files.append(b_source.strpath)
+    c_source = tmpdir.join('g.c')
+    c_source.write('''
+        #include <stdio.h>
+        long g(void) __asm__("b.g");
+        long g(void) { return putchar('c'); }
+    ''')
+    main_source = tmpdir.join('main.b')
+    main_source.write('''
+        main() { extrn f0, f1, f2, g; f2(); f0(); f1(); g(); }
+    ''')
+    files.extend([c_source.strpath, main_source.strpath])
+
+    options = compiler.CompilerOptions()
+    options.codegen_partitions = 2
+    executable = tmpdir.join('test').strpath
+    compiler.compile_and_link(executable, files, options, jobs=3)
+    assert subprocess.check_output([executable]) == b'201c'
+
+def test_options_can_be_pickled():
+    import pickle
+    options = compiler.CompilerOptions()
+    options.opt_level = 3
+    options.memoize = frozenset(['f'])
+    unpickled = pickle.loads(pickle.dumps(options))
+    assert unpickled.opt_level == 3
+    assert unpickled.memoize == frozenset(['f'])
+    assert unpickled.target.triple == options.target.triple
+    assert str(unpickled.machine.target_data) == \
+        str(options.machine.target_data)
+
+def test_compile_b_to_outputs(tmpdir, monkeypatch):
+    b_source = tmpdir.join('test.b')
+    b_source.write('main() { return(0); }')
+
+    # The source is compiled once for all outputs.
+    compile_b_source = compiler.compile_b_source
+    calls = []
+    def _compile_b_source(*args, **kwargs):
+        calls.append(args)
+        return compile_b_source(*args, **kwargs)
+    monkeypatch.setattr(compiler, 'compile_b_source', _compile_b_source)
+
+    outputs = dict((kind, tmpdir.join('test.' + kind).strpath)
+                   for kind in compiler.OUTPUT_KINDS)
+    compiler.compile_b_to_outputs(
+        outputs, b_source.strpath, compiler.CompilerOptions())
+    assert len(calls) == 1
+    assert tmpdir.join('test.obj').size() > 0
+    assert 'b.main' in tmpdir.join('test.asm').read()
+    assert 'define' in tmpdir.join('test.llvm-ir').read()
+    assert tmpdir.join('test.llvm-bc').read_binary().startswith(b'BC')
+
+def test_emit_option(tmpdir):
+    import docopt
+    import rbc
+    b_source = tmpdir.join('test.b')
+    b_source.write('main() { return(0); }')
+    rbc.run(rbc.Options(docopt.docopt(
+        rbc.__doc__, argv=['--emit=obj,llvm-ir', b_source.strpath])))
+    assert tmpdir.join('test.o').check()
+    assert tmpdir.join('test.ll').check()
+    assert not tmpdir.join('test.s').check()
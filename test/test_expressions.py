@@ -124,3 +124,15 @@ def test_conditional_evaluates_one_side(check_output):
         }
     ''', '1021')
 
+
+def test_assignment_op_evaluates_lhs_once(check_output):
+    check_output('''
+        main() {
+            extrn v, putnumb;
+            auto i;
+            i = 0;
+            v[i++] =+ 10; v[i++] =* 3;
+            putnumb(i); putnumb(v[0]); putnumb(v[1]); putnumb(v[2]);
+        }
+        v[] 1, 2, 3;
+    ''', '21163')
@@ -0,0 +1,40 @@
+import pickle
+
+import rbc.compiler as compiler
+
+_PROGRAM = '''
+    a "one*n";
+    v[1] "two*n", "three*n";
+    main() {
+        extrn putstr, a, v;
+        auto i;
+        putstr(a);
+        i = 0;
+        while(i < 2) putstr(v[i++]);
+    }
+'''
+
+def _fast_options():
+    options = compiler.CompilerOptions()
+    options.opt_level = 3
+    options.fast = True
+    options.verify = False
+    return options
+
+def test_fast_output(output_from):
+    assert output_from(_PROGRAM, _fast_options()) == b'one\ntwo\nthree\n'
+
+def test_fast_module_is_not_optimised():
+    module = compiler.compile_b_to_module(_PROGRAM, _fast_options())
+    mod_asm = str(module)
+
+    # Auto variables are left on the stack.
+    assert 'alloca' in mod_asm
+
+    # Both externals are initialised by the same constructor.
+    assert mod_asm.count('define private void @__ctor') == 1
+
+def test_fast_option_is_pickled():
+    unpickled = pickle.loads(pickle.dumps(_fast_options()))
+    assert unpickled.fast
+    assert not unpickled.verify
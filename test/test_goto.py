@@ -27,3 +27,45 @@ def test_goto_future(check_output):
             putchar('Z');
         }
     ''', 'X.....Z')
+
+def test_goto_into_unreachable_code(check_output):
+    check_output('''
+        main() {
+            extrn putchar;
+            auto i;
+            i = 'A';
+            goto skip;
+            putchar('X');
+            if(i) { skip: putchar(i); }
+            return;
+            auto j;
+            j = 'Y'; putchar(j);
+        }
+    ''', 'A')
+
+def test_undefined_label():
+    import pytest
+    import rbc.compiler as compiler
+    import rbc.exception as exc
+    with pytest.raises(exc.SemanticError):
+        compiler.compile_b_source(
+            'main() { goto nowhere; }', compiler.CompilerOptions())
+
+def test_no_blocks_after_terminators(word_type):
+    import rbc.compiler as compiler
+    mod_asm = compiler.compile_b_source('''
+        f(x) {
+            if(x) return(1); else return(2);
+            x = 3;
+        }
+        g(x) {
+            while(1) { break; x = 2; }
+            goto end; x = 4;
+        end:
+            return(x); x = 5;
+        }
+    ''', compiler.CompilerOptions())
+    for text in ['post_return', 'post_goto', 'post_break', 'endif']:
+        assert text not in mod_asm
+    for value in range(2, 6):
+        assert 'store {} {}'.format(word_type, value) not in mod_asm
@@ -52,3 +52,54 @@ def test_else_binds_to_inner_if(check_output):
         }
     ''', '-1-1011')
 
+
+def test_conditional_assignment(check_output):
+    check_output('''
+        clamp(x) { if(x > 10) x = 10; else x =+ 1; return(x); }
+        count(x, n) { if(x & 1) { n =+ 2; } return(n); }
+        main() {
+            extrn putnumb;
+            putnumb(clamp(20)); putnumb(clamp(3));
+            putnumb(count(3, 1)); putnumb(count(2, 1));
+        }
+    ''', '10431')
+
+def test_conditional_assignment_is_branchless():
+    import rbc.compiler as compiler
+    mod_asm = compiler.compile_b_source('''
+        f(a, b) {
+            if(a < b) a = b; else a = a * 2;
+            if(a) b =+ 1;
+            return(a > b ? a : b);
+        }
+    ''', compiler.CompilerOptions())
+    assert 'br ' not in mod_asm
+    assert 'select' in mod_asm
+
+def test_conditional_with_side_effects_branches(check_output):
+    check_output('''
+        main() {
+            extrn putnumb, putchar;
+            auto a, v[1];
+            a = 0; v[0] = 7;
+            if(a) a = putchar('X');
+            putnumb(a ? a/a : v[0]);
+            putnumb(a ? 1 : putnumb(5));
+        }
+    ''', '755')
+
+def test_conditional_assignment_to_external_branches():
+    # A store to an external variable must not happen if the condition is
+    # false.
+    import rbc.compiler as compiler
+    mod_asm = compiler.compile_b_source('''
+        f(c) {
+            extrn g;
+            if(c) g = 1;
+        }
+    ''', compiler.CompilerOptions())
+    assert 'select' not in mod_asm
+    body = mod_asm[mod_asm.index('define'):]
+    entry_block = body[:body.index('br ')]
+    assert '@"b.g"' not in entry_block
+    assert 'store' in body and '@"b.g"' in body
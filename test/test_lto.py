@@ -0,0 +1,46 @@
+import pytest
+
+@pytest.fixture
+def lto_options():
+    import rbc.compiler as compiler
+    options = compiler.CompilerOptions()
+    options.lto = True
+    options.opt_level = 2
+    return options
+
+def test_lto_output(tmpdir, lto_options):
+    import subprocess
+    import rbc.compiler as compiler
+    main_source = tmpdir.join('main.b')
+    main_source.write('''
+        main() {
+            extrn printn, putchar, twice, n;
+            printn(twice(n), 10); putchar('*n');
+        }
+    ''')
+    lib_source = tmpdir.join('lib.b')
+    lib_source.write('''
+        twice(x) { return(2*x); }
+        n 21;
+    ''')
+    executable = tmpdir.join('test').strpath
+    compiler.compile_and_link(
+        executable, [main_source.strpath, lib_source.strpath], lto_options)
+    assert subprocess.check_output([executable]) == b'42\n'
+
+def test_lto_module(tmpdir, lto_options, word_type):
+    import rbc.compiler as compiler
+    main_source = tmpdir.join('main.b')
+    main_source.write('main() { extrn twice; return(twice(21)); }')
+    lib_source = tmpdir.join('lib.b')
+    lib_source.write('twice(x) { return(2*x); }')
+
+    module = compiler.link_b_modules(
+        [main_source.strpath, lib_source.strpath], lto_options)
+    compiler._optimize_module_ref(module, lto_options)
+    ir = str(module)
+
+    # The function from the other module is inlined and folded but remains
+    # visible.
+    assert 'ret {} 42'.format(word_type) in ir
+    assert 'define {} @b.twice'.format(word_type) in ir
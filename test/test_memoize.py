@@ -0,0 +1,48 @@
+import pytest
+
+@pytest.fixture
+def memoize_options():
+    import rbc.compiler as compiler
+    options = compiler.CompilerOptions()
+    options.memoize = frozenset(['fib', 'choose'])
+    return options
+
+def test_memoized_recursion(output_from, memoize_options):
+    # Without memoisation, fib(80) would take longer than the age of the
+    # universe.
+    output = output_from('''
+        fib(n) {
+            if(n < 2) return(n);
+            return(fib(n-1) + fib(n-2));
+        }
+        choose(n, k) {
+            if(k == 0 | k == n) return(1);
+            return(choose(n-1, k-1) + choose(n-1, k));
+        }
+        main() {
+            extrn putnumb, putchar;
+            putnumb(fib(80)); putchar(' ');
+            putnumb(choose(60, 30)); putchar(' ');
+            putnumb(fib(10));
+        }
+    ''', memoize_options)
+    assert output == b'23416728348467685 118264581564861424 55'
+
+def test_memoized_module(memoize_options, word_type):
+    import rbc.compiler as compiler
+    mod_asm = compiler.compile_b_source('''
+        fib(n) {
+            if(n < 2) return(n);
+            return(fib(n-1) + fib(n-2));
+        }
+        g(n) { return(n); }
+    ''', memoize_options)
+
+    # The body of fib is private and called from the public wrapper.
+    assert 'define private {0} @"__memo.fib"({0} %"n")'.format(
+        word_type) in mod_asm
+    assert 'call {} @"__memo.fib"'.format(word_type) in mod_asm
+    assert '@"__memo.fib.cache" = internal global' in mod_asm
+
+    # Functions which are not named are not memoised.
+    assert '__memo.g' not in mod_asm
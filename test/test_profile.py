@@ -0,0 +1,49 @@
+import rbc.compiler as compiler
+
+_PROGRAM = '''
+    classify(n) {
+        if(n % 10 == 0) return(1);
+        return(0);
+    }
+    main() {
+        extrn putnumb;
+        auto i, c;
+        i = c = 0;
+        while(i < 1000) { c =+ classify(i); i++; }
+        putnumb(c);
+    }
+'''
+
+def test_profile_round_trip(output_from, tmpdir, monkeypatch):
+    profile_file = tmpdir.join('test.prof').strpath
+    monkeypatch.setenv('RBC_PROFILE', profile_file)
+
+    # Running an instrumented program twice appends two profiles.
+    options = compiler.CompilerOptions()
+    options.profile_generate = True
+    assert output_from(_PROGRAM, options) == b'100'
+    assert output_from(_PROGRAM, options) == b'100'
+
+    with open(profile_file) as fobj:
+        profile = compiler.codegen.profile.read_profile(fobj)
+    assert profile['b.classify'] == (2000, 200, 2000)
+    assert profile['b.main'][0] == 2
+
+    # The profile annotates the module.
+    options = compiler.CompilerOptions()
+    options.profile_use = profile_file
+    mod_asm = compiler.compile_b_source(_PROGRAM, options)
+    assert '!"function_entry_count", i64 2000' in mod_asm
+    assert '!"branch_weights", i32 200, i32 1800' in mod_asm
+    assert '!"ProfileSummary"' in mod_asm
+    assert output_from(_PROGRAM, options) == b'100'
+
+def test_stale_profile_is_ignored(tmpdir):
+    profile_file = tmpdir.join('test.prof')
+    profile_file.write('b.classify 10 1 2 3 4\nb.main 1 0 1 1 1\n')
+
+    options = compiler.CompilerOptions()
+    options.profile_use = profile_file.strpath
+    mod_asm = compiler.compile_b_source(_PROGRAM, options)
+    assert '!"function_entry_count", i64 10' not in mod_asm
+    assert '!"function_entry_count", i64 1' in mod_asm
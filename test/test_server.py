@@ -0,0 +1,125 @@
+import os
+import threading
+import time
+
+import docopt
+import pytest
+
+import rbc
+import rbc.cache
+import rbc.server
+
+def _options(argv):
+    return rbc.Options(docopt.docopt(rbc.__doc__, argv=argv))
+
+def test_no_server(tmpdir):
+    opts = _options(['-c', tmpdir.join('test.b').strpath])
+    socket_path = tmpdir.join('server.sock').strpath
+    assert not rbc.server.compile_remotely(opts, socket_path)
+
+# Number of seconds to wait for a server to start listening.
+_SERVER_START_TIMEOUT = 10
+
+def _start_server(socket_path):
+    """Run a server in a new thread and wait for it to listen on
+    socket_path. Returns the thread.
+
+    """
+    errors = []
+    def _serve():
+        try:
+            rbc.server.serve(socket_path=socket_path, jobs=2, idle_timeout=1)
+        except Exception as err:
+            errors.append(err)
+            raise
+
+    server_thread = threading.Thread(target=_serve)
+    server_thread.daemon = True
+    server_thread.start()
+
+    deadline = time.time() + _SERVER_START_TIMEOUT
+    while not os.path.exists(socket_path):
+        if len(errors) > 0:
+            pytest.fail('Server failed to start: {!r}'.format(errors[0]))
+        if time.time() > deadline:
+            pytest.fail('Server did not start listening in time')
+        time.sleep(0.01)
+    return server_thread
+
+def test_server(tmpdir, monkeypatch):
+    socket_path = tmpdir.join('server.sock').strpath
+    server_thread = _start_server(socket_path)
+
+    b_source = tmpdir.join('test.b')
+    b_source.write('main() { return(0); }')
+    opts = _options(['-c', b_source.strpath])
+    assert rbc.server.compile_remotely(opts, socket_path)
+    assert tmpdir.join('test.o').check()
+
+    # Errors are reported by the client.
+    b_source.write('main() { return(x); }')
+    with pytest.raises(rbc.server.RemoteCompileError) as err:
+        rbc.server.compile_remotely(opts, socket_path)
+    assert 'Variable not found in scope: x' in str(err.value)
+
+    # A server running a different compiler is not used.
+    fingerprint = rbc.cache.compiler_fingerprint.value
+    try:
+        rbc.cache.compiler_fingerprint.value = 'another compiler'
+        assert not rbc.server.compile_remotely(opts, socket_path)
+    finally:
+        rbc.cache.compiler_fingerprint.value = fingerprint
+
+    # Nor is a server whose environment differs from the client's.
+    cache_dir = tmpdir.join('cache').strpath
+    monkeypatch.setenv('RBC_CACHE_DIR', cache_dir)
+    assert not rbc.server.compile_remotely(opts, socket_path)
+    monkeypatch.undo()
+
+    # The server stops when idle.
+    server_thread.join(10)
+    assert not server_thread.is_alive()
+    assert not os.path.exists(socket_path)
+
+def test_shared_directory_is_not_used(tmpdir):
+    import json
+    import socket
+    shared_dir = tmpdir.mkdir('shared')
+    shared_dir.chmod(0o755)
+    socket_path = shared_dir.join('server.sock').strpath
+
+    # The server refuses to listen in the directory.
+    with pytest.raises(RuntimeError):
+        rbc.server.serve(socket_path=socket_path, jobs=1, idle_timeout=1)
+
+    # The client ignores a server in the directory which claims success.
+    listener = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+    listener.bind(socket_path)
+    listener.listen(1)
+    def _reply():
+        conn, _ = listener.accept()
+        conn.makefile('rb').readline()
+        conn.sendall(json.dumps({'compiled': True, 'error': None}).encode(
+            'utf8') + b'\n')
+        conn.close()
+    reply_thread = threading.Thread(target=_reply)
+    reply_thread.daemon = True
+    reply_thread.start()
+
+    opts = _options(['-c', tmpdir.join('test.b').strpath])
+    try:
+        assert not rbc.server.compile_remotely(opts, socket_path)
+    finally:
+        listener.close()
+
+def test_disabled_server_is_not_asked(tmpdir, monkeypatch):
+    def _compile_remotely(*args, **kwargs):
+        raise AssertionError('Disabled server was asked to compile')
+    compiled = []
+    monkeypatch.setenv('RBC_SERVER_SOCKET', '')
+    monkeypatch.setattr(rbc.server, 'compile_remotely', _compile_remotely)
+    monkeypatch.setattr(rbc, 'run', compiled.append)
+    monkeypatch.setattr(
+        'sys.argv', ['rbc', '-c', tmpdir.join('test.b').strpath])
+    rbc.main()
+    assert len(compiled) == 1
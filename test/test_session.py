@@ -0,0 +1,28 @@
+def test_session_compiles_objects(tmpdir):
+    import subprocess
+    import rbc.compiler as compiler
+    session = compiler.Compiler()
+
+    for idx in range(3):
+        object_code = session.compile(
+            'main() { extrn putnumb; putnumb(' + str(idx) + '); }')
+        obj_filename = tmpdir.join('test{}.o'.format(idx)).strpath
+        with open(obj_filename, 'wb') as fobj:
+            fobj.write(object_code)
+
+        executable = tmpdir.join('test').strpath
+        session.compile_and_link(executable, [obj_filename])
+        assert subprocess.check_output([executable]) == str(idx).encode()
+
+    # The pass manager is created once.
+    assert list(session._pass_managers) == [session.options.opt_level]
+
+def test_session_uses_output_cache(tmpdir):
+    import rbc.cache
+    import rbc.compiler as compiler
+    session = compiler.Compiler()
+    session.options.output_cache = rbc.cache.OutputCache(tmpdir.strpath)
+
+    source = 'main() { return(1); }'
+    assert session.compile(source) == session.compile(source)
+    assert session.options.output_cache.hits == 1
@@ -0,0 +1,19 @@
+import subprocess
+import sys
+
+# Modules which are only needed when compiling. Printing help should not load
+# them since importing them takes much longer than parsing the command line.
+_HEAVY_MODULES = ['rbc.compiler', 'rbc.parser', 'grako', 'pkg_resources']
+
+def test_help_does_not_load_compiler():
+    loaded = subprocess.check_output([sys.executable, '-c', '''
+import sys
+import rbc
+try:
+    rbc.main()
+except SystemExit:
+    pass
+print(' '.join(sys.modules))
+''', '--help']).decode('utf8').split()
+    for name in _HEAVY_MODULES:
+        assert name not in loaded
@@ -61,3 +61,28 @@ def test_dereference_via_flip(check_output):
             putnumb(a); putnumb(b);
         }
     ''', '10202010')
+
+def test_increment_evaluates_address_once(check_output):
+    check_output('''
+        main() {
+            extrn v, putnumb;
+            auto i;
+            i = 0;
+            ++v[i++]; v[i++]--;
+            putnumb(i); putnumb(v[0]); putnumb(v[1]); putnumb(v[2]);
+        }
+        v[] 5, 5, 5;
+    ''', '2645')
+
+def test_not_of_comparisons(check_output):
+    check_output('''
+        main() {
+            extrn putnumb;
+            auto a, b;
+            a = 3; b = 5;
+            putnumb(!(a < b)); putnumb(!(a > b)); putnumb(!!a);
+            putnumb(a < b & b < a); putnumb(a < b | b < a);
+            putnumb(!(a < b & b < 6)); putnumb((a < b) & 3);
+            if(!(a < b | 0)) putnumb(9);
+        }
+    ''', '0110101')
@@ -98,3 +98,39 @@ def test_init_vector_too_many_count(check_output):
         }
         v[6] 1, 2, 3;
     ''', '1230000')
+
+def test_negative_offset_from_vector(check_output):
+    check_output('''
+        main() {
+            extrn v, putnumb;
+            auto p;
+            p = &v[2];
+            putnumb(p[-1]); putnumb(*(p-2)); putnumb(1[v]);
+        }
+        v[] 1, 2, 3;
+    ''', '212')
+
+def test_vector_access_is_pointer_arithmetic(compile_b):
+    # Indexing vectors whose base pointer is known statically should not need
+    # integer to pointer conversions.
+    mod = compile_b('''
+        sum(n) {
+            extrn v;
+            auto i, s, w[10];
+            s = i = 0;
+            while(i < n) { w[i] = v[i]; s =+ w[i++]; }
+            return(s);
+        }
+        v[100];
+    ''')
+    assert 'inttoptr' not in str(mod)
+
+def test_large_external_vector_is_zero_initialised():
+    # Uninitialised elements should not be emitted one constant at a time.
+    import rbc.compiler as compiler
+    mod_asm = compiler.compile_b_source('''
+        v[2000000];
+        w[2000000] 1, 2;
+    ''', compiler.CompilerOptions())
+    assert len(mod_asm) < 1000
+    assert 'zeroinitializer' in mod_asm
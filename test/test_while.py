@@ -1,3 +1,5 @@
+import pytest
+
 def test_count_down(check_output):
     check_output('''
         countdown(num) {
@@ -33,3 +35,65 @@ def test_break_is_no_op_outside_while(check_output):
 
 
 
+
+def test_relational_condition_is_not_widened():
+    import rbc.compiler as compiler
+    mod_asm = compiler.compile_b_source('''
+        f(a, b) {
+            while(a < b & !(a == 3)) a++;
+            if(!(a > b | a == 0)) return(1);
+            return(a < b ? 2 : 3);
+        }
+    ''', compiler.CompilerOptions())
+    assert 'zext' not in mod_asm
+    assert 'icmp ne' not in mod_asm
+
+def test_loop_hints(check_output):
+    check_output('''
+        main() {
+            extrn putnumb, v;
+            auto i, s;
+            i = 0; s = 0;
+            while(i < 8) { __unroll(4); __vectorize(2); s =+ v[i]; i++; }
+            putnumb(s);
+        }
+        v[8] 1, 2, 3, 4, 5, 6, 7, 8;
+    ''', '36')
+
+def test_loop_hint_metadata():
+    import rbc.compiler as compiler
+    mod_asm = compiler.compile_b_source('''
+        f(n) {
+            while(n > 0) { __unroll(4); __vectorize(0); n =- 1; }
+            while(n < 0) { n =+ 1; }
+        }
+    ''', compiler.CompilerOptions())
+
+    # Loops are rotated and only the hinted loop has metadata
+    assert mod_asm.count('label %"whilethen"') == 2
+    assert mod_asm.count('!llvm.loop') == 1
+    assert '!"llvm.loop.unroll.count", i32 4' in mod_asm
+    assert '!"llvm.loop.vectorize.enable", i1 0' in mod_asm
+
+def test_loop_hint_metadata_is_unique_per_loop():
+    import re
+    import rbc.compiler as compiler
+    mod_asm = compiler.compile_b_source('''
+        f(n) {
+            while(n > 0) { __unroll(2); n =- 1; }
+            while(n < 0) { __unroll(2); n =+ 1; }
+        }
+    ''', compiler.CompilerOptions())
+
+    # Each loop has its own node whose first operand is the node itself
+    ids = re.findall(r'!llvm.loop !(\d+)', mod_asm)
+    assert len(set(ids)) == 2
+    for id_ in ids:
+        assert re.search(r'!{0} = .*!{{ *!{0},'.format(id_), mod_asm)
+
+def test_loop_hint_outside_loop():
+    import rbc.compiler as compiler
+    import rbc.exception as exc
+    with pytest.raises(exc.SemanticError):
+        compiler.compile_b_source(
+            'f() { __unroll(2); }', compiler.CompilerOptions())
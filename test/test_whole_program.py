@@ -0,0 +1,79 @@
+import pytest
+
+@pytest.fixture
+def whole_program_options():
+    import rbc.compiler as compiler
+    options = compiler.CompilerOptions()
+    options.whole_program = True
+    return options
+
+def test_whole_program_output(output_from, whole_program_options):
+    output = output_from('''
+        main() {
+            extrn printn, putchar, v;
+            auto g;
+            g = &twice;
+            printn((*g)(v[1]), 10); putchar('*n');
+        }
+        twice(x) { return(2*x); }
+        unused(x) { return(x); }
+        v[] 1, 21;
+    ''', whole_program_options)
+    assert output == b'42\n'
+
+def test_whole_program_module(tmpdir, whole_program_options, word_type):
+    import rbc.compiler as compiler
+    b_source = tmpdir.join('test.b')
+    b_source.write('''
+        main() { extrn printn; printn(add(1, 2), 10); }
+        add(a, b) { return(a+b); }
+        unused() { return(0); }
+    ''')
+    module = compiler.link_b_modules(
+        [compiler._LIBB_B_SOURCE_FILE, b_source.strpath],
+        whole_program_options)
+    compiler.internalize_module(module)
+    ir = str(module)
+
+    # main is still visible but other B functions are internal, unused ones are
+    # removed and those whose addresses aren't taken use fastcc.
+    assert 'define {} @b.main()'.format(word_type) in ir
+    assert 'b.unused' not in ir
+    assert 'define internal fastcc {} @b.printn'.format(word_type) in ir
+
+def test_constant_externals(tmpdir, whole_program_options):
+    import rbc.compiler as compiler
+    b_source = tmpdir.join('test.b')
+    b_source.write('''
+        main() {
+            extrn n, t, v, m, p, printn;
+            auto i;
+            i = 0;
+            while(i < n) { v[i] = t[i] + t[v[i]]; printn(*(t+i), 10); ++i; }
+            f(&m, p);
+        }
+        f(x, y) { *x = 1; y[0] = 2; }
+        n 3; m 4; p;
+        t[] 1, 2, 3;
+        v[4];
+    ''')
+    module = compiler.link_b_modules([b_source.strpath], whole_program_options)
+    globals_by_name = dict((g.name, str(g)) for g in module.global_variables)
+    assert ' constant ' in globals_by_name['b.n']
+    assert ' constant ' in globals_by_name['b.t']
+    assert ' constant ' in globals_by_name['b.p']
+    assert ' constant ' not in globals_by_name['b.v']
+    assert ' constant ' not in globals_by_name['b.m']
+
+def test_constant_externals_analysis():
+    from rbc.compiler import parse_b_source
+    from rbc.codegen.analysis import find_constant_externals
+    program = parse_b_source('''
+        main() {
+            extrn a, b, c, d, e, f, g, h;
+            a = 1; b++; --c; putnumb(&d); putnumb(e); e[1] = 2; g(f);
+            h = h[1] + *(h-2) + h[e[0]];
+        }
+        a; b; c; d; e; f[2]; g[2]; h[2]; i 5; j[] 1, "two";
+    ''')
+    assert find_constant_externals([program]) == frozenset(['e', 'i', 'j'])